@@ -1,38 +1,25 @@
 #!/usr/bin/env python2
-"""Aptly mirror/snapshot managment automation."""
-import argparse
+"""Aptly mirror/snapshot managment automation.
+
+pyaptly is started by cron and hooks many times a day, so importing it must
+stay cheap: heavy modules (yaml, subprocess, argparse) and the
+submodules are imported by the functions that need them.
+"""
 import codecs
 import collections
 import datetime
+import hashlib
+import heapq
 import logging
 import os
 import re
-import subprocess
 import sys
-
-import freeze
-import six
-import yaml
+import time
 
 _logging_setup = False
 
-if six.PY2:
-    environb = os.environ  # pragma: no cover
-else:
-    environb = os.environb  # pragma: no cover
-
-
-def init_hypothesis():
-    """Initialize hypothesis profile if hypothesis is available"""
-    try:  # pragma: no cover:w
-        if b'HYPOTHESIS_PROFILE' in environb:
-            from hypothesis import Settings
-            Settings.register_profile("ci", Settings(
-                max_examples=10000
-            ))
-            Settings.load_profile(os.getenv(u'HYPOTHESIS_PROFILE', 'default'))
-    except (ImportError, AttributeError):  # pragma: no cover
-        pass
+# The asyncio engine (:class:`pyaptly.aio.Engine`) used with --jobs
+engine = None
 
 
 def get_logger():
@@ -42,7 +29,6 @@ def get_logger():
     return logging.getLogger("pyaptly")
 
 lg = get_logger()
-init_hypothesis()
 
 
 def iso_first_week_start(iso_year, tzinfo=None):
@@ -177,6 +163,7 @@ def call_output(args, input_=None):
     :param input_: Input to command
     :type  input_: bytes
     """
+    import subprocess
     p = subprocess.Popen(
         args,
         stdin=subprocess.PIPE,
@@ -192,21 +179,100 @@ def call_output(args, input_=None):
     return (output.decode("UTF-8"), err.decode("UTF-8"))
 
 
+def call_output_lines(args):
+    """Call command and yield the decoded lines of its output as they arrive,
+    without the line endings. stderr is spooled to a temporary file, so
+    memory stays flat regardless of the size of the output.
+
+    The exit status is checked after the last line, if the caller stops
+    early the rest of the output is discarded.
+
+    :param args: Command to execute
+    :type  args: list
+    :rtype:      generator"""
+    import subprocess
+    import tempfile
+    null = open(os.devnull, 'rb')
+    try:
+        with tempfile.TemporaryFile() as err:
+            p = subprocess.Popen(
+                args,
+                stdin=null,
+                stdout=subprocess.PIPE,
+                stderr=err,
+            )
+            finished = False
+            try:
+                for line in iter(p.stdout.readline, b''):
+                    yield line.decode("UTF-8").rstrip("\r\n")
+                finished = True
+            finally:
+                if not finished:
+                    for _ in iter(p.stdout.readline, b''):
+                        pass
+                p.stdout.close()
+                p.wait()
+            if p.returncode != 0:
+                err.seek(0)
+                lg.debug(
+                    'Command %s failed: %s', args, err.read().decode("UTF-8")
+                )
+                raise subprocess.CalledProcessError(
+                    p.returncode,
+                    args,
+                )
+    finally:
+        null.close()
+
+
+def freeze_value(value):
+    """Convert lists, dicts and sets recursively to hashable tuples and
+    frozensets.
+
+    :param value: The value to freeze
+    :rtype:       hashable"""
+    if isinstance(value, (list, tuple)):
+        return tuple([freeze_value(x) for x in value])
+    if hasattr(value, 'items'):
+        return tuple(sorted([
+            (key, freeze_value(x)) for key, x in value.items()
+        ]))
+    if isinstance(value, (set, frozenset)):
+        return frozenset([freeze_value(x) for x in value])
+    return value
+
+
 class Command(object):
     """Repesents a system command and is used to resolve dependencies between
     such commands.
 
+    Commands are compared by their structure: the command, its requires and
+    provides. When a command enters the scheduler it is sealed, its key and
+    hash are computed once and it can't be changed anymore.
+
     :param cmd: The command as list, one item per argument
     :type  cmd: list
     """
 
     pretend_mode = False
+    observers    = []
+    durations    = None
+    retries      = None
+    bandwidth    = None
+    progress     = None
+    status_file  = None
+    resources    = None
 
     def __init__(self, cmd):
         self.cmd = cmd
         self._requires = set()
         self._provides = set()
         self._finished = None
+        self._key      = None
+        self._hash     = None
+        self.timeout       = None
+        self.stall_timeout = None
+        self.deferred      = None
         self._known_dependency_types = (
             'snapshot', 'mirror', 'repo', 'publish', 'virtual'
         )
@@ -223,6 +289,7 @@ class Command(object):
         :param argument: String argument to append
         :type  argument: str"""
         assert str(argument) == argument
+        assert self._key is None, "Command is sealed: %r" % self
         self.cmd.append(argument)
 
     def require(self, type_, identifier):
@@ -239,6 +306,7 @@ class Command(object):
             ('any', ) +
             SystemStateReader.known_dependency_types
         )
+        assert self._key is None, "Command is sealed: %r" % self
         self._requires.add((type_, str(identifier)))
 
     def provide(self, type_, identifier):
@@ -251,6 +319,7 @@ class Command(object):
         :type  identifier: usually str
         """
         assert type_ in self._known_dependency_types
+        assert self._key is None, "Command is sealed: %r" % self
         self._provides.add((type_, str(identifier)))
 
     def execute(self):
@@ -261,30 +330,219 @@ class Command(object):
             return self._finished
 
         if not Command.pretend_mode:
-            lg.debug('Running command: %s', ' '.join(self.cmd))
-            self._finished = subprocess.check_call(self.cmd)
+            start = self.begin()
+            try:
+                result = self.run()
+            except Exception as e:
+                self.fail(e)
+                raise
+            self.finish(result, start)
         else:
-            lg.info('Pretending to run command: %s', ' '.join(self.cmd))
+            self.pretend()
 
         return self._finished
 
+    def begin(self):
+        """Notify the observers that the command is started. Return the
+        start time.
+
+        :rtype: float"""
+        self.notify('started')
+        return time.time()
+
+    def fail(self, error):
+        """Notify the observers that the command failed.
+
+        :param error: Exception that made the command fail
+        :type  error: Exception"""
+        self.notify('failed', error)
+
+    def finish(self, result, start):
+        """Mark the command as finished, record its duration and notify the
+        observers.
+
+        :param result: The return value of the command
+        :param  start: Start time returned by :meth:`begin`
+        :type   start: float"""
+        self._finished = result
+        if Command.durations is not None:
+            Command.durations.record(self, time.time() - start)
+        self.notify('finished')
+
+    def monitored(self):
+        """Return True if the command is run by
+        :func:`pyaptly.executor.run_monitored`, because it has limits or its
+        output is needed to classify failures for retries.
+
+        :rtype: bool"""
+        return (
+            self.timeout is not None or
+            self.stall_timeout is not None or
+            self.deferred is not None or
+            Command.retries is not None or
+            (Command.progress is not None and self.kind() == 'mirror update')
+        )
+
+    def output_observer(self):
+        """Return the callable the output of the command is fed to, None if
+        its progress isn't tracked. See :mod:`pyaptly.progress`.
+
+        :rtype: function"""
+        if Command.progress is None:
+            return None
+        return Command.progress.observer(self)
+
+    def run(self):
+        """Run the system command, called by :meth:`execute` unless
+        pretending. Mirror updates get their share of the bandwidth budget,
+        see :mod:`pyaptly.bandwidth`.
+
+        :rtype: integer"""
+        if Command.bandwidth is not None:
+            with Command.bandwidth.allot(self) as args:
+                return self.run_args(args)
+        return self.run_args(self.cmd)
+
+    def run_args(self, args):
+        """Run the system command with the given arguments.
+
+        :param args: The command, with options added at run time
+        :type  args: list
+        :rtype:      integer"""
+        if self.monitored():
+            from . import executor
+            return executor.run_monitored(
+                args, self.timeout, self.stall_timeout, self.preexec(),
+                self.output_observer()
+            )
+        import subprocess
+        lg.debug('Running command: %s', ' '.join([str(x) for x in args]))
+        preexec = self.preexec()
+        if preexec is None:
+            return subprocess.check_call(args)
+        return subprocess.check_call(args, preexec_fn=preexec)
+
+    def preexec(self):
+        """Return the function preparing the process of the command between
+        fork and exec, None if there is nothing to prepare: the resource
+        class of its kind (see :mod:`pyaptly.resources`) and the lower
+        priority of deferred commands.
+
+        :rtype: function"""
+        from . import executor
+        niceness = executor.deferred_niceness if self.deferred else None
+        if Command.resources is None:
+            return executor.lower_priority(niceness)
+        return Command.resources.preexec(self.kind(), niceness)
+
+    def pretend(self):
+        """Log the command instead of running it, called by :meth:`execute`
+        in pretend mode."""
+        lg.info('Pretending to run command: %s', self.describe())
+
+    def kind(self):
+        """Return the kind of the command, for aptly commands the object and
+        the action, ie. "mirror update".
+
+        :rtype: str"""
+        if not isinstance(self.cmd, list) or not self.cmd:
+            return 'unknown'
+        if self.cmd[0] != 'aptly':
+            return os.path.basename(str(self.cmd[0]))
+        words = [x for x in self.cmd[1:] if not x.startswith('-')]
+        return ' '.join(words[:2])
+
+    def opens_database(self):
+        """Return True if the command opens the aptly database, only one
+        process can have it open at a time.
+
+        :rtype: bool"""
+        return is_aptly_call(self.cmd)
+
+    def notify(self, event, error=None):
+        """Inform all registered observers about an execution event.
+
+        Observers are callables registered in :attr:`Command.observers`,
+        called with the command, the event ("started", "finished" or
+        "failed") and the exception in case of failure.
+
+        :param event: Name of the event
+        :type  event: str
+        :param error: Exception that made the command fail
+        :type  error: Exception"""
+        for observer in list(Command.observers):
+            observer(self, event, error)
+
+    def describe(self):
+        """Return a human readable description of the command.
+
+        :rtype: str"""
+        if isinstance(self.cmd, list):
+            return ' '.join([str(x) for x in self.cmd])
+        return str(self.cmd)
+
     def repr_cmd(self):
         """Return repr of the command.
 
         :rtype: str"""
         return repr(self.cmd)
 
+    def structure(self):
+        """Return the structure the command is compared by.
+
+        :rtype: tuple"""
+        return (
+            freeze_value(self.cmd),
+            frozenset(self._requires),
+            frozenset(self._provides),
+        )
+
+    def seal(self):
+        """Compute the key and hash of the command once, afterwards the
+        command can't be changed anymore. Called by the scheduler.
+
+        :rtype: Command"""
+        if self._key is None:
+            self._key  = (type(self).__name__, ) + self.structure()
+            self._hash = hash(self._key)
+        return self
+
+    @property
+    def sealed(self):
+        """True if the command is sealed.
+
+        :rtype: bool"""
+        return self._key is not None
+
+    def key(self):
+        """Return the structural key of the command.
+
+        :rtype: tuple"""
+        if self._key is not None:
+            return self._key
+        return (type(self).__name__, ) + self.structure()
+
     def __hash__(self):
         """Hash of the command.
 
         :rtype: integer"""
-        return freeze.recursive_hash(
-            (self.cmd, self._requires, self._provides)
-        )
+        if self._hash is not None:
+            return self._hash
+        return hash(self.key())
 
     def __eq__(self, other):
-        """Equalitity based on the hash, might collide... hmm"""
-        return self.__hash__() == other.__hash__()
+        """Structural equality."""
+        if self is other:
+            return True
+        if not isinstance(other, Command):
+            return NotImplemented
+        return self.key() == other.key()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
 
     def __repr__(self):
         return "Command<%s requires %s, provides %s>\n" % (
@@ -350,72 +608,156 @@ class Command(object):
             ";\n".join(['%s -> %s' % edge for edge in edges])
         )
 
+    @staticmethod
+    def dependency_graph(commands, has_dependency_cb=lambda x: False):
+        """Build the dependency graph of the commands.
+
+        A command has to wait for all commands providing one of its
+        requirements, unless the requirement is already fulfilled according
+        to has_dependency_cb. Requirements nobody provides never block.
+
+        :param          commands: The commands to order
+        :type           commands: list
+        :param has_dependency_cb: Optional callback the resolve external
+                                  dependencies
+        :type  has_dependency_cb: function
+        :rtype:                   (list, dict, dict) the unique commands,
+                                  their predecessors and successors"""
+        unique = []
+        seen   = set()
+        for cmd in commands:
+            if cmd is not None:
+                cmd.seal()
+            if cmd is not None and cmd not in seen:
+                seen.add(cmd)
+                unique.append(cmd)
+
+        providers = collections.defaultdict(list)
+        for cmd in unique:
+            for provide in cmd._provides:
+                providers[provide].append(cmd)
+
+        fulfilled    = {}
+        predecessors = dict([(cmd, set()) for cmd in unique])
+        successors   = dict([(cmd, set()) for cmd in unique])
+        for cmd in unique:
+            for req in cmd._requires:
+                if req not in providers:
+                    continue
+                if req not in fulfilled:
+                    # Let's see if the dependency is already otherwise
+                    # fulfilled
+                    fulfilled[req] = has_dependency_cb(req)
+                    lg.debug(
+                        "dependency %s in aptly state: %s" % (
+                            req, fulfilled[req]
+                        )
+                    )
+                if fulfilled[req]:
+                    continue
+                for provider in providers[req]:
+                    predecessors[cmd].add(provider)
+                    successors[provider].add(cmd)
+
+        return (unique, predecessors, successors)
+
+    @staticmethod
+    def estimator():
+        """Return the function estimating the duration of commands, based on
+        the recorded durations if :attr:`Command.durations` is set.
+
+        :rtype: function"""
+        from . import durations
+        if Command.durations is not None:
+            return Command.durations.estimate
+        return durations.default_estimate
+
+    @staticmethod
+    def critical_paths(commands, successors, estimate):
+        """Calculate the longest remaining path through the dependency graph
+        for every command, including the command itself.
+
+        Commands in cycles are missing from the result.
+
+        :param   commands: The unique commands
+        :type    commands: list
+        :param successors: Successors as returned by
+                           :meth:`dependency_graph`
+        :type  successors: dict
+        :param   estimate: Estimates the duration of a command in seconds
+        :type    estimate: function
+        :rtype:            dict"""
+        incoming = collections.defaultdict(lambda: 0)
+        for cmd in commands:
+            for successor in successors[cmd]:
+                incoming[successor] += 1
+        topological = [cmd for cmd in commands if incoming[cmd] == 0]
+        for cmd in topological:
+            for successor in successors[cmd]:
+                incoming[successor] -= 1
+                if incoming[successor] == 0:
+                    topological.append(successor)
+
+        paths = {}
+        for cmd in reversed(topological):
+            paths[cmd] = estimate(cmd) + max(
+                [paths[x] for x in successors[cmd]] + [0]
+            )
+        return paths
+
     @staticmethod
     def order_commands(commands, has_dependency_cb=lambda x: False):
         """Order the commands according to the dependencies they
         provide/require.
 
+        Among the commands that are ready to run, the one with the longest
+        remaining path through the dependency graph is scheduled first, see
+        :meth:`critical_paths`.
+
         :param          commands: The commands to order
         :type           commands: list
         :param has_dependency_cb: Optional callback the resolve external
                                   dependencies
         :type  has_dependency_cb: function"""
 
-        commands = set([c for c in commands if c is not None])
+        commands, predecessors, successors = Command.dependency_graph(
+            commands, has_dependency_cb
+        )
 
         lg.debug('Ordering commands: %s', [
             str(cmd) for cmd in commands
         ])
 
-        have_requirements = collections.defaultdict(lambda: 0)
-        required_number   = collections.defaultdict(lambda: 0)
-        scheduled  = []
-
-        for cmd in commands:
-            for provide in cmd._provides:
-                required_number[provide] += 1
-
-        something_changed = True
-        while something_changed:
-            something_changed = False
-
-            for cmd in commands:
-                if cmd in scheduled:
-                    continue
+        paths = Command.critical_paths(
+            commands, successors, Command.estimator()
+        )
+        scheduled = []
+        waiting   = dict([(cmd, len(predecessors[cmd])) for cmd in commands])
+        ready     = [
+            (-paths[cmd], index, cmd)
+            for index, cmd in enumerate(commands)
+            if waiting[cmd] == 0
+        ]
+        heapq.heapify(ready)
+        index     = dict([(cmd, i) for i, cmd in enumerate(commands)])
 
-                can_schedule = True
-                for req in cmd._requires:
-                    if have_requirements[req] < required_number[req]:
-                        lg.debug(
-                            "%s: dependency %s not fulfilled, "
-                            "checking aptly state" % (cmd, req)
-                        )
-                        # No command providing our dependency.. Let's see if
-                        # it's already otherwise fulfilled
-                        if not has_dependency_cb(req):
-                            lg.debug(
-                                "%s: dependency %s not "
-                                "in aptly state either" % (cmd, req)
-                            )
-                            can_schedule = False
-                            # Break out of the requirements loop, as the
-                            # command cannot be scheduled anyway.
-                            break
-
-                if can_schedule:
-                    lg.debug(
-                        "%s: all dependencies fulfilled" % cmd
+        while ready:
+            _, _, cmd = heapq.heappop(ready)
+            lg.debug(
+                "%s: all dependencies fulfilled" % cmd
+            )
+            scheduled.append(cmd)
+            for successor in successors[cmd]:
+                waiting[successor] -= 1
+                if waiting[successor] == 0:
+                    heapq.heappush(
+                        ready, (-paths[successor], index[successor], successor)
                     )
-                    scheduled.append(cmd)
-                    for provide in cmd._provides:
-                        have_requirements[provide] += 1
-
-                    something_changed = True
 
         unresolved = [
             cmd
             for cmd in commands
-            if cmd not in scheduled
+            if waiting[cmd] > 0
         ]
 
         if len(unresolved) > 0:  # pragma: no cover
@@ -434,6 +776,69 @@ class Command(object):
 
         return scheduled
 
+    @staticmethod
+    def predict_makespan(commands,
+                         has_dependency_cb=lambda x: False,
+                         workers=1):
+        """Predict how long executing the commands takes, if up to *workers*
+        commands run at once and ready commands are started in the order of
+        their critical paths.
+
+        :param          commands: The commands to execute
+        :type           commands: list
+        :param has_dependency_cb: Optional callback the resolve external
+                                  dependencies
+        :type  has_dependency_cb: function
+        :param           workers: Number of commands running at once
+        :type            workers: int
+        :rtype:                   float"""
+        commands, predecessors, successors = Command.dependency_graph(
+            commands, has_dependency_cb
+        )
+        estimate = Command.estimator()
+        paths    = Command.critical_paths(commands, successors, estimate)
+        index    = dict([(cmd, i) for i, cmd in enumerate(commands)])
+        waiting  = dict([(cmd, len(predecessors[cmd])) for cmd in commands])
+        ready    = [
+            (-paths[cmd], index[cmd], cmd)
+            for cmd in commands
+            if waiting[cmd] == 0
+        ]
+        heapq.heapify(ready)
+        running = []
+        now     = 0.0
+        while ready or running:
+            while ready and len(running) < workers:
+                _, i, cmd = heapq.heappop(ready)
+                heapq.heappush(running, (now + estimate(cmd), i, cmd))
+            now, _, cmd = heapq.heappop(running)
+            for successor in successors[cmd]:
+                waiting[successor] -= 1
+                if waiting[successor] == 0:
+                    heapq.heappush(
+                        ready, (-paths[successor], index[successor], successor)
+                    )
+        return now
+
+
+# Functions of FunctionCommands that only work on files or gpg
+database_free_functions = frozenset([
+    'add_gpg_keys', 'fail_unplanned', 'release_staged', 'replicate_publish',
+    'rollback_staged',
+])
+
+
+def is_aptly_call(args):
+    """Return True if a call runs aptly.
+
+    :param args: The call
+    :type  args: list
+    :rtype:      bool"""
+    return (
+        isinstance(args, list) and bool(args) and
+        os.path.basename(str(args[0])) == 'aptly'
+    )
+
 
 class FunctionCommand(Command):
     """Repesents a function command and is used to resolve dependencies between
@@ -452,42 +857,64 @@ class FunctionCommand(Command):
         self.args   = args
         self.kwargs = kwargs
 
-    def __hash__(self):
-        return freeze.recursive_hash(
-            (
-                id(self.cmd),
-                self.args,
-                self.kwargs,
-                self._requires,
-                self._provides
-            )
+    def structure(self):
+        """Return the structure the command is compared by, the function is
+        compared by identity.
+
+        :rtype: tuple"""
+        return (
+            self.cmd,
+            freeze_value(self.args),
+            freeze_value(self.kwargs),
+            frozenset(self._requires),
+            frozenset(self._provides),
         )
 
-    def execute(self):
-        """Execute the command. (Call the function)."""
-        if self._finished is not None:  # pragma: no cover
-            return self._finished
+    def run(self):
+        """Call the function, called by :meth:`Command.execute` unless
+        pretending."""
+        lg.debug(
+            'Running code: %s(args=%s, kwargs=%s)',
+            self.cmd.__name__,
+            repr(self.args),
+            repr(self.kwargs),
+        )
+        self.cmd(*self.args, **self.kwargs)
+        return True
 
-        if not Command.pretend_mode:
-            lg.debug(
-                'Running code: %s(args=%s, kwargs=%s)',
-                self.cmd.__name__,
-                repr(self.args),
-                repr(self.kwargs),
-            )
+    def pretend(self):  # pragma: no cover
+        """Log the function call instead of calling it."""
+        lg.info(
+            'Pretending to run code: %s(args=%s, kwargs=%s)',
+            self.repr_cmd(),
+            repr(self.args),
+            repr(self.kwargs),
+        )
 
-            self.cmd(*self.args, **self.kwargs)
+    def kind(self):
+        """Return the kind of the command, which is always "function".
 
-            self._finished = True
-        else:  # pragma: no cover
-            lg.info(
-                'Pretending to run code: %s(args=%s, kwargs=%s)',
-                self.repr_cmd(),
-                repr(self.args),
-                repr(self.kwargs),
-            )
+        :rtype: str"""
+        return 'function'
 
-        return self._finished
+    def opens_database(self):
+        """Return True unless the function is known not to call aptly, see
+        :data:`database_free_functions`.
+
+        :rtype: bool"""
+        return self.cmd.__name__ not in database_free_functions
+
+    def describe(self):
+        """Return a human readable description of the function call.
+
+        :rtype: str"""
+        return '%s(%s)' % (
+            self.cmd.__name__,
+            ", ".join(
+                [repr(x) for x in self.args] +
+                ['%s=%r' % x for x in sorted(self.kwargs.items())]
+            )
+        )
 
     def repr_cmd(self):
         """Return repr of the command.
@@ -508,12 +935,39 @@ class FunctionCommand(Command):
 class SystemStateReader(object):
     """Reads the state from aptly and gpg to find out what operations have to
     be performed to reach the state defined in the yml config-file.
+
+    The names read are interned in a name table and stored in compact
+    immutable sets and maps, see :mod:`pyaptly.statestore`.
     """
     known_dependency_types = (
         'repo', 'snapshot', 'mirror', 'gpg_key'
     )
+    name_set_attributes = (
+        'gpg_keys', 'mirrors', 'repos', 'snapshots', 'publishes'
+    )
+    gpg_list_keys = [
+        "gpg",
+        "--no-default-keyring",
+        "--keyring", "trustedkeys.gpg",
+        "--list-keys",
+        "--with-colons"
+    ]
+    # Command of the aptly calls reading the state, see :mod:`pyaptly.dbcopy`
+    aptly_cmd = ["aptly"]
+    # Reads the state with aptly or from the database, see
+    # :mod:`pyaptly.aptlydb`
+    backend = "aptly"
+    # match example:  main: test-snapshot [snapshot]
+    re_publish_source = re.compile(
+        r"\s+[\w\d-]+\:\s([\w\d-]+)\s\[snapshot\]"
+    )
+    # match example:  test-snapshot [snapshot]
+    re_snapshot_source = re.compile(r"\s+([\w\d-]+)\s\[snapshot\]")
 
     def __init__(self):
+        self.names        = None
+        self._timestamps  = (None, None)
+        self._database    = (None, None)
         self.gpg_keys     = set()
         self.mirrors      = set()
         self.repos        = set()
@@ -522,6 +976,61 @@ class SystemStateReader(object):
         self.publishes    = set()
         self.publish_map  = {}
 
+    def _name_table(self):
+        from . import statestore
+        if self.names is None:
+            self.names = statestore.NameTable()
+        return self.names
+
+    def _name_set(self, names):
+        """Store names as :class:`pyaptly.statestore.NameSet`."""
+        from . import statestore
+        return statestore.NameSet(self._name_table(), names)
+
+    def _name_map(self, mapping):
+        """Store a mapping of names to names as
+        :class:`pyaptly.statestore.NameMap`."""
+        from . import statestore
+        return statestore.NameMap(self._name_table(), mapping)
+
+    def timestamp_index(self):
+        """Return the index of the existing timestamped snapshots, it is
+        rebuilt when the snapshots have changed.
+
+        :rtype: :class:`pyaptly.statestore.TimestampIndex`"""
+        from . import statestore
+        snapshots, index = self._timestamps
+        if snapshots is not self.snapshots:
+            index = statestore.TimestampIndex(self.snapshots)
+            self._timestamps = (self.snapshots, index)
+        return index
+
+    def copy(self):
+        """Return a copy of the state, the sets and maps are immutable so they
+        are shared.
+
+        :rtype: SystemStateReader"""
+        other = SystemStateReader()
+        other.__dict__.update(self.__dict__)
+        return other
+
+    def diff(self, other):
+        """Compare with an earlier state.
+
+        :param other: The earlier state
+        :type  other: SystemStateReader
+        :rtype:       dict of (added, removed) names per attribute"""
+        from . import statestore
+        return dict([
+            (
+                attribute,
+                statestore.diff(
+                    getattr(other, attribute), getattr(self, attribute)
+                )
+            )
+            for attribute in self.name_set_attributes
+        ])
+
     def _extract_sources(self, data):
         """
         Extract sources from data.
@@ -531,10 +1040,15 @@ class SystemStateReader(object):
         Description: some description
         Sources:
           test-snap-base [snapshot]
+
+        :param data: Output of aptly, as string or iterable of lines
+        :type  data: str or iterable
         """
+        if hasattr(data, 'split'):
+            data = data.split("\n")
         entered_sources = False
         sources = []
-        for line in data.split("\n"):
+        for line in data:
             # source line need to start with two spaces
             if entered_sources and line[0:2] != '  ':
                 break
@@ -547,9 +1061,23 @@ class SystemStateReader(object):
 
         return sources
 
+    def aptly_call(self, call):
+        """Return an aptly call reading the state, with the config of the
+        database copy if the state is read from a copy.
+
+        :param call: The call, starting with "aptly"
+        :type  call: list
+        :rtype:      list"""
+        return list(self.aptly_cmd) + list(call[1:])
+
     def read(self):
         """Reads all available system states."""
+        # Intern into a new table, so it doesn't keep the names of every
+        # state ever read in a long running process
+        self.names = None
         self.read_gpg()
+        if self.backend == "leveldb" and self.read_database():
+            return
         self.read_repos()
         self.read_mirror()
         self.read_snapshot()
@@ -557,59 +1085,102 @@ class SystemStateReader(object):
         self.read_publishes()
         self.read_publish_map()
 
+    def read_database(self):
+        """Read the repos, mirrors, snapshots and publishes from a copy of
+        the aptly database, see :mod:`pyaptly.aptlydb`. Returns False if no
+        copy could be taken. The database is only copied and read again if it
+        changed since it was read last.
+
+        :rtype: bool"""
+        from . import aptlydb, dbcopy
+        fingerprint = dbcopy.source_fingerprint()
+        cached, read = self._database
+        if fingerprint is None or fingerprint != cached:
+            config = dbcopy.prepare(os.path.join(state_dir(), 'dbcopy'))
+            if config is None:
+                lg.warning('Reading the state with aptly')
+                return False
+            read = aptlydb.read(os.path.join(os.path.dirname(config), 'db'))
+            self._database = (fingerprint, read)
+        else:
+            lg.debug('Aptly database unchanged, reusing the state read')
+        self.repos        = self._name_set(read['repos'])
+        self.mirrors      = self._name_set(read['mirrors'])
+        self.snapshots    = self._name_set(read['snapshots'])
+        self.snapshot_map = self._name_map(read['snapshot_map'])
+        self.publishes    = self._name_set(read['publishes'])
+        self.publish_map  = self._name_map(read['publish_map'])
+        return True
+
     def read_gpg(self):
         """Read all trusted keys in gpg."""
-        self.gpg_keys = set()
-        data, _ = call_output([
-            "gpg",
-            "--no-default-keyring",
-            "--keyring", "trustedkeys.gpg",
-            "--list-keys",
-            "--with-colons"
-        ])
-        lg.debug('GPG returned: %s', data)
-        for line in data.split("\n"):
+        self.gpg_keys = self._name_set(
+            self.parse_gpg(call_output_lines(self.gpg_list_keys))
+        )
+        lg.debug('GPG returned %d keys', len(self.gpg_keys))
+
+    def parse_gpg(self, lines):
+        """Parse the keys listed by gpg.
+
+        :param lines: Output of :attr:`gpg_list_keys`
+        :type  lines: iterable
+        :rtype:       set"""
+        gpg_keys = set()
+        for line in lines:
             field = line.split(":")
             if field[0] in ("pub", "sub"):
                 key = field[4]
                 key_short = key[8:]
-                self.gpg_keys.add(key)
-                self.gpg_keys.add(key_short)
+                gpg_keys.add(key)
+                gpg_keys.add(key_short)
+        return gpg_keys
+
+    def parse_publish_sources(self, lines):
+        """Parse the snapshots of a publish.
+
+        :param lines: Output of aptly publish show
+        :type  lines: iterable
+        :rtype:       list"""
+        sources = self._extract_sources(lines)
+        matches = [self.re_publish_source.match(x) for x in sources]
+        return [match.group(1) for match in matches if match]
+
+    def parse_snapshot_sources(self, lines):
+        """Parse the source snapshots of a snapshot.
+
+        :param lines: Output of aptly snapshot show
+        :type  lines: iterable
+        :rtype:       list"""
+        sources = self._extract_sources(lines)
+        matches = [self.re_snapshot_source.match(x) for x in sources]
+        return [match.group(1) for match in matches if match]
 
     def read_publish_map(self):
         """Create a publish map. publish -> snapshots"""
-        self.publish_map = {}
-        # match example:  main: test-snapshot [snapshot]
-        re_snap = re.compile(r"\s+[\w\d-]+\:\s([\w\d-]+)\s\[snapshot\]")
+        publish_map = {}
         for publish in self.publishes:
-
             prefix, dist = publish.split(' ')
-            data, _ = call_output([
-                "aptly", "publish", "show", dist, prefix
-            ])
-
-            sources = self._extract_sources(data)
-            matches = [re_snap.match(source) for source in sources]
-            snapshots = [match.group(1) for match in matches if match]
-            self.publish_map[publish] = set(snapshots)
+            publish_map[publish] = self.parse_publish_sources(
+                call_output_lines(self.aptly_call([
+                    "aptly", "publish", "show", dist, prefix
+                ]))
+            )
 
+        self.publish_map = self._name_map(publish_map)
         lg.debug('Joined snapshots and publishes: %s', self.publish_map)
 
     def read_snapshot_map(self):
         """Create a snapshot map. snapshot -> snapshots. This is also called
         merge-tree."""
-        self.snapshot_map = {}
-        # match example:  test-snapshot [snapshot]
-        re_snap = re.compile(r"\s+([\w\d-]+)\s\[snapshot\]")
+        snapshot_map = {}
         for snapshot_outer in self.snapshots:
-            data, _ = call_output([
-                "aptly", "snapshot", "show", snapshot_outer
-            ])
-            sources = self._extract_sources(data)
-            matches = [re_snap.match(source) for source in sources]
-            snapshots = [match.group(1) for match in matches if match]
-            self.snapshot_map[snapshot_outer] = set(snapshots)
+            snapshot_map[snapshot_outer] = self.parse_snapshot_sources(
+                call_output_lines(self.aptly_call([
+                    "aptly", "snapshot", "show", snapshot_outer
+                ]))
+            )
 
+        self.snapshot_map = self._name_map(snapshot_map)
         lg.debug(
             'Joined snapshots with self(snapshots): %s',
             self.snapshot_map
@@ -617,23 +1188,27 @@ class SystemStateReader(object):
 
     def read_publishes(self):
         """Read all available publishes."""
-        self.publishes = set()
-        self.read_aptly_list("publish", self.publishes)
+        names = set()
+        self.read_aptly_list("publish", names)
+        self.publishes = self._name_set(names)
 
     def read_repos(self):
         """Read all available repos."""
-        self.repos = set()
-        self.read_aptly_list("repo", self.repos)
+        names = set()
+        self.read_aptly_list("repo", names)
+        self.repos = self._name_set(names)
 
     def read_mirror(self):
         """Read all available mirrors."""
-        self.mirrors = set()
-        self.read_aptly_list("mirror", self.mirrors)
+        names = set()
+        self.read_aptly_list("mirror", names)
+        self.mirrors = self._name_set(names)
 
     def read_snapshot(self):
         """Read all available snapshots."""
-        self.snapshots = set()
-        self.read_aptly_list("snapshot", self.snapshots)
+        names = set()
+        self.read_aptly_list("snapshot", names)
+        self.snapshots = self._name_set(names)
 
     def read_aptly_list(self, type_, list_):
         """Generic method to read lists from aptly.
@@ -642,15 +1217,52 @@ class SystemStateReader(object):
         :type  type_: str
         :param list_: Read into this list
         :param list_: list"""
-        data, _ = call_output([
-            "aptly", type_, "list", "-raw"
-        ])
-        lg.debug('Aptly returned %s: %s', type_, data)
-        for line in data.split("\n"):
+        self.parse_aptly_list(
+            call_output_lines(
+                self.aptly_call(["aptly", type_, "list", "-raw"])
+            ),
+            list_
+        )
+        lg.debug('Aptly returned %d %s entries', len(list_), type_)
+
+    def parse_aptly_list(self, lines, list_):
+        """Parse the names of a raw aptly list.
+
+        :param lines: Output of aptly list -raw
+        :type  lines: iterable
+        :param list_: Read into this list
+        :type  list_: list"""
+        for line in lines:
             clean_line = line.strip()
             if clean_line:
                 list_.add(clean_line)
 
+    def fingerprint(self):
+        """Return a fingerprint of the aptly and gpg state.
+
+        Only the list commands are used, not the show commands for every
+        snapshot and publish, so it is much cheaper than :meth:`read`. The
+        non-raw publish list contains the sources of the publishes.
+
+        :rtype: str"""
+        digest = hashlib.sha256()
+        calls = [
+            self.gpg_list_keys,
+            ["aptly", "repo", "list", "-raw"],
+            ["aptly", "mirror", "list", "-raw"],
+            ["aptly", "snapshot", "list", "-raw"],
+            ["aptly", "publish", "list"],
+        ]
+        for call in calls:
+            if call[0] == "aptly":
+                output = call_output_lines(self.aptly_call(call))
+            else:
+                output = call_output_lines(call)
+            lines = sorted([line.strip() for line in output])
+            digest.update(" ".join(call).encode("UTF-8"))
+            digest.update("\n".join(lines).encode("UTF-8"))
+        return digest.hexdigest()
+
     def has_dependency(self, dependency):
         """Check system state dependencies.
 
@@ -666,6 +1278,8 @@ class SystemStateReader(object):
             return name in self.snapshots  # pragma: no cover
         elif type_ == 'gpg_key':  # pragma: no cover
             return name in self.gpg_keys  # Not needed ATM
+        elif type_ == 'publish':
+            return name in self.publishes
         elif type_ == 'virtual':
             # virtual dependencies can never be resolved by the
             # system state reader - they are used for internal
@@ -686,6 +1300,7 @@ def main(argv=None):
     :param argv: Arguments usually taken from sys.argv
     :type  argv: list"""
     global _logging_setup
+    import argparse
     if not argv:  # pragma: no cover
         argv = sys.argv[1:]
     parser = argparse.ArgumentParser(description='Manage aptly')
@@ -694,7 +1309,6 @@ def main(argv=None):
         '-c',
         help='Yaml config file defining mirrors and snapshots',
         type=str,
-        required=True
     )
     parser.add_argument(
         '--debug',
@@ -708,6 +1322,46 @@ def main(argv=None):
         help='Do not do anything, just print out what WOULD be done',
         action='store_true',
     )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        help='Run up to JOBS aptly and gpg processes at once, independent '
+             'commands run concurrently (requires Python 3.5)',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--status-file',
+        help='Write the progress of mirror updates to STATUS_FILE, default '
+             'status.json in the state directory',
+        type=str,
+    )
+    parser.add_argument(
+        '--state-copy',
+        help='Read the state of pretend and plan runs from a copy of the '
+             'aptly database, so they do not wait for a running aptly',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--state-backend',
+        help='Read the state with aptly commands or from the aptly database '
+             'directly (requires plyvel), default aptly',
+        choices=['aptly', 'leveldb'],
+        default='aptly',
+    )
+    parser.add_argument(
+        '--changed-only',
+        help='Plan only the entities whose config changed since the last '
+             'successful run of the task, and the ones downstream of them',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--lock-timeout',
+        help='Seconds to wait for another run on the same aptly root, '
+             'default 3600',
+        type=float,
+        default=3600,
+    )
     subparsers = parser.add_subparsers()
     mirror_parser = subparsers.add_parser(
         'mirror',
@@ -742,7 +1396,11 @@ def main(argv=None):
         help='manage aptly publish endpoints'
     )
     publish_parser.set_defaults(func=publish)
-    publish_parser.add_argument('task', type=str, choices=['create', 'update'])
+    publish_parser.add_argument(
+        'task',
+        type=str,
+        choices=['create', 'update', 'rollback']
+    )
     publish_parser.add_argument(
         'publish_name',
         type=str,
@@ -754,15 +1412,74 @@ def main(argv=None):
         help='manage aptly repositories'
     )
     repo_parser.set_defaults(func=repo)
-    repo_parser.add_argument('task', type=str, choices=['create'])
+    repo_parser.add_argument('task', type=str, choices=['create', 'add'])
     repo_parser.add_argument(
         'repo_name',
         type=str,
         nargs='?',
         default='all'
     )
+    repo_parser.add_argument(
+        'directories',
+        type=str,
+        nargs='*',
+        help='Incoming directories to add, instead of the ones in the config'
+    )
+    serve_parser = subparsers.add_parser(
+        'serve',
+        help='accept mirror, snapshot, publish and repo tasks on a local '
+             'control socket'
+    )
+    serve_parser.set_defaults(func=serve)
+    serve_parser.add_argument(
+        'socket',
+        type=str,
+        help='Path of the unix socket to listen on'
+    )
+    plan_parser = subparsers.add_parser(
+        'plan',
+        help='write the commands of a task to a plan file, see apply'
+    )
+    plan_parser.set_defaults(func=plan)
+    plan_parser.add_argument(
+        '--output',
+        '-o',
+        type=str,
+        required=True,
+        help='Path of the plan file to write'
+    )
+    plan_parser.add_argument('entry', type=str, choices=sorted(plan_entries))
+    plan_parser.add_argument('task', type=str)
+    plan_parser.add_argument(
+        'name',
+        type=str,
+        nargs='?',
+        default='all'
+    )
+    apply_parser = subparsers.add_parser(
+        'apply',
+        help='execute a plan file written by plan'
+    )
+    apply_parser.set_defaults(func=apply, needs_config=False)
+    apply_parser.add_argument('plan_file', type=str)
+    apply_parser.add_argument(
+        '--force',
+        help='Apply the plan even if the state has changed since planning',
+        action='store_true',
+    )
 
     args = parser.parse_args(argv)
+    needs_config = getattr(args, 'needs_config', True)
+    if needs_config and not args.config:
+        parser.error("argument --config/-c is required")
+    if args.jobs < 1:
+        parser.error("argument --jobs/-j must be at least 1")
+    if args.jobs > 1 and sys.version_info < (3, 5):
+        parser.error("argument --jobs/-j requires Python 3.5")
+    if args.state_backend == 'leveldb':
+        from . import aptlydb
+        if not aptlydb.available():
+            parser.error("argument --state-backend leveldb requires plyvel")
     root = logging.getLogger()
     formatter = logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -780,15 +1497,416 @@ def main(argv=None):
     else:
         Command.pretend_mode = False
 
-        _logging_setup = True  # noqa
-    lg.debug("Args: %s", vars(args))
+        _logging_setup = True  # noqa
+    lg.debug("Args: %s", vars(args))
+
+    if Command.durations is None:
+        from . import durations
+        Command.durations = durations.LazyStore(state_dir())
+
+    global engine
+    if args.jobs > 1:
+        from . import aio
+        engine = aio.Engine(args.jobs)
+    Command.retries = None
+    Command.bandwidth = None
+    Command.resources = None
+    Command.status_file = None
+    if not Command.pretend_mode:
+        Command.status_file = (
+            args.status_file or os.path.join(state_dir(), 'status.json')
+        )
+    lock = None
+    try:
+        if not needs_config:
+            lock = lock_run(args)
+            args.func(None, args)
+            return
+
+        cfg = load_config(args.config)
+        if cfg.get('retries'):
+            from . import executor
+            Command.retries = executor.RetryPolicy.from_config(
+                cfg['retries']
+            )
+        if cfg.get('resources'):
+            from . import resources
+            Command.resources = resources.Resources.from_config(
+                cfg['resources']
+            )
+        if cfg.get('bandwidth'):
+            from . import bandwidth
+            # Mirror updates hold the aptly database, they never run
+            # concurrently, whatever --jobs is
+            Command.bandwidth = bandwidth.Budget.from_config(cfg['bandwidth'])
+        lock = lock_run(args)
+        if args.state_copy:
+            use_state_copy(args)
+        state.backend = args.state_backend
+        read_state()
+        changes = None
+        if args.changed_only:
+            changes = detect_changes(cfg, args)
+
+        # run function for selected subparser
+        args.func(cfg, args)
+        if changes is not None and not Command.pretend_mode:
+            store, task, digests = changes
+            store.save(os.path.abspath(args.config), task, digests)
+    finally:
+        if lock is not None:
+            lock.release()
+        if engine is not None:
+            engine.close()
+            engine = None
+        if Command.progress is not None:
+            Command.observers.remove(Command.progress)
+            Command.progress = None
+        Command.status_file = None
+        state.aptly_cmd = SystemStateReader.aptly_cmd
+        state.backend = SystemStateReader.backend
+
+
+def run_request(args):
+    """Return the request of a run for the run lock, None if the run doesn't
+    change aptly.
+
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace
+    :rtype:      dict"""
+    func = getattr(args, 'func', None)
+    if func is apply:
+        return {
+            'config': None,
+            'entry':  'apply',
+            'task':   'apply',
+            'name':   os.path.abspath(args.plan_file),
+        }
+    entry = getattr(func, '__name__', None)
+    if entry not in plan_entries:
+        return None
+    request = {
+        'config': os.path.abspath(args.config),
+        'entry':  entry,
+        'task':   args.task,
+        'name':   getattr(args, plan_entries[entry][1]),
+    }
+    if getattr(args, 'directories', None):
+        request['directories'] = [
+            os.path.abspath(x) for x in args.directories
+        ]
+    return request
+
+
+def lock_run(args):
+    """Take the lock of the aptly root for a run changing aptly, see
+    :mod:`pyaptly.runlock`. Exits if the run was coalesced with a waiting
+    run.
+
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace
+    :rtype:      :class:`pyaptly.runlock.RunLock`"""
+    request = run_request(args)
+    if request is None or Command.pretend_mode:
+        return None
+    from . import runlock
+    lock = runlock.RunLock(runlock.aptly_root(), args.lock_timeout)
+    if not lock.acquire(request):
+        lg.warning('Run coalesced with a waiting run: %s', request)
+        sys.exit(runlock.coalesced_status)
+    return lock
+
+
+def detect_changes(cfg, args):
+    """Select the entities affected by changes of the config since the last
+    successful run of the task, see :mod:`pyaptly.changes`. Returns the
+    digests to store after the run, None if nothing is stored.
+
+    :param  cfg: The configuration yml as dict
+    :type   cfg: dict
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace
+    :rtype:      tuple of the store, the task and the digests"""
+    from . import changes
+    if args.func is plan:
+        entry, name = args.entry, args.name
+    else:
+        entry = getattr(args.func, '__name__', None)
+        name = getattr(args, plan_entries.get(entry, (None, 'name'))[1], None)
+    if entry not in plan_entries or name != 'all':
+        lg.warning('--changed-only only applies to the tasks of "all"')
+        return None
+    task = '%s %s' % (entry, args.task)
+    store = changes.DigestStore(
+        os.path.join(state_dir(), 'config-digests.json')
+    )
+    digests = changes.digests(cfg)
+    args.changed = changes.closure(cfg, changes.changed(
+        store.load(os.path.abspath(args.config), task), digests
+    ))
+    for type_ in changes.entity_types:
+        if args.changed[type_]:
+            lg.info(
+                'Changed %s entities: %s',
+                type_, ', '.join(sorted(args.changed[type_]))
+            )
+    if args.func is plan:
+        # The plan is applied later, apply records the run
+        args.digests = digests
+        return None
+    return store, task, digests
+
+
+def selected_entities(cfg, args, type_):
+    """Return the entities of a type a task plans for "all", with
+    --changed-only the ones affected by changes of the config.
+
+    :param   cfg: The configuration yml as dict
+    :type    cfg: dict
+    :param  args: The command-line arguments read with :py:mod:`argparse`
+    :type   args: namespace
+    :param type_: The type, ie. "mirror"
+    :type  type_: str
+    :rtype:       list of (name, config)"""
+    changed = getattr(args, 'changed', None)
+    return [
+        (name, config) for name, config in cfg[type_].items()
+        if changed is None or name in changed[type_]
+    ]
+
+
+def use_state_copy(args):
+    """Read the state from a copy of the aptly database in pretend and plan
+    runs, see :mod:`pyaptly.dbcopy`. Runs changing aptly read the database
+    itself.
+
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace"""
+    if not (Command.pretend_mode or args.func is plan):
+        lg.warning('--state-copy is ignored by runs changing aptly')
+        return
+    from . import dbcopy
+    config = dbcopy.prepare(os.path.join(state_dir(), 'dbcopy'))
+    if config is not None:
+        state.aptly_cmd = ['aptly', '-config=%s' % config]
+
+
+def load_config(path):
+    """Read the yml config file.
+
+    :param path: Path of the config file
+    :type  path: str
+    :rtype:      dict"""
+    import yaml
+    with codecs.open(path, 'r', encoding="UTF-8") as cfgfile:
+        return yaml.load(cfgfile)
+
+
+def state_dir():
+    """Return the directory pyaptly keeps its own state in, ie. the durations
+    of commands. It is ~/.pyaptly unless PYAPTLY_STATE_DIR is set.
+
+    :rtype: str"""
+    directory = os.environ.get(
+        'PYAPTLY_STATE_DIR',
+        os.path.join(os.path.expanduser('~'), '.pyaptly')
+    )
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
+# Limits of commands per kind unless configured in "timeouts" or per entity
+default_limits = {
+    'mirror update': {'stall-timeout': 3600},
+}
+
+
+def limit_command(cmd, config):
+    """Set the timeout and stall timeout of a command from the "timeout" and
+    "stall-timeout" keys of the configuration of its entity.
+
+    :param    cmd: The command
+    :type     cmd: Command
+    :param config: Configuration of the mirror or publish
+    :type  config: dict
+    :rtype:        Command"""
+    cmd.timeout       = config.get('timeout')
+    cmd.stall_timeout = config.get('stall-timeout')
+    return cmd
+
+
+def limit_commands(cfg, commands):
+    """Set the limits of the commands without limits configured per entity,
+    from the "timeouts" config per kind of command or the defaults.
+
+    :param      cfg: pyaptly config
+    :type       cfg: dict
+    :param commands: The commands
+    :type  commands: list
+    :rtype:          list"""
+    timeouts = cfg.get('timeouts') or {}
+    for cmd in commands:
+        kind = cmd.kind()
+        limits = timeouts.get(kind, default_limits.get(kind, {}))
+        if cmd.timeout is None:
+            cmd.timeout = limits.get('timeout')
+        if cmd.stall_timeout is None:
+            cmd.stall_timeout = limits.get('stall-timeout')
+    return commands
+
+
+def track_progress(commands):
+    """Start tracking the progress of mirror updates, if the commands contain
+    one and :attr:`Command.status_file` is set. See :mod:`pyaptly.progress`.
+
+    :param commands: The commands to execute
+    :type  commands: list"""
+    if Command.progress is not None or Command.status_file is None:
+        return
+    if 'mirror update' not in [cmd.kind() for cmd in commands]:
+        return
+    from . import progress
+    Command.progress = progress.Tracker(Command.status_file)
+    Command.observers.append(Command.progress)
+
+
+def execute_commands(commands, has_dependency_cb=None):
+    """Execute ordered commands. The dependents of failed commands are
+    skipped, the other commands are executed. The first error is raised
+    after the run.
+
+    :param          commands: Commands as returned by
+                              :meth:`Command.order_commands`
+    :type           commands: list
+    :param has_dependency_cb: Callback to resolve external dependencies,
+                              defaults to the system state
+    :type  has_dependency_cb: function
+    :rtype:                   :class:`pyaptly.executor.RunReport`"""
+    from . import executor
+    if has_dependency_cb is None:
+        has_dependency_cb = state.has_dependency
+    track_progress(commands)
+    if Command.pretend_mode:
+        lg.info(
+            'Predicted makespan of %d commands: %.1f seconds',
+            len(commands),
+            Command.predict_makespan(commands, has_dependency_cb)
+        )
+    if engine is not None:
+        report = engine.run(
+            engine.execute_commands(commands, has_dependency_cb)
+        )
+    else:
+        report = executor.execute_commands(commands, has_dependency_cb)
+    report.log()
+    report.raise_errors()
+    return report
+
+
+def read_state():
+    """Read the system state, using the asyncio engine if enabled and the
+    state is read with aptly."""
+    if engine is not None and state.backend == "aptly":
+        engine.run(engine.read_state(state))
+    else:
+        state.read()
+
+
+def plan(cfg, args):
+    """Writes the ordered commands of a task and the fingerprint of the
+    current state to a plan file, see :mod:`pyaptly.planfile`.
+
+    :param  cfg: The configuration yml as dict
+    :type   cfg: dict
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace"""
+    import argparse
+    from . import planfile
+    func, name_arg, tasks = plan_entries[args.entry]
+    if args.task not in tasks:
+        raise ValueError(
+            "Unknown task for %s: %s" % (args.entry, args.task)
+        )
+    entry_args = argparse.Namespace(
+        task=args.task,
+        debug=args.debug,
+        changed=getattr(args, 'changed', None),
+    )
+    setattr(entry_args, name_arg, args.name)
+    commands = func(cfg, entry_args)
+    request = {
+        'config': os.path.abspath(args.config),
+        'entry':  args.entry,
+        'task':   args.task,
+        'name':   args.name,
+    }
+    if getattr(args, 'digests', None) is not None:
+        request['digests'] = args.digests
+    planfile.write_plan(
+        args.output,
+        commands,
+        state.fingerprint(),
+        request,
+        planfile.fulfilled_requirements(commands, state.has_dependency),
+    )
+    lg.info('Wrote plan with %d commands to %s', len(commands), args.output)
+
+
+def apply(cfg, args):
+    """Executes the commands of a plan file, if the state still matches the
+    fingerprint of the plan. The config isn't read and the commands aren't
+    ordered again. The state isn't read either, the dependencies are resolved
+    with the requirements the plan recorded as fulfilled, only the gpg keys
+    are listed for :func:`add_gpg_keys`.
+
+    :param  cfg: Not used, the plan contains the commands
+    :type   cfg: None
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace"""
+    from . import planfile
+    commands, fingerprint, request, fulfilled = planfile.read_plan(
+        args.plan_file
+    )
+    if fingerprint != state.fingerprint():
+        if not args.force:
+            raise ValueError(
+                "State has changed since %s was planned, plan again" % (
+                    args.plan_file
+                )
+            )
+        lg.warning('State has changed since planning, applying anyway')
+    lg.info('Applying plan %s: %s', args.plan_file, dict(
+        (x, y) for x, y in request.items() if x != 'digests'
+    ))
+    state.read_gpg()
+    execute_commands(commands, lambda x: tuple(x) in fulfilled)
+    if 'digests' in request and not Command.pretend_mode:
+        from . import changes
+        store = changes.DigestStore(
+            os.path.join(state_dir(), 'config-digests.json')
+        )
+        store.save(
+            request['config'],
+            '%s %s' % (request['entry'], request['task']),
+            request['digests'],
+        )
+
 
-    with codecs.open(args.config, 'r', encoding="UTF-8") as cfgfile:
-        cfg = yaml.load(cfgfile)
-    state.read()
+def serve(cfg, args):
+    """Serves the mirror, snapshot, publish and repo tasks on a local control
+    socket until interrupted. See :mod:`pyaptly.control`.
 
-    # run function for selected subparser
-    args.func(cfg, args)
+    :param  cfg: The configuration yml as dict
+    :type   cfg: dict
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace"""
+    from . import control
+    server = control.ControlServer(args.socket, args.config, cfg, args)
+    try:
+        server.serve_forever()
+    finally:
+        server.shutdown_worker()
 
 day_of_week_map = {
     'mon': 1,
@@ -921,21 +2039,24 @@ def publish_cmd_create(cfg,
     :param   publish_name: Name of the publish to create
     :type    publish_name: str
     :param publish_config: Configuration of the publish from the yml file.
-    :type  publish_config: dict"""
-    publish_fullname = '%s %s' % (publish_name, publish_config['distribution'])
+    :type  publish_config: dict
+    :rtype:                list"""
+    aptly_name = publish_aptly_name(publish_name, publish_config)
+    publish_fullname = '%s %s' % (aptly_name, publish_config['distribution'])
     if publish_fullname in state.publishes and not ignore_existing:
         # Nothing to do, publish already created
-        return
+        return []
 
     publish_cmd   = ['aptly', 'publish']
     options       = []
     source_args   = []
     endpoint_args = [
-        publish_name
+        aptly_name
     ]
 
     has_source = False
     num_sources = 0
+    source_publish = None
 
     for conf, conf_value in publish_config.items():
 
@@ -964,7 +2085,7 @@ def publish_cmd_create(cfg,
 
         elif conf == 'gpg-key':
             options.append('-gpg-key=%s' % conf_value)
-        elif conf == 'automatic-update':
+        elif conf in ('automatic-update', 'staged', 'destinations'):
             # Ignored here
             pass
         elif conf == 'snapshots':
@@ -978,11 +2099,14 @@ def publish_cmd_create(cfg,
             has_source = True
             snapshots = unit_or_list_to_list(conf_value)
             source_args.append('snapshot')
-            source_args.extend([
-                snapshot_spec_to_name(cfg, conf_value)
-                for conf_value
-                in snapshots
-            ])
+            try:
+                source_args.extend([
+                    snapshot_spec_to_name(cfg, conf_value)
+                    for conf_value
+                    in snapshots
+                ])
+            except MissingGenerationError as e:
+                return unplanned('publish %s' % publish_fullname, e)
 
             num_sources = len(snapshots)
 
@@ -1009,16 +2133,14 @@ def publish_cmd_create(cfg,
                     )
                 )
             has_source = True
-            conf_value = " ".join(conf_value.split("/"))
+            conf_value = publish_source_name(cfg, conf_value)
             source_args.append('snapshot')
-            try:
-                sources = state.publish_map[conf_value]
-            except KeyError:
-                lg.critical((
-                    "Creating %s has been deferred, please call publish "
-                    "create again"
-                ) % publish_name)
-                return
+            if conf_value not in state.publish_map:
+                # The source publish is created in this run, its snapshots
+                # are resolved when the command is executed
+                source_publish = conf_value
+                continue
+            sources = state.publish_map[conf_value]
             source_args.extend(sources)
             num_sources = len(sources)
         else:  # pragma: no cover
@@ -1029,9 +2151,303 @@ def publish_cmd_create(cfg,
                 )
             )
     assert has_source
+
+    if source_publish is not None:
+        if publish_config.get('skip-contents') == 'deferred':
+            # A new publish has no clients waiting for it
+            options.remove('-skip-contents=true')
+        cmd = FunctionCommand(
+            publish_from_publish,
+            publish_cmd + options + source_args,
+            endpoint_args,
+            source_publish,
+            publish_config,
+        )
+        cmd.require('publish', source_publish)
+        cmd.provide('publish', publish_fullname)
+        if publish_config.get('staged'):
+            return stage_publish(cmd, publish_name, publish_config)
+        return [cmd]
+
     assert len(components) == num_sources
+    cmd = limit_command(
+        Command(publish_cmd + options + source_args + endpoint_args),
+        publish_config
+    )
+    cmd.provide('publish', publish_fullname)
+    if publish_config.get('staged'):
+        return stage_publish(cmd, publish_name, publish_config)
+    if publish_config.get('skip-contents') != 'deferred':
+        return [cmd]
+    snapshots = None
+    if source_args[0] == 'snapshot':
+        snapshots = source_args[1:]
+    return defer_contents(cmd, publish_name, publish_config, snapshots)
+
+
+def publish_from_publish(head, tail, source, publish_config):
+    """Creates a publish of the snapshots of another publish, which is
+    created in the same run. The snapshots are resolved when the command is
+    executed.
+
+    :param           head: The publish command up to the snapshots
+    :type            head: list
+    :param           tail: The publish command after the snapshots
+    :type            tail: list
+    :param         source: The source publish, "<prefix> <distribution>"
+    :type          source: str
+    :param publish_config: Configuration of the publish from the yml file.
+    :type  publish_config: dict"""
+    prefix, distribution = source.split(' ')
+    sources = state.parse_publish_sources(call_output_lines(state.aptly_call([
+        "aptly", "publish", "show", distribution, prefix
+    ])))
+    components = unit_or_list_to_list(publish_config['components'])
+    if len(components) != len(sources):
+        raise ValueError(
+            "Publish %s has %d snapshots for %d components" % (
+                source, len(sources), len(components)
+            )
+        )
+    limit_command(
+        Command(list(head) + sources + list(tail)), publish_config
+    ).run()
+
+
+def publish_aptly_name(publish_name, publish_config):
+    """Return the prefix aptly publishes a publish to, the hidden staging
+    prefix for staged publishes, see :mod:`pyaptly.staging`.
+
+    :param   publish_name: Name of the publish
+    :type    publish_name: str
+    :param publish_config: Configuration of the publish from the yml file.
+    :type  publish_config: dict
+    :rtype:                str"""
+    if not publish_config.get('staged'):
+        return publish_name
+    if publish_config.get('skip-contents') == 'deferred':
+        raise ValueError(
+            "Staged publish %s can't defer the contents" % publish_name
+        )
+    from . import staging
+    return staging.staged_name(publish_name)
+
+
+def publish_source_name(cfg, source):
+    """Return the aptly name of the source of a publish of another publish,
+    resolved through the config of the source, ie. "ubuntu/trusty" of a
+    staged publish is ".staged/ubuntu trusty".
+
+    :param    cfg: pyaptly config
+    :type     cfg: dict
+    :param source: The source, "<name> <distribution>" or
+                   "<name>/<distribution>"
+    :type  source: str
+    :rtype:        str"""
+    source_name, distribution = " ".join(source.split("/")).split(" ")
+    for source_config in (cfg.get('publish') or {}).get(source_name, []):
+        if source_config['distribution'] == distribution:
+            source_name = publish_aptly_name(source_name, source_config)
+            break
+    return '%s %s' % (source_name, distribution)
+
+
+def check_publish_sources(commands):
+    """Raise if a publish of another publish has a source that is neither
+    published nor created by the commands.
+
+    :param commands: The commands
+    :type  commands: list"""
+    provided = set()
+    for cmd in commands:
+        provided.update(cmd.get_provides())
+    for cmd in commands:
+        if (
+                isinstance(cmd, FunctionCommand) and
+                cmd.cmd is publish_from_publish and
+                ('publish', cmd.args[2]) not in provided
+        ):
+            raise ValueError(
+                "Source publish %s is neither published nor created" % (
+                    cmd.args[2]
+                )
+            )
+
+
+def release_staged(publish_name):
+    """Release the staged tree of a publish by flipping its symlink, see
+    :func:`pyaptly.staging.release`.
+
+    :param publish_name: Name of the publish
+    :type  publish_name: str"""
+    from . import staging
+    staging.release(publish_name)
+
+
+def rollback_staged(publish_name):
+    """Flip a staged publish back to its previous release, see
+    :func:`pyaptly.staging.rollback`.
+
+    :param publish_name: Name of the publish
+    :type  publish_name: str"""
+    from . import staging
+    staging.rollback(publish_name)
+
+
+def stage_publish(cmd, publish_name, publish_config):
+    """Return the publish command cmd, which publishes to the staging
+    prefix, and the command releasing the staged tree once cmd is finished.
+
+    :param            cmd: The publish command
+    :type             cmd: Command
+    :param   publish_name: Name of the publish
+    :type    publish_name: str
+    :param publish_config: Configuration of the publish from the yml file.
+    :type  publish_config: dict
+    :rtype:                list"""
+    staged = 'staged %s %s' % (publish_name, publish_config['distribution'])
+    cmd.provide('virtual', staged)
+    release = FunctionCommand(release_staged, publish_name)
+    release.require('virtual', staged)
+    return [cmd, release]
+
+
+def merge_publish_commands(commands):
+    """Merge the release, rollback and replication commands of the
+    distributions of a publish, so the publish is released and replicated
+    once after all its distributions are published.
+
+    :param commands: The commands
+    :type  commands: list
+    :rtype:          list"""
+    merged = {}
+    result = []
+    for cmd in commands:
+        if (
+                isinstance(cmd, FunctionCommand) and
+                cmd.cmd in (release_staged, rollback_staged, replicate_publish)
+        ):
+            key = (cmd.cmd, cmd.args)
+            if key in merged:
+                for require in cmd._requires:
+                    merged[key].require(*require)
+                merged[key].deferred = merged[key].deferred or cmd.deferred
+                continue
+            merged[key] = cmd
+        result.append(cmd)
+    return result
+
+
+def replicate_publish(publish_name, destination):
+    """Replicate the published tree of a publish to a destination, see
+    :func:`pyaptly.replicate.replicate`.
+
+    :param publish_name: Name of the publish
+    :type  publish_name: str
+    :param  destination: The destination directory
+    :type   destination: str"""
+    from . import replicate, staging
+    replicate.replicate(
+        os.path.join(staging.public_dir(), publish_name), destination
+    )
+
+
+def fan_out(commands, publish_name, publish_config):
+    """Add the commands replicating a publish to its "destinations" once the
+    publish commands are finished. If the last command is deferred, the
+    replication is deferred too.
+
+    :param       commands: The commands of the publish
+    :type        commands: list
+    :param   publish_name: Name of the publish
+    :type    publish_name: str
+    :param publish_config: Configuration of the publish from the yml file.
+    :type  publish_config: dict
+    :rtype:                list"""
+    destinations = unit_or_list_to_list(publish_config.get('destinations', []))
+    if not commands or not destinations:
+        return commands
+    last = commands[-1]
+    done = 'publish done %s %s' % (
+        publish_name, publish_config['distribution']
+    )
+    last.provide('virtual', done)
+    replications = []
+    for destination in destinations:
+        cmd = FunctionCommand(replicate_publish, publish_name, destination)
+        cmd.require('virtual', done)
+        cmd.deferred = last.deferred and 'replication'
+        replications.append(cmd)
+    return commands + replications
+
+
+def publish_cmd_rollback(cfg, publish_name, publish_config):
+    """Creates the command flipping a staged publish back to its previous
+    release.
+
+    :param            cfg: pyaptly config
+    :type             cfg: dict
+    :param   publish_name: Name of the publish to roll back
+    :type    publish_name: str
+    :param publish_config: Configuration of the publish from the yml file.
+    :type  publish_config: dict
+    :rtype:                list"""
+    if not publish_config.get('staged'):
+        lg.warning("Publish %s is not staged, can't roll back", publish_name)
+        return []
+    return [FunctionCommand(rollback_staged, publish_name)]
 
-    return Command(publish_cmd + options + source_args + endpoint_args)
+
+def publish_contents_cmd(publish_name, publish_config, snapshots=None):
+    """Creates the deferred command regenerating the contents indexes of a
+    publish that was created or switched with "skip-contents: deferred".
+
+    :param   publish_name: Name of the publish
+    :type    publish_name: str
+    :param publish_config: Configuration of the publish from the yml file.
+    :type  publish_config: dict
+    :param      snapshots: Snapshots of the publish, None for a repo
+                           publish
+    :type       snapshots: list
+    :rtype:                Command"""
+    if snapshots is None:
+        aptly_cmd = ['aptly', 'publish', 'update', '-skip-contents=false']
+    else:
+        aptly_cmd = [
+            'aptly', 'publish', 'switch',
+            '-component=%s' % ','.join(
+                unit_or_list_to_list(publish_config['components'])
+            ),
+            '-skip-contents=false',
+        ]
+    aptly_cmd.extend([publish_config['distribution'], publish_name])
+    aptly_cmd.extend(snapshots or [])
+    cmd = limit_command(Command(aptly_cmd), publish_config)
+    cmd.deferred = 'contents'
+    return cmd
+
+
+def defer_contents(cmd, publish_name, publish_config, snapshots=None):
+    """Return the publish command cmd, which skips the contents indexes, and
+    the deferred command regenerating them once cmd is finished.
+
+    :param            cmd: The publish command
+    :type             cmd: Command
+    :param   publish_name: Name of the publish
+    :type    publish_name: str
+    :param publish_config: Configuration of the publish from the yml file.
+    :type  publish_config: dict
+    :param      snapshots: Snapshots of the publish, None for a repo
+                           publish
+    :type       snapshots: list
+    :rtype:                list"""
+    published = 'published %s %s' % (
+        publish_name, publish_config['distribution']
+    )
+    contents = publish_contents_cmd(publish_name, publish_config, snapshots)
+    cmd.provide('virtual', published)
+    contents.require('virtual', published)
+    return [cmd, contents]
 
 
 def clone_snapshot(origin, destination):
@@ -1066,37 +2482,56 @@ def publish_cmd_update(cfg,
     :param   publish_name: Name of the publish to update
     :type    publish_name: str
     :param publish_config: Configuration of the publish from the yml file.
-    :type  publish_config: dict"""
+    :type  publish_config: dict
+    :rtype:                list"""
 
+    aptly_name  = publish_aptly_name(publish_name, publish_config)
     publish_cmd = ['aptly', 'publish']
     options     = []
-    args        = [publish_config['distribution'], publish_name]
+    args        = [publish_config['distribution'], aptly_name]
 
     if 'skip-contents' in publish_config and publish_config['skip-contents']:
         options.append('-skip-contents=true')
 
     if 'repo' in publish_config:
         publish_cmd.append('update')
-        return Command(publish_cmd + options + args)
+        cmd = limit_command(
+            Command(publish_cmd + options + args), publish_config
+        )
+        if publish_config.get('staged'):
+            return stage_publish(cmd, publish_name, publish_config)
+        if publish_config.get('skip-contents') == 'deferred':
+            return defer_contents(cmd, publish_name, publish_config)
+        return [cmd]
 
-    publish_fullname = '%s %s' % (publish_name, publish_config['distribution'])
+    publish_fullname = '%s %s' % (aptly_name, publish_config['distribution'])
     current_snapshots = state.publish_map[publish_fullname]
     if 'snapshots' in publish_config:
         snapshots_config  = publish_config['snapshots']
-        new_snapshots     = [
-            snapshot_spec_to_name(cfg, snap)
-            for snap
-            in snapshots_config
-        ]
+        try:
+            new_snapshots = [
+                snapshot_spec_to_name(cfg, snap)
+                for snap
+                in snapshots_config
+            ]
+        except MissingGenerationError as e:
+            return unplanned('publish %s' % publish_fullname, e)
     elif 'publish' in publish_config:
-        conf_value       = publish_config['publish']
+        conf_value       = " ".join(publish_config['publish'].split("/"))
         snapshots_config = []
         ref_publish_name, distribution     = conf_value.split(" ")
         for publish in cfg['publish'][ref_publish_name]:
             if publish['distribution'] == distribution:
                 snapshots_config.extend(publish['snapshots'])
                 break
-        new_snapshots = list(state.publish_map[conf_value])
+        source_fullname = publish_source_name(cfg, conf_value)
+        if source_fullname not in state.publish_map:
+            raise ValueError(
+                "Source publish %s of %s is not published" % (
+                    source_fullname, publish_name
+                )
+            )
+        new_snapshots = list(state.publish_map[source_fullname])
     else:  # pragma: no cover
         raise ValueError(
             "No snapshot references configured in publish %s" % publish_name
@@ -1104,8 +2539,9 @@ def publish_cmd_update(cfg,
 
     if set(new_snapshots) == set(current_snapshots) and not ignore_existing:
         # Already pointing to the newest snapshot, nothing to do
-        return
+        return []
     components = unit_or_list_to_list(publish_config['components'])
+    archive_cmds = []
 
     for snap in snapshots_config:
         # snap may be a plain name or a dict..
@@ -1132,7 +2568,9 @@ def publish_cmd_update(cfg,
                     if snap_name.startswith(prefix_to_search)
                 ][0]
 
-                clone_snapshot(current_snapshot, archive).execute()
+                archive_cmds.append(
+                    clone_snapshot(current_snapshot, archive)
+                )
 
     publish_cmd.append('switch')
     options.append('-component=%s' % ','.join(components))
@@ -1140,7 +2578,20 @@ def publish_cmd_update(cfg,
     if 'skip-contents' in publish_config and publish_config['skip-contents']:
         options.append('-skip-contents=true')
 
-    return Command(publish_cmd + options + args + new_snapshots)
+    cmd = limit_command(
+        Command(publish_cmd + options + args + new_snapshots), publish_config
+    )
+    # Archive the current snapshots before switching away from them
+    for archive_cmd in archive_cmds:
+        for provide in archive_cmd.get_provides():
+            cmd.require(*provide)
+    if publish_config.get('staged'):
+        return archive_cmds + stage_publish(cmd, publish_name, publish_config)
+    if publish_config.get('skip-contents') == 'deferred':
+        return archive_cmds + defer_contents(
+            cmd, publish_name, publish_config, new_snapshots
+        )
+    return archive_cmds + [cmd]
 
 
 def repo_cmd_create(cfg, repo_name, repo_config):
@@ -1155,7 +2606,7 @@ def repo_cmd_create(cfg, repo_name, repo_config):
 
     if repo_name in state.repos:  # pragma: no cover
         # Nothing to do, repo already created
-        return
+        return []
 
     repo_cmd      = ['aptly', 'repo']
     options       = []
@@ -1178,6 +2629,9 @@ def repo_cmd_create(cfg, repo_name, repo_config):
             )
         elif conf == 'distribution':
             options.append('-distribution=%s' % conf_value)
+        elif conf == 'incoming':
+            # Used by repo add
+            continue
         else:  # pragma: no cover
             raise ValueError(
                 "Don't know how to handle repo config entry %s in %s" % (
@@ -1186,95 +2640,206 @@ def repo_cmd_create(cfg, repo_name, repo_config):
                 )
             )
 
-    return Command(repo_cmd + options + endpoint_args)
+    return [Command(repo_cmd + options + endpoint_args)]
 
 
-def repo(cfg, args):
-    """Creates repository commands, orders and executes them.
+def repo_cmd_add(cfg, repo_name, repo_config):
+    """Create the command adding the new packages in the incoming directories
+    of a repo, followed by the commands updating the snapshots and publishes
+    of the repo. See :mod:`pyaptly.incoming`.
+
+    :param         cfg: pyaptly config
+    :type          cfg: dict
+    :param   repo_name: Name of the repo to add to
+    :type    repo_name: str
+    :param repo_config: Configuration of the repo from the yml file.
+    :type  repo_config: dict
+    :rtype:             list"""
+    from . import incoming
+    directories = unit_or_list_to_list(repo_config.get('incoming', []))
+    if not directories:
+        return []
+    if repo_name in state.repos:
+        known = incoming.repo_checksums(repo_name)
+    else:
+        known = set()
+    files = incoming.new_files(directories, known)
+    if not files:
+        lg.info('No new packages for repo %s', repo_name)
+        return []
+    lg.info('Adding %d packages to repo %s', len(files), repo_name)
+    added = 'repo added %s' % repo_name
+    commands = []
+    for batch in incoming.batches(files):
+        cmd = Command(['aptly', 'repo', 'add', repo_name] + batch)
+        cmd.require('repo', repo_name)
+        cmd.provide('virtual', added)
+        commands.append(cmd)
+    followers = repo_followers(cfg, repo_name)
+    for follower in followers:
+        follower.require('virtual', added)
+    return commands + followers
+
+
+def repo_followers(cfg, repo_name):
+    """Create the commands updating the snapshots of a repo and the
+    automatically updated publishes of a repo or of these snapshots, after
+    packages were added to it. Timestamped snapshots are only created if they
+    don't exist yet.
+
+    :param       cfg: pyaptly config
+    :type        cfg: dict
+    :param repo_name: Name of the changed repo
+    :type  repo_name: str
+    :rtype:           list"""
+    from . import changes
+    commands = []
+    created = set()
+    create_cmds = []
+    for snapshot_name, snapshot_config in cfg.get('snapshot', {}).items():
+        if snapshot_config.get('repo') != repo_name:
+            continue
+        if '%T' in snapshot_name or snapshot_name not in state.snapshots:
+            created.add(snapshot_name)
+            create_cmds.extend(
+                cmd_snapshot_create(cfg, snapshot_name, snapshot_config)
+            )
+        else:
+            # The update switches the publishes of the snapshot itself
+            commands.extend(
+                cmd_snapshot_update(cfg, snapshot_name, snapshot_config)
+            )
+    commands.extend(create_cmds)
+    for publish_name, publish_conf in cfg.get('publish', {}).items():
+        for publish_conf_entry in publish_conf:
+            if publish_conf_entry.get('automatic-update', 'false') is not True:
+                continue
+            sources = changes.publish_sources(publish_conf_entry)
+            if ('repo', repo_name) not in sources and not [
+                    name for type_, name in sources
+                    if type_ == 'snapshot' and name in created
+            ]:
+                continue
+            fullname = '%s %s' % (
+                publish_aptly_name(publish_name, publish_conf_entry),
+                publish_conf_entry['distribution'],
+            )
+            if fullname not in state.publishes:
+                continue
+            updates = publish_cmd_update(cfg, publish_name, publish_conf_entry)
+            for cmd in updates:
+                # Switch to the new snapshots once they are created
+                for create_cmd in create_cmds:
+                    for provide in create_cmd.get_provides():
+                        cmd.require(*provide)
+            commands.extend(fan_out(
+                updates, publish_name, publish_conf_entry
+            ))
+    return commands
+
+
+def plan_repo(cfg, args):
+    """Creates repository commands and orders them.
 
     :param  cfg: The configuration yml as dict
     :type   cfg: dict
     :param args: The command-line arguments read with :py:mod:`argparse`
-    :type  args: namespace"""
+    :type  args: namespace
+    :rtype:      list"""
     lg.debug("Repositories to create: %s", cfg['repo'])
 
     repo_cmds = {
         'create': repo_cmd_create,
+        'add':    repo_cmd_add,
     }
 
     cmd_repo = repo_cmds[args.task]
+    directories = getattr(args, 'directories', None)
 
     if args.repo_name == "all":
+        if directories:
+            raise ValueError(
+                "Incoming directories can only be given for a single repo"
+            )
         commands = [
-            cmd_repo(cfg, repo_name, repo_conf)
-            for repo_name, repo_conf in cfg['repo'].items()
+            cmd
+            for repo_name, repo_conf in selected_entities(cfg, args, 'repo')
+            for cmd in cmd_repo(cfg, repo_name, repo_conf)
         ]
-
-        for cmd in Command.order_commands(commands, state.has_dependency):
-            cmd.execute()
-
     else:
         if args.repo_name in cfg['repo']:
-            commands = [
-                cmd_repo(
-                    cfg,
-                    args.repo_name,
-                    cfg['repo'][args.repo_name]
-                )
-            ]
-            for cmd in Command.order_commands(commands, state.has_dependency):
-                cmd.execute()
+            repo_conf = cfg['repo'][args.repo_name]
+            if directories:
+                repo_conf = dict(repo_conf, incoming=directories)
+            commands = cmd_repo(cfg, args.repo_name, repo_conf)
         else:
             raise ValueError(
-                "Requested publish is not defined in config file: %s" % (
+                "Requested repo is not defined in config file: %s" % (
                     args.repo_name
                 )
             )
 
+    return limit_commands(cfg, Command.order_commands(
+        merge_publish_commands(commands), state.has_dependency
+    ))
 
-def publish(cfg, args):
-    """Creates publish commands, orders and executes them.
+
+def repo(cfg, args):
+    """Creates repository commands, orders and executes them.
 
     :param  cfg: The configuration yml as dict
     :type   cfg: dict
     :param args: The command-line arguments read with :py:mod:`argparse`
     :type  args: namespace"""
+    execute_commands(plan_repo(cfg, args))
+
+
+def plan_publish(cfg, args):
+    """Creates publish commands and orders them.
+
+    :param  cfg: The configuration yml as dict
+    :type   cfg: dict
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace
+    :rtype:      list"""
     lg.debug("Publishes to create / update: %s", cfg['publish'])
 
     # aptly publish snapshot -components ... -architectures ... -distribution
     # ... -origin Ubuntu trusty-stable ubuntu/stable
 
     publish_cmds = {
-        'create': publish_cmd_create,
-        'update': publish_cmd_update,
+        'create':   publish_cmd_create,
+        'update':   publish_cmd_update,
+        'rollback': publish_cmd_rollback,
     }
 
     cmd_publish = publish_cmds[args.task]
 
     if args.publish_name == "all":
         commands = [
-            cmd_publish(cfg, publish_name, publish_conf_entry)
-            for publish_name, publish_conf in cfg['publish'].items()
+            cmd
+            for publish_name, publish_conf
+            in selected_entities(cfg, args, 'publish')
             for publish_conf_entry in publish_conf
             if publish_conf_entry.get('automatic-update', 'false') is True
+            for cmd in fan_out(
+                cmd_publish(cfg, publish_name, publish_conf_entry),
+                publish_name,
+                publish_conf_entry,
+            )
         ]
-
-        for cmd in Command.order_commands(commands, state.has_dependency):
-            cmd.execute()
-
     else:
         if args.publish_name in cfg['publish']:
             commands = [
-                cmd_publish(
-                    cfg,
-                    args.publish_name,
-                    publish_conf_entry
-                )
+                cmd
                 for publish_conf_entry
                 in cfg['publish'][args.publish_name]
+                for cmd in fan_out(
+                    cmd_publish(cfg, args.publish_name, publish_conf_entry),
+                    args.publish_name,
+                    publish_conf_entry,
+                )
             ]
-            for cmd in Command.order_commands(commands, state.has_dependency):
-                cmd.execute()
         else:
             raise ValueError(
                 "Requested publish is not defined in config file: %s" % (
@@ -1282,14 +2847,30 @@ def publish(cfg, args):
                 )
             )
 
+    check_publish_sources(commands)
+    return limit_commands(cfg, Command.order_commands(
+        merge_publish_commands(commands), state.has_dependency
+    ))
 
-def snapshot(cfg, args):
-    """Creates snapshot commands, orders and executes them.
+
+def publish(cfg, args):
+    """Creates publish commands, orders and executes them.
 
     :param  cfg: The configuration yml as dict
     :type   cfg: dict
     :param args: The command-line arguments read with :py:mod:`argparse`
     :type  args: namespace"""
+    execute_commands(plan_publish(cfg, args))
+
+
+def plan_snapshot(cfg, args):
+    """Creates snapshot commands and orders them.
+
+    :param  cfg: The configuration yml as dict
+    :type   cfg: dict
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace
+    :rtype:      list"""
     lg.debug("Snapshots to create: %s", cfg['snapshot'].keys())
 
     snapshot_cmds = {
@@ -1302,7 +2883,8 @@ def snapshot(cfg, args):
     if args.snapshot_name == "all":
         commands = [
             cmd
-            for snapshot_name, snapshot_config in cfg['snapshot'].items()
+            for snapshot_name, snapshot_config
+            in selected_entities(cfg, args, 'snapshot')
             for cmd in cmd_snapshot(cfg, snapshot_name, snapshot_config)
         ]
 
@@ -1312,11 +2894,6 @@ def snapshot(cfg, args):
                 fh_dot.write(Command.command_list_to_digraph(commands))
             lg.info('Wrote command dependency tree graph to %s', dot_file)
 
-        if len(commands) > 0:
-            for cmd in Command.order_commands(commands,
-                                              state.has_dependency):
-                cmd.execute()
-
     else:
         if args.snapshot_name in cfg['snapshot']:
             commands = cmd_snapshot(
@@ -1324,12 +2901,6 @@ def snapshot(cfg, args):
                 args.snapshot_name,
                 cfg['snapshot'][args.snapshot_name]
             )
-
-            if len(commands) > 0:
-                for cmd in Command.order_commands(commands,
-                                                  state.has_dependency):
-                    cmd.execute()
-
         else:
             raise ValueError(
                 "Requested snapshot is not defined in config file: %s" % (
@@ -1337,6 +2908,22 @@ def snapshot(cfg, args):
                 )
             )
 
+    if len(commands) > 0:
+        return limit_commands(cfg, Command.order_commands(
+            merge_publish_commands(commands), state.has_dependency
+        ))
+    return []
+
+
+def snapshot(cfg, args):
+    """Creates snapshot commands, orders and executes them.
+
+    :param  cfg: The configuration yml as dict
+    :type   cfg: dict
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace"""
+    execute_commands(plan_snapshot(cfg, args))
+
 
 def format_timestamp(timestamp):
     """Wrapper for strftime, to ensure we're all using the same format.
@@ -1349,9 +2936,40 @@ def format_timestamp(timestamp):
 back_reference_map = {
     "current":  0,
     "previous": 1,
+    "latest":   None,
 }
 
 
+class MissingGenerationError(ValueError):
+    """A snapshot spec refers back to more generations than exist, raised by
+    :func:`snapshot_spec_to_name`."""
+
+
+def fail_unplanned(entity, message):
+    """Fails in place of the commands of an entity that couldn't be planned,
+    see :func:`unplanned`.
+
+    :param  entity: Description of the entity
+    :type   entity: str
+    :param message: Why it couldn't be planned
+    :type  message: str"""
+    raise ValueError("Can't plan %s: %s" % (entity, message))
+
+
+def unplanned(entity, error):
+    """Logs that the commands of an entity couldn't be planned and returns a
+    command failing in their place. The other entities are still planned and
+    executed and the run fails at the end.
+
+    :param entity: Description of the entity
+    :type  entity: str
+    :param  error: Why it couldn't be planned
+    :type   error: Exception
+    :rtype:        list"""
+    lg.error("Can't plan %s: %s", entity, error)
+    return [FunctionCommand(fail_unplanned, entity, str(error))]
+
+
 def snapshot_spec_to_name(cfg, snapshot):
     """Converts a given snapshot short spec to a name.
 
@@ -1368,29 +2986,52 @@ def snapshot_spec_to_name(cfg, snapshot):
     For further information regarding the timestamp's data structure,
     consult the documentation of expand_timestamped_name().
 
+    The timestamp of the spec is a back-reference: "current" (0) is the
+    timestamp of the current period, even if the snapshot doesn't exist yet.
+    "previous" (1) or any other number N is the N-th existing snapshot before
+    the current period, found in :meth:`SystemStateReader.timestamp_index`. If
+    there are fewer existing snapshots a :class:`MissingGenerationError` is
+    raised. "latest" is the newest existing snapshot, or the current period if
+    none exists.
+
     :param      cfg: Complete yaml config
     :type       cfg: dict
     :param snapshot: Config of the snapshot
     :type  snapshot: dict
     """
-    delta = datetime.timedelta(seconds=1)
     if hasattr(snapshot, 'items'):
         name      = snapshot['name']
         if 'timestamp' not in snapshot:
             return name
 
         ts        = snapshot['timestamp']
-        back_ref  = back_reference_map.get(ts)
-        if back_ref is None:
+        if ts in back_reference_map:
+            back_ref = back_reference_map[ts]
+        else:
             back_ref = int(ts)
         reference = cfg['snapshot'][name]
+        index     = state.timestamp_index()
 
-        timestamp = datetime.datetime.now()
-        for _ in range(back_ref + 1):
-            timestamp = round_timestamp(reference["timestamp"], timestamp)
-            timestamp -= delta
+        if back_ref is None:
+            existing = index.latest(name)
+            if existing is not None:
+                return name.replace('%T', existing)
+            back_ref = 0
 
-        timestamp += delta
+        timestamp = round_timestamp(
+            reference["timestamp"], datetime.datetime.now()
+        )
+        if back_ref > 0:
+            existing = index.before(
+                name, format_timestamp(timestamp), back_ref
+            )
+            if existing is None:
+                raise MissingGenerationError(
+                    "Snapshot %s has less than %s generations before %s" % (
+                        name, back_ref, format_timestamp(timestamp)
+                    )
+                )
+            return name.replace('%T', existing)
         return name.replace('%T', format_timestamp(timestamp))
     else:  # pragma: no cover
         return snapshot
@@ -1538,12 +3179,16 @@ def cmd_snapshot_update(cfg, snapshot_name, snapshot_config):
 
     def is_publish_affected(name, publish):
         if "%s %s" % (
-                name,
+                publish_aptly_name(name, publish),
                 publish['distribution']
         ) in state.publishes:
             try:
                 for snap in publish['snapshots']:
-                    snap_name = snapshot_spec_to_name(cfg, snap)
+                    try:
+                        snap_name = snapshot_spec_to_name(cfg, snap)
+                    except MissingGenerationError:
+                        # publish_cmd_update fails if it is affected
+                        continue
                     if snap_name in affected_snapshots:
                         return True
             except KeyError:  # pragma: no cover
@@ -1556,28 +3201,42 @@ def cmd_snapshot_update(cfg, snapshot_name, snapshot_config):
 
     if 'publish' in cfg:
         all_publish_commands = [
-            publish_cmd_update(cfg,
-                               publish_name,
-                               publish_conf_entry,
-                               ignore_existing=True)
+            cmd
             for publish_name, publish_conf in cfg['publish'].items()
             for publish_conf_entry in publish_conf
             if publish_conf_entry.get('automatic-update', 'false') is True
             if is_publish_affected(publish_name, publish_conf_entry)
+            for cmd in fan_out(
+                publish_cmd_update(cfg,
+                                   publish_name,
+                                   publish_conf_entry,
+                                   ignore_existing=True),
+                publish_name,
+                publish_conf_entry,
+            )
         ]
     else:
         all_publish_commands = []
 
-    republish_cmds = [
-        c
-        for c
-        in all_publish_commands
-        if c
-    ]
-
-    # Ensure that the republish commands run AFTER the snapshots are rebuilt
-    for cmd in republish_cmds:
-        cmd.require('virtual', 'all-snapshots-rebuilt')
+    republish_cmds = []
+    for cmd in all_publish_commands:
+        archived = [
+            provide
+            for provide
+            in cmd.get_provides()
+            if provide[0] == 'snapshot'
+        ]
+        if archived:
+            # Archive snapshots clone the published snapshots, so they have
+            # to be taken BEFORE the snapshots are rotated
+            for rename_cmd in rename_cmds:
+                for provide in archived:
+                    rename_cmd.require(*provide)
+        else:
+            # Ensure that the republish commands run AFTER the snapshots are
+            # rebuilt
+            cmd.require('virtual', 'all-snapshots-rebuilt')
+        republish_cmds.append(cmd)
 
     # TODO:
     # - We need to cleanup all the rotated snapshots after the publishes are
@@ -1641,19 +3300,22 @@ def cmd_snapshot_create(cfg,
         return [cmd]
 
     elif 'filter' in snapshot_config:
+        try:
+            source_name = snapshot_spec_to_name(
+                cfg, snapshot_config['filter']['source']
+            )
+        except MissingGenerationError as e:
+            return unplanned('snapshot %s' % snapshot_name, e)
         cmd = Command([
             'aptly',
             'snapshot',
             'filter',
-            snapshot_spec_to_name(cfg, snapshot_config['filter']['source']),
+            source_name,
             snapshot_name,
             snapshot_config['filter']['query'],
         ])
         cmd.provide('snapshot', snapshot_name)
-        cmd.require(
-            'snapshot',
-            snapshot_spec_to_name(cfg, snapshot_config['filter']['source'])
-        )
+        cmd.require('snapshot', source_name)
         return [cmd]
 
     elif 'merge' in snapshot_config:
@@ -1666,7 +3328,10 @@ def cmd_snapshot_create(cfg,
         cmd.provide('snapshot', snapshot_name)
 
         for source in snapshot_config['merge']:
-            source_name = snapshot_spec_to_name(cfg, source)
+            try:
+                source_name = snapshot_spec_to_name(cfg, source)
+            except MissingGenerationError as e:
+                return unplanned('snapshot %s' % snapshot_name, e)
             cmd.append(source_name)
             cmd.require('snapshot', source_name)
 
@@ -1680,13 +3345,14 @@ def cmd_snapshot_create(cfg,
         )
 
 
-def mirror(cfg, args):
-    """Creates mirror commands, orders and executes them.
+def plan_mirror(cfg, args):
+    """Creates mirror commands and orders them.
 
     :param  cfg: The configuration yml as dict
     :type   cfg: dict
     :param args: The command-line arguments read with :py:mod:`argparse`
-    :type  args: namespace"""
+    :type  args: namespace
+    :rtype:      list"""
     lg.debug("Mirrors to create: %s", cfg['mirror'])
 
     mirror_cmds = {
@@ -1697,11 +3363,15 @@ def mirror(cfg, args):
     cmd_mirror = mirror_cmds[args.task]
 
     if args.mirror_name == "all":
-        for mirror_name, mirror_config in cfg['mirror'].items():
-            cmd_mirror(cfg, mirror_name, mirror_config)
+        commands = [
+            cmd
+            for mirror_name, mirror_config
+            in selected_entities(cfg, args, 'mirror')
+            for cmd in cmd_mirror(cfg, mirror_name, mirror_config)
+        ]
     else:
         if args.mirror_name in cfg['mirror']:
-            cmd_mirror(
+            commands = cmd_mirror(
                 cfg,
                 args.mirror_name,
                 cfg['mirror'][args.mirror_name]
@@ -1713,6 +3383,20 @@ def mirror(cfg, args):
                 )
             )
 
+    return limit_commands(
+        cfg, Command.order_commands(commands, state.has_dependency)
+    )
+
+
+def mirror(cfg, args):
+    """Creates mirror commands, orders and executes them.
+
+    :param  cfg: The configuration yml as dict
+    :type   cfg: dict
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace"""
+    execute_commands(plan_mirror(cfg, args))
+
 
 def add_gpg_keys(mirror_config):
     """Uses the gpg command-line to download and add gpg keys needed to create
@@ -1721,6 +3405,7 @@ def add_gpg_keys(mirror_config):
     :param  mirror_config: The configuration yml as dict
     :type   mirror_config: dict
     """
+    import subprocess
     keys_urls = {}
     if 'gpg-keys' in mirror_config:
         keys = unit_or_list_to_list(mirror_config['gpg-keys'])
@@ -1767,20 +3452,34 @@ def add_gpg_keys(mirror_config):
     state.read_gpg()
 
 
+def gpg_keys_cmd(mirror_name, mirror_config):
+    """Create a command adding the gpg keys of a mirror, the aptly commands of
+    the mirror require it.
+
+    :param   mirror_name: Name of the mirror the keys are needed for
+    :type    mirror_name: str
+    :param mirror_config: Configuration of the mirror from the yml file.
+    :type  mirror_config: dict
+    :rtype:               FunctionCommand"""
+    cmd = FunctionCommand(add_gpg_keys, mirror_config)
+    cmd.provide('virtual', 'gpg-keys-for-%s' % mirror_name)
+    return cmd
+
+
 def cmd_mirror_create(cfg, mirror_name, mirror_config):
-    """Create a mirror create command to be ordered and executed later.
+    """Create mirror create commands to be ordered and executed later.
 
     :param           cfg: The configuration yml as dict
     :type            cfg: dict
     :param   mirror_name: Name of the mirror to create
     :type    mirror_name: str
     :param mirror_config: Configuration of the snapshot from the yml file.
-    :type  mirror_config: dict"""
+    :type  mirror_config: dict
+    :rtype:               list"""
 
-    if mirror_name in state.mirrors:  # pragma: no cover
-        return
+    if mirror_name in state.mirrors:
+        return cmd_mirror_edit(mirror_name, mirror_config)
 
-    add_gpg_keys(mirror_config)
     aptly_cmd = ['aptly', 'mirror', 'create']
 
     if 'sources' in mirror_config and mirror_config['sources']:
@@ -1796,34 +3495,152 @@ def cmd_mirror_create(cfg, mirror_name, mirror_config):
             ','.join(unit_or_list_to_list(mirror_config['architectures']))
         ))
 
+    aptly_cmd.extend(mirror_filter_options(mirror_config))
+    aptly_cmd.extend(mirror_dependency_options(mirror_config))
+
     aptly_cmd.append(mirror_name)
     aptly_cmd.append(mirror_config['archive'])
     aptly_cmd.append(mirror_config['distribution'])
     aptly_cmd.extend(unit_or_list_to_list(mirror_config['components']))
 
-    lg.debug('Running command: %s', ' '.join(aptly_cmd))
-    subprocess.check_call(aptly_cmd)
+    cmd = limit_command(Command(aptly_cmd), mirror_config)
+    cmd.provide('mirror', mirror_name)
+    cmd.require('virtual', 'gpg-keys-for-%s' % mirror_name)
+    return [gpg_keys_cmd(mirror_name, mirror_config), cmd]
 
 
 def cmd_mirror_update(cfg, mirror_name, mirror_config):
-    """Create a mirror update command to be ordered and executed later.
+    """Create mirror update commands to be ordered and executed later.
 
     :param           cfg: pyaptly config
     :type            cfg: dict
     :param   mirror_name: Name of the mirror to create
     :type    mirror_name: str
     :param mirror_config: Configuration of the snapshot from the yml file.
-    :type  mirror_config: dict"""
+    :type  mirror_config: dict
+    :rtype:               list"""
     if mirror_name not in state.mirrors:  # pragma: no cover
         raise Exception("Mirror not created yet")
-    add_gpg_keys(mirror_config)
     aptly_cmd = ['aptly', 'mirror', 'update']
     if 'max-tries' in mirror_config:
         aptly_cmd.append('-max-tries=%d' % mirror_config['max-tries'])
+    aptly_cmd.extend(mirror_dependency_options(mirror_config))
 
     aptly_cmd.append(mirror_name)
-    lg.debug('Running command: %s', ' '.join(aptly_cmd))
-    subprocess.check_call(aptly_cmd)
+
+    cmd = limit_command(Command(aptly_cmd), mirror_config)
+    cmd.provide('mirror', mirror_name)
+    cmd.require('virtual', 'gpg-keys-for-%s' % mirror_name)
+    edit_cmds = cmd_mirror_edit(mirror_name, mirror_config)
+    for edit_cmd in edit_cmds:
+        for provide in edit_cmd.get_provides():
+            cmd.require(*provide)
+    return edit_cmds + [gpg_keys_cmd(mirror_name, mirror_config), cmd]
+
+
+# The dependency-follow-* keys of mirrors
+dependency_follows = ('all-variants', 'recommends', 'source', 'suggests')
+
+
+def mirror_filter_options(mirror_config):
+    """Return the aptly options of the package filter of a mirror.
+
+    :param mirror_config: Configuration of the mirror from the yml file.
+    :type  mirror_config: dict
+    :rtype:               list"""
+    package_filter, with_deps = mirror_filter(mirror_config)
+    if not package_filter:
+        return []
+    return [
+        '-filter=%s' % package_filter,
+        '-filter-with-deps=%s' % ('true' if with_deps else 'false'),
+    ]
+
+
+def mirror_filter(mirror_config):
+    """Return the package filter of a mirror and if it includes the
+    dependencies of the matching packages.
+
+    :param mirror_config: Configuration of the mirror from the yml file.
+    :type  mirror_config: dict
+    :rtype:               tuple"""
+    package_filter = mirror_config.get('filter') or ''
+    with_deps = bool(package_filter and mirror_config.get('filter-with-deps'))
+    return (package_filter, with_deps)
+
+
+def mirror_dependency_options(mirror_config):
+    """Return the aptly options following dependencies of the filter of a
+    mirror. aptly doesn't store them in the mirror, they apply to the
+    update.
+
+    :param mirror_config: Configuration of the mirror from the yml file.
+    :type  mirror_config: dict
+    :rtype:               list"""
+    return [
+        '-dep-follow-%s' % follow
+        for follow in dependency_follows
+        if mirror_config.get('dependency-follow-%s' % follow)
+    ]
+
+
+def parse_mirror_filter(lines):
+    """Parse the package filter of a mirror from aptly mirror show.
+
+    :param lines: Output of aptly mirror show
+    :type  lines: iterable
+    :rtype:       tuple"""
+    package_filter = ''
+    with_deps = False
+    for line in lines:
+        key, _, value = line.partition(':')
+        if key == 'Filter':
+            package_filter = value.strip()
+        elif key == 'Filter With Deps':
+            with_deps = value.strip() == 'yes'
+    return (package_filter, with_deps)
+
+
+def cmd_mirror_edit(mirror_name, mirror_config):
+    """Create the command applying a changed package filter to an existing
+    mirror, it takes effect on the next update.
+
+    :param   mirror_name: Name of the mirror to edit
+    :type    mirror_name: str
+    :param mirror_config: Configuration of the mirror from the yml file.
+    :type  mirror_config: dict
+    :rtype:               list"""
+    wanted = mirror_filter(mirror_config)
+    current = parse_mirror_filter(
+        call_output_lines(
+            state.aptly_call(['aptly', 'mirror', 'show', mirror_name])
+        )
+    )
+    if wanted == current:
+        return []
+    lg.info(
+        'Filter of mirror %s changed from %s to %s',
+        mirror_name, current, wanted
+    )
+    cmd = Command([
+        'aptly', 'mirror', 'edit',
+        '-filter=%s' % wanted[0],
+        '-filter-with-deps=%s' % ('true' if wanted[1] else 'false'),
+        mirror_name,
+    ])
+    cmd.provide('virtual', 'mirror edited %s' % mirror_name)
+    return [cmd]
+
+
+# The tasks that can be planned: entry -> (plan function, name argument, tasks)
+plan_entries = {
+    'mirror':   (plan_mirror,   'mirror_name',   ('create', 'update')),
+    'snapshot': (plan_snapshot, 'snapshot_name', ('create', 'update')),
+    'publish':  (plan_publish,  'publish_name',
+                 ('create', 'update', 'rollback')),
+    'repo':     (plan_repo,     'repo_name',     ('create', 'add')),
+}
+
 
 if __name__ == '__main__':  # pragma: no cover
     main()
@@ -0,0 +1,428 @@
+"""Asyncio engine multiplexing aptly and gpg processes in one event loop.
+
+Used instead of the sequential execution when pyaptly is started with
+``--jobs N``. At most N processes run at once, independent commands run
+concurrently as soon as the commands they depend on are finished. A process
+that times out, stalls or whose task is cancelled is terminated, and killed
+if it doesn't exit within :data:`kill_grace` seconds.
+
+aptly's database can only be opened by one process at a time, a second
+aptly process fails on its lock. The aptly processes and the functions that
+may call aptly run one at a time, gpg and the other processes and functions
+run concurrently.
+
+Requires Python 3.5 or newer.
+"""
+import asyncio
+import collections
+import subprocess
+import time
+
+from . import Command, FunctionCommand, executor, is_aptly_call, lg
+
+# Seconds a terminated process gets to exit before it is killed
+kill_grace = 10.0
+
+
+async def stop_process(process, grace=None):
+    """Terminate a process, kill it if it doesn't exit in time.
+
+    :param process: The process
+    :type  process: :py:class:`asyncio.subprocess.Process`
+    :param   grace: Seconds to wait before killing the process
+    :type    grace: float"""
+    if process.returncode is not None:
+        return
+    if grace is None:
+        grace = kill_grace
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), grace)
+    except ProcessLookupError:  # pragma: no cover
+        pass
+    except asyncio.TimeoutError:
+        lg.warning('Killing process %s, it ignored SIGTERM', process.pid)
+        process.kill()
+        await process.wait()
+
+
+async def run_process(
+        args, timeout=None, capture=True, input_=None, preexec_fn=None
+):
+    """Run a process and return its exit status and output. The process is
+    stopped if it times out or the task is cancelled.
+
+    :param       args: Command to execute
+    :type        args: list
+    :param    timeout: Seconds the process may run, None waits forever
+    :type     timeout: float
+    :param    capture: Capture stdout and stderr, else they are inherited
+    :type     capture: bool
+    :param     input_: Input to command
+    :type      input_: bytes
+    :param preexec_fn: Prepares the process before it executes
+    :type  preexec_fn: function
+    :rtype:            (int, bytes, bytes)"""
+    pipe = asyncio.subprocess.PIPE if capture else None
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.PIPE if input_ else subprocess.DEVNULL,
+        stdout=pipe,
+        stderr=pipe,
+        preexec_fn=preexec_fn
+    )
+    try:
+        output, err = await asyncio.wait_for(
+            process.communicate(input_), timeout
+        )
+    except BaseException:
+        await stop_process(process)
+        raise
+    return process.returncode, output, err
+
+
+async def run_monitored(
+        args, timeout=None, stall_timeout=None, preexec_fn=None,
+        observer=None
+):
+    """Run a process, passing its output through, and stop it if it exceeds
+    timeout or doesn't produce output for stall_timeout seconds, like
+    :func:`pyaptly.executor.run_monitored`.
+
+    :param          args: Command to execute
+    :type           args: list
+    :param       timeout: Seconds the process may run, None for no limit
+    :type        timeout: float
+    :param stall_timeout: Seconds the process may be silent, None for no
+                          limit
+    :type  stall_timeout: float
+    :param    preexec_fn: Prepares the process before it executes, see
+                          :meth:`pyaptly.Command.preexec`
+    :type     preexec_fn: function
+    :param      observer: Called with every chunk of output
+    :type       observer: function
+    :rtype:               int"""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        preexec_fn=preexec_fn
+    )
+    out = executor.output_stream()
+    start = time.time()
+    tail = b""
+    try:
+        while True:
+            wait = stall_timeout
+            if timeout is not None:
+                remaining = max(timeout - (time.time() - start), 0)
+                if wait is None or remaining < wait:
+                    wait = remaining
+            try:
+                data = await asyncio.wait_for(
+                    process.stdout.read(65536), wait
+                )
+            except asyncio.TimeoutError:
+                await stop_process(process)
+                if (
+                        timeout is not None and
+                        time.time() - start >= timeout
+                ):
+                    error = executor.CommandTimeout(
+                        process.returncode, args, "timed out", timeout
+                    )
+                else:
+                    error = executor.CommandTimeout(
+                        process.returncode, args, "stalled", stall_timeout
+                    )
+                raise executor.with_output(error, tail)
+            if not data:
+                break
+            out.write(data)
+            out.flush()
+            tail = (tail + data)[-executor.output_tail:]
+            if observer is not None:
+                observer(data)
+        returncode = await process.wait()
+    except BaseException:
+        await stop_process(process)
+        raise
+    if returncode != 0:
+        raise executor.with_output(
+            subprocess.CalledProcessError(returncode, args), tail
+        )
+    return returncode
+
+
+class Unlocked(object):
+    """Stands in for the database lock of calls not opening the database."""
+
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class Engine(object):
+    """Runs processes and commands in an event loop.
+
+    :param     jobs: Maximum number of concurrent processes and functions
+    :type      jobs: int
+    :param  timeout: Default timeout of every process in seconds
+    :type   timeout: float"""
+
+    def __init__(self, jobs=4, timeout=None):
+        assert jobs > 0
+        self.jobs       = jobs
+        self.timeout    = timeout
+        self.loop       = asyncio.new_event_loop()
+        self._semaphore = None
+        self._database  = None
+
+    def run(self, coroutine):
+        """Run a coroutine in the event loop of the engine until it is done.
+
+        :param coroutine: The coroutine
+        :rtype:           the result of the coroutine"""
+        return self.loop.run_until_complete(coroutine)
+
+    def close(self):
+        """Close the event loop."""
+        self.loop.close()
+
+    @property
+    def semaphore(self):
+        """Semaphore limiting the number of concurrent jobs, created in the
+        running loop.
+
+        :rtype: :py:class:`asyncio.Semaphore`"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.jobs)
+        return self._semaphore
+
+    def database_lock(self, opens_database):
+        """Return the lock the calls opening the aptly database hold, created
+        in the running loop.
+
+        :param opens_database: The call opens the database
+        :type  opens_database: bool
+        :rtype:                :py:class:`asyncio.Lock`"""
+        if not opens_database:
+            return Unlocked()
+        if self._database is None:
+            self._database = asyncio.Lock()
+        return self._database
+
+    async def call_output(self, args, input_=None, timeout=None):
+        """Call command and return output, like :func:`pyaptly.call_output`.
+
+        :param    args: Command to execute
+        :type     args: list
+        :param  input_: Input to command
+        :type   input_: bytes
+        :param timeout: Seconds the process may run, defaults to the timeout
+                        of the engine
+        :type  timeout: float
+        :rtype:         (str, str)"""
+        async with self.database_lock(is_aptly_call(args)):
+            async with self.semaphore:
+                returncode, output, err = await run_process(
+                    args, timeout or self.timeout, input_=input_
+                )
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+        return (output.decode("UTF-8"), err.decode("UTF-8"))
+
+    async def run_command(self, cmd):
+        """Run a command, the equivalent of :meth:`pyaptly.Command.run`.
+        Functions are called in the default executor of the loop.
+
+        :param cmd: The command
+        :type  cmd: :class:`pyaptly.Command`"""
+        if isinstance(cmd, FunctionCommand):
+            return await self.loop.run_in_executor(None, cmd.run)
+        if Command.bandwidth is not None:
+            with Command.bandwidth.allot(cmd) as args:
+                return await self.run_args(cmd, args)
+        return await self.run_args(cmd, cmd.cmd)
+
+    async def run_args(self, cmd, args):
+        """Run a system command with the given arguments, the equivalent of
+        :meth:`pyaptly.Command.run_args`.
+
+        :param  cmd: The command
+        :type   cmd: :class:`pyaptly.Command`
+        :param args: The command, with options added at run time
+        :type  args: list"""
+        lg.debug('Running command: %s', ' '.join([str(x) for x in args]))
+        timeout = cmd.timeout or self.timeout
+        if timeout is not None or cmd.monitored():
+            return await run_monitored(
+                args, timeout, cmd.stall_timeout, cmd.preexec(),
+                cmd.output_observer()
+            )
+        returncode, _, _ = await run_process(
+            args, capture=False, preexec_fn=cmd.preexec()
+        )
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+        return returncode
+
+    async def execute(self, cmd):
+        """Execute a command, the equivalent of
+        :meth:`pyaptly.Command.execute`.
+
+        :param cmd: The command
+        :type  cmd: :class:`pyaptly.Command`"""
+        if cmd._finished is not None:  # pragma: no cover
+            return cmd._finished
+        if Command.pretend_mode:
+            cmd.pretend()
+            return None
+        async with self.database_lock(cmd.opens_database()):
+            return await self.execute_slot(cmd)
+
+    async def execute_slot(self, cmd):
+        """Execute a command in a job slot of the engine.
+
+        :param cmd: The command
+        :type  cmd: :class:`pyaptly.Command`"""
+        async with self.semaphore:
+            start = cmd.begin()
+            try:
+                result = await self.run_command(cmd)
+            except BaseException as e:
+                cmd.fail(e)
+                raise
+            cmd.finish(result, start)
+        return result
+
+    async def execute_commands(self, commands, has_dependency_cb):
+        """Execute commands concurrently, every command starts once the
+        commands it depends on are finished. The tasks are created in the
+        given order, so ordered commands acquire a job slot in their order.
+
+        Transient failures are retried, the dependents of a failed command
+        are skipped and unrelated commands continue, like
+        :func:`pyaptly.executor.execute_commands`. A command waiting for a
+        retry doesn't hold a job slot. Deferred commands start once all
+        other commands are done.
+
+        :param          commands: Commands as returned by
+                                  :meth:`pyaptly.Command.order_commands`
+        :type           commands: list
+        :param has_dependency_cb: Callback to resolve external dependencies
+        :type  has_dependency_cb: function
+        :rtype:                   :class:`pyaptly.executor.RunReport`"""
+        commands, predecessors, _ = Command.dependency_graph(
+            commands, has_dependency_cb
+        )
+        commands = executor.split_deferred(commands)
+        if Command.bandwidth is not None:
+            Command.bandwidth.expect(commands)
+        report   = executor.RunReport()
+        tasks    = {}
+        regular  = [cmd for cmd in commands if not cmd.deferred]
+
+        async def run(cmd):
+            if cmd.deferred and regular:
+                await asyncio.wait([tasks[x] for x in regular])
+            for predecessor in predecessors[cmd]:
+                await tasks[predecessor]
+            for predecessor in predecessors[cmd]:
+                if report.status(predecessor) not in ('finished', 'pretended'):
+                    report.record(cmd, 'skipped')
+                    return
+            attempt = 1
+            while True:
+                try:
+                    await self.execute(cmd)
+                    break
+                except Exception as e:
+                    delay = executor.retry_delay(
+                        Command.retries, report, cmd, e, attempt
+                    )
+                    if delay is None:
+                        report.record(cmd, executor.outcome(e), e)
+                        return
+                await asyncio.sleep(delay)
+                attempt += 1
+            if Command.pretend_mode:
+                report.record(cmd, 'pretended')
+            else:
+                report.record(cmd, 'finished')
+
+        for cmd in commands:
+            tasks[cmd] = self.loop.create_task(run(cmd))
+        if tasks:
+            await asyncio.wait(list(tasks.values()))
+        # Keep the order of the commands in the report
+        report.results = collections.OrderedDict([
+            (cmd, report.results[cmd]) for cmd in commands
+        ])
+        return report
+
+    async def read_state(self, reader):
+        """Read the state like :meth:`pyaptly.SystemStateReader.read`, with
+        gpg running concurrently to the aptly list and show commands.
+
+        :param reader: The state to read into
+        :type  reader: :class:`pyaptly.SystemStateReader`"""
+        types = ("repo", "mirror", "snapshot", "publish")
+        outputs = await asyncio.gather(
+            self.call_output(reader.gpg_list_keys),
+            *[
+                self.call_output(
+                    reader.aptly_call(["aptly", type_, "list", "-raw"])
+                )
+                for type_ in types
+            ]
+        )
+        reader.names = None
+        reader.gpg_keys = reader._name_set(
+            reader.parse_gpg(outputs[0][0].split("\n"))
+        )
+        lists = []
+        for type_, (data, _) in zip(types, outputs[1:]):
+            names = set()
+            reader.parse_aptly_list(data.split("\n"), names)
+            lists.append(reader._name_set(names))
+        (
+            reader.repos, reader.mirrors, reader.snapshots, reader.publishes
+        ) = lists
+
+        snapshots = list(reader.snapshots)
+        publishes = list(reader.publishes)
+        outputs = await asyncio.gather(*(
+            [
+                self.call_output(
+                    reader.aptly_call(["aptly", "snapshot", "show", name])
+                )
+                for name in snapshots
+            ] + [
+                self.call_output(reader.aptly_call(
+                    ["aptly", "publish", "show"] +
+                    list(reversed(name.split(' ')))
+                ))
+                for name in publishes
+            ]
+        ))
+        snapshot_map = {}
+        for name, (data, _) in zip(snapshots, outputs):
+            snapshot_map[name] = reader.parse_snapshot_sources(
+                data.split("\n")
+            )
+        publish_map = {}
+        for name, (data, _) in zip(publishes, outputs[len(snapshots):]):
+            publish_map[name] = reader.parse_publish_sources(
+                data.split("\n")
+            )
+        reader.snapshot_map = reader._name_map(snapshot_map)
+        reader.publish_map  = reader._name_map(publish_map)
+        lg.debug(
+            'Read state with %d snapshots and %d publishes',
+            len(snapshots),
+            len(publishes),
+        )
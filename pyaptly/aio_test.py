@@ -0,0 +1,252 @@
+"""Testing the asyncio engine"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+from . import Command, FunctionCommand, SystemStateReader
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+requires_asyncio = pytest.mark.skipif(
+    sys.version_info < (3, 5),
+    reason="requires python3.5"
+)
+
+
+def make_engine(jobs=2, timeout=None):
+    """Create an engine, aio can only be imported on python3."""
+    from . import aio
+    return aio.Engine(jobs, timeout)
+
+
+@requires_asyncio
+def test_call_output():
+    """Test if output is returned and errors are raised."""
+    engine = make_engine()
+    try:
+        output, _ = engine.run(engine.call_output(['echo', 'hello']))
+        assert output == "hello\n"
+        error = False
+        try:
+            engine.run(engine.call_output(['bash', '-c', 'exit 42']))
+        except subprocess.CalledProcessError as e:
+            assert e.returncode == 42
+            error = True
+        assert error
+    finally:
+        engine.close()
+
+
+@requires_asyncio
+def test_call_output_timeout():
+    """Test if a process is terminated when it times out."""
+    import asyncio
+    engine = make_engine(timeout=0.2)
+    start = time.time()
+    try:
+        error = False
+        try:
+            engine.run(engine.call_output(['sleep', '10']))
+        except asyncio.TimeoutError:
+            error = True
+        assert error
+    finally:
+        engine.close()
+    assert time.time() - start < 5
+
+
+@requires_asyncio
+def test_execute_commands():
+    """Test if independent commands run concurrently and dependencies are
+    respected."""
+    order = []
+    sleeps = []
+    for i in range(2):
+        cmd = Command(['sleep', '0.5'])
+        cmd.provide('virtual', 'sleep-%d' % i)
+        sleeps.append(cmd)
+    last = FunctionCommand(order.append, 'last')
+    last.require('virtual', 'sleep-0')
+    last.require('virtual', 'sleep-1')
+    engine = make_engine()
+    start = time.time()
+    try:
+        with mock.patch.object(Command, 'durations', None):
+            engine.run(engine.execute_commands(
+                [last] + sleeps, lambda x: False
+            ))
+    finally:
+        engine.close()
+    assert time.time() - start < 0.95
+    assert order == ['last']
+    assert all([cmd._finished == 0 for cmd in sleeps])
+
+
+@requires_asyncio
+def test_execute_commands_failure():
+    """Test if the dependents of a failed command are skipped and unrelated
+    commands continue."""
+    fail = Command(['bash', '-c', 'exit 3'])
+    slow = Command(['sleep', '0.2'])
+    after = FunctionCommand(len, 'after')
+    after.require('virtual', 'failed')
+    fail.provide('virtual', 'failed')
+    stuck = Command(['sleep', '10'])
+    stuck.stall_timeout = 0.2
+    engine = make_engine(jobs=4)
+    start = time.time()
+    try:
+        with mock.patch.object(Command, 'durations', None):
+            report = engine.run(engine.execute_commands(
+                [fail, slow, after, stuck], lambda x: False
+            ))
+    finally:
+        engine.close()
+    assert time.time() - start < 5
+    assert [status for status, _ in report.results.values()] == [
+        'failed', 'finished', 'skipped', 'timeout'
+    ]
+    assert report.errors()[0].returncode == 3
+    assert after._finished is None
+    assert slow._finished == 0
+
+
+@requires_asyncio
+def test_execute_commands_retry():
+    """Test if a transient failure is retried from its output."""
+    from . import executor
+    directory = tempfile.mkdtemp()
+    marker = os.path.join(directory, 'locked')
+    cmd = Command(['bash', '-c', (
+        'test -e %s || { touch %s; echo "database is locked"; exit 1; }'
+    ) % (marker, marker)])
+    policy = executor.RetryPolicy(delay=0)
+    engine = make_engine()
+    try:
+        with mock.patch.object(Command, 'durations', None), \
+                mock.patch.object(Command, 'retries', policy):
+            report = engine.run(engine.execute_commands(
+                [cmd], lambda x: False
+            ))
+    finally:
+        engine.close()
+        shutil.rmtree(directory)
+    assert report.status(cmd) == 'finished'
+    assert report.retries == {cmd: 1}
+
+
+@requires_asyncio
+def test_execute_commands_deferred():
+    """Test if deferred commands start after all other commands."""
+    sleep = Command(['sleep', '0.3'])
+    contents = FunctionCommand(time.time)
+    contents.deferred = 'contents'
+    engine = make_engine()
+    try:
+        with mock.patch.object(Command, 'durations', None):
+            report = engine.run(engine.execute_commands(
+                [contents, sleep], lambda x: False
+            ))
+    finally:
+        engine.close()
+    assert list(report.results) == [sleep, contents]
+    assert report.pending() == []
+
+
+@requires_asyncio
+def test_database_serialized():
+    """Test if aptly processes and functions that may call aptly never
+    overlap, while other processes run concurrently."""
+    import asyncio
+    directory = tempfile.mkdtemp()
+    log = os.path.join(directory, 'log')
+    aptly = os.path.join(directory, 'aptly')
+    with open(aptly, 'w') as f:
+        f.write('#!/bin/sh\necho start >> %s; sleep 0.2; echo end >> %s\n' % (
+            log, log
+        ))
+    os.chmod(aptly, 0o755)
+
+    def refresh():
+        with open(log, 'a') as f:
+            f.write('start\n')
+        time.sleep(0.2)
+        with open(log, 'a') as f:
+            f.write('end\n')
+    refresh.__name__ = 'read'
+
+    engine = make_engine(jobs=4)
+    commands = [Command([aptly, 'mirror', 'update', str(i)]) for i in range(2)]
+    commands.append(FunctionCommand(refresh))
+    start = time.time()
+    try:
+        calls = [
+            engine.loop.create_task(engine.call_output(args))
+            for args in (
+                [aptly, 'snapshot', 'show', 'a'],
+                [aptly, 'publish', 'show', 'b'],
+                ['sleep', '0.4'],
+            )
+        ]
+        engine.run(asyncio.wait(calls))
+        assert time.time() - start < 0.6
+        with mock.patch.object(Command, 'durations', None):
+            report = engine.run(engine.execute_commands(
+                commands, lambda x: False
+            ))
+        with open(log) as f:
+            events = f.read().split()
+    finally:
+        engine.close()
+        shutil.rmtree(directory)
+    assert report.counts() == {'finished': 3}
+    assert events == ['start', 'end'] * 5
+
+
+@requires_asyncio
+def test_read_state():
+    """Test if the state is read with concurrent calls."""
+    outputs = {
+        'gpg': "pub:-:2048:1:0123456789ABCDEF:",
+        'repo list': "",
+        'mirror list': "ubuntu\n",
+        'snapshot list': "base\nmerged\n",
+        'publish list': "ubuntu stable\n",
+        'snapshot show base': "Name: base\n",
+        'snapshot show merged': (
+            "Name: merged\nSources:\n  base [snapshot]\n"
+        ),
+        'publish show stable ubuntu': (
+            "Prefix: ubuntu\nSources:\n  main: merged [snapshot]\n"
+        ),
+    }
+
+    engine = make_engine()
+
+    def call_output(args):
+        if args[0] == 'gpg':
+            key = 'gpg'
+        else:
+            key = " ".join([x for x in args[1:] if x != '-raw'])
+        future = engine.loop.create_future()
+        future.set_result((outputs[key], ""))
+        return future
+
+    reader = SystemStateReader()
+    try:
+        with mock.patch.object(engine, 'call_output', call_output):
+            engine.run(engine.read_state(reader))
+    finally:
+        engine.close()
+    assert reader.gpg_keys == set(['0123456789ABCDEF', '89ABCDEF'])
+    assert reader.mirrors == set(['ubuntu'])
+    assert reader.snapshot_map == {'base': set(), 'merged': set(['base'])}
+    assert reader.publish_map == {'ubuntu stable': set(['merged'])}
@@ -0,0 +1,283 @@
+"""Native reader of the aptly database.
+
+Reading the state with aptly takes a list command per type of object and a
+show command per snapshot and publish, each opening the database. With
+``--state-backend leveldb`` the mirrors, repos, snapshots and publishes are
+decoded from the database itself, one sequential scan per key prefix, without
+any aptly process. It requires plyvel.
+
+The database is a LevelDB with a record per object, keyed by a prefix and
+the UUID, encoded with msgpack as a map of the fields of the Go struct:
+
+==========  =============  ================================================
+Prefix      Object         Fields used
+==========  =============  ================================================
+``R``       mirror         Name
+``L``       local repo     Name
+``S``       snapshot       UUID, Name, SourceKind, SourceIDs
+``U``       publish        Storage, Prefix, Distribution, SourceKind,
+                           Sources (component -> UUID) or SourceUUID
+==========  =============  ================================================
+
+The sources of snapshots and publishes refer to snapshots by UUID, they are
+resolved to names. Like the show commands, only snapshot sources are kept.
+LevelDB can't be opened read-only, so the reader opens a copy of the
+database (see :mod:`pyaptly.dbcopy`) and never touches the one of aptly.
+"""
+import struct
+import time
+
+from . import lg
+
+# Key prefixes of the collections in the aptly database
+collection_prefixes = (
+    ('mirrors',   b'R'),
+    ('repos',     b'L'),
+    ('snapshots', b'S'),
+    ('publishes', b'U'),
+)
+
+# Fields every record of a collection has
+collection_fields = {
+    'mirrors':   ('UUID', 'Name'),
+    'repos':     ('UUID', 'Name'),
+    'snapshots': ('UUID', 'Name'),
+    'publishes': ('UUID', 'Distribution'),
+}
+
+# msgpack formats of fixed size: code -> struct format
+fixed_formats = {
+    0xca: '>f', 0xcb: '>d',
+    0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+    0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q',
+}
+
+# msgpack formats with a length: code -> (struct format of the length, kind)
+sized_formats = {
+    0xc4: ('>B', 'raw'),   0xc5: ('>H', 'raw'),   0xc6: ('>I', 'raw'),
+    0xc7: ('>B', 'ext'),   0xc8: ('>H', 'ext'),   0xc9: ('>I', 'ext'),
+    0xd9: ('>B', 'raw'),   0xda: ('>H', 'raw'),   0xdb: ('>I', 'raw'),
+    0xdc: ('>H', 'array'), 0xdd: ('>I', 'array'),
+    0xde: ('>H', 'map'),   0xdf: ('>I', 'map'),
+}
+
+# Data sizes of the fixext formats
+fixext_sizes = {0xd4: 1, 0xd5: 2, 0xd6: 4, 0xd7: 8, 0xd8: 16}
+
+constants = {0xc0: None, 0xc2: False, 0xc3: True}
+
+
+def available():
+    """Return True if the database can be read, plyvel is installed.
+
+    :rtype: bool"""
+    try:
+        import plyvel  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+def unpack(data, offset=0):
+    """Decode the msgpack value at an offset. Strings and binaries are
+    returned as bytes, aptly writes both as raw, extensions as their data.
+
+    :param   data: The encoded data
+    :type    data: bytes
+    :param offset: Offset of the value
+    :type  offset: int
+    :rtype:        tuple of the value and the offset after it"""
+    if offset >= len(data):
+        raise ValueError("Truncated msgpack data")
+    code = ord(data[offset:offset + 1])
+    offset += 1
+    if code <= 0x7f:
+        return code, offset
+    if code >= 0xe0:
+        return code - 0x100, offset
+    if code <= 0x8f:
+        return unpack_map(data, offset, code & 0x0f)
+    if code <= 0x9f:
+        return unpack_array(data, offset, code & 0x0f)
+    if code <= 0xbf:
+        return unpack_raw(data, offset, code & 0x1f)
+    if code in constants:
+        return constants[code], offset
+    if code in fixed_formats:
+        format_ = fixed_formats[code]
+        value = struct.unpack_from(format_, data, offset)[0]
+        return value, offset + struct.calcsize(format_)
+    if code in fixext_sizes:
+        return unpack_raw(data, offset + 1, fixext_sizes[code])
+    if code not in sized_formats:
+        raise ValueError("Unknown msgpack code 0x%02x" % code)
+    format_, kind = sized_formats[code]
+    length = struct.unpack_from(format_, data, offset)[0]
+    offset += struct.calcsize(format_)
+    if kind == 'map':
+        return unpack_map(data, offset, length)
+    if kind == 'array':
+        return unpack_array(data, offset, length)
+    if kind == 'ext':
+        offset += 1
+    return unpack_raw(data, offset, length)
+
+
+def unpack_raw(data, offset, length):
+    """Decode a string, binary or extension of a length."""
+    end = offset + length
+    if end > len(data):
+        raise ValueError("Truncated msgpack data")
+    return data[offset:end], end
+
+
+def unpack_array(data, offset, length):
+    """Decode an array of a length."""
+    array = []
+    for _ in range(length):
+        value, offset = unpack(data, offset)
+        array.append(value)
+    return array, offset
+
+
+def unpack_map(data, offset, length):
+    """Decode a map of a length, string keys are decoded to text."""
+    map_ = {}
+    for _ in range(length):
+        key, offset = unpack(data, offset)
+        value, offset = unpack(data, offset)
+        map_[text(key)] = value
+    return map_, offset
+
+
+def text(value):
+    """Return a string of a record as text.
+
+    :param value: The string
+    :type  value: bytes
+    :rtype:       str"""
+    if isinstance(value, bytes):
+        return value.decode("UTF-8", "replace")
+    return value
+
+
+def decode(value):
+    """Decode a record of the database, None if it isn't an object.
+
+    :param value: The record
+    :type  value: bytes
+    :rtype:       dict"""
+    record, offset = unpack(value)
+    if offset != len(value) or not isinstance(record, dict):
+        return None
+    return record
+
+
+def scan(path):
+    """Read the records of the collections of a database.
+
+    :param path: Directory of the database
+    :type  path: str
+    :rtype:      dict of lists of records per collection"""
+    import plyvel
+    db = plyvel.DB(path, create_if_missing=False)
+    try:
+        records = {}
+        for collection, prefix in collection_prefixes:
+            fields = collection_fields[collection]
+            records[collection] = []
+            for value in db.iterator(prefix=prefix, include_key=False):
+                try:
+                    record = decode(value)
+                except (ValueError, struct.error):
+                    record = None
+                # Other keys may share the prefix
+                if record is None or not all(x in record for x in fields):
+                    continue
+                records[collection].append(record)
+    finally:
+        db.close()
+    return records
+
+
+def publish_name(record):
+    """Return the name of a publish like "aptly publish list -raw",
+    "<prefix> <distribution>".
+
+    :param record: The publish
+    :type  record: dict
+    :rtype:        str"""
+    prefix = text(record.get('Prefix')) or '.'
+    storage = text(record.get('Storage'))
+    if storage:
+        prefix = '%s:%s' % (storage, prefix)
+    return '%s %s' % (prefix, text(record['Distribution']))
+
+
+def publish_sources(record):
+    """Return the UUIDs of the sources of a publish, ordered by component.
+
+    :param record: The publish
+    :type  record: dict
+    :rtype:        list"""
+    sources = record.get('Sources')
+    if sources:
+        return [text(sources[x]) for x in sorted(sources)]
+    if record.get('SourceUUID'):
+        return [text(record['SourceUUID'])]
+    return []
+
+
+def read_state(records):
+    """Return the names of the objects and the snapshot sources of
+    snapshots and publishes.
+
+    :param records: The records, as returned by :func:`scan`
+    :type  records: dict
+    :rtype:         dict of repos, mirrors, snapshots, snapshot_map,
+                    publishes and publish_map"""
+    snapshot_names = dict([
+        (text(x['UUID']), text(x['Name'])) for x in records['snapshots']
+    ])
+
+    def snapshot_sources(kind, uuids):
+        if text(kind) != 'snapshot':
+            return []
+        return [
+            snapshot_names[text(x)] for x in uuids
+            if text(x) in snapshot_names
+        ]
+
+    snapshot_map = {}
+    for record in records['snapshots']:
+        snapshot_map[text(record['Name'])] = snapshot_sources(
+            record.get('SourceKind'), record.get('SourceIDs') or []
+        )
+    publish_map = {}
+    for record in records['publishes']:
+        publish_map[publish_name(record)] = snapshot_sources(
+            record.get('SourceKind'), publish_sources(record)
+        )
+    return {
+        'repos':        set([text(x['Name']) for x in records['repos']]),
+        'mirrors':      set([text(x['Name']) for x in records['mirrors']]),
+        'snapshots':    set(snapshot_map),
+        'snapshot_map': snapshot_map,
+        'publishes':    set(publish_map),
+        'publish_map':  publish_map,
+    }
+
+
+def read(path):
+    """Read the state from a database, see :func:`read_state`.
+
+    :param path: Directory of the database
+    :type  path: str
+    :rtype:      dict"""
+    start = time.time()
+    records = scan(path)
+    lg.debug(
+        'Read %d records from %s in %.3f seconds',
+        sum(len(x) for x in records.values()), path, time.time() - start
+    )
+    return read_state(records)
@@ -0,0 +1,171 @@
+"""Testing the native reader of the aptly database"""
+import json
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+import pytest
+
+from . import aptlydb, dbcopy
+
+requires_aptly = pytest.mark.skipif(
+    not any(
+        os.path.exists(os.path.join(path, 'aptly'))
+        for path in os.environ.get('PATH', '').split(os.pathsep)
+    ),
+    reason="requires aptly"
+)
+
+
+def pack(value):
+    """Encode a value like aptly, strings as raw."""
+    if value is None:
+        return b'\xc0'
+    if isinstance(value, bool):
+        return b'\xc3' if value else b'\xc2'
+    if isinstance(value, int):
+        if 0 <= value <= 0x7f:
+            return struct.pack('>B', value)
+        return b'\xd3' + struct.pack('>q', value)
+    if not isinstance(value, (bytes, list, dict)):
+        value = value.encode("UTF-8")
+    if isinstance(value, bytes):
+        if len(value) < 32:
+            return struct.pack('>B', 0xa0 | len(value)) + value
+        return b'\xda' + struct.pack('>H', len(value)) + value
+    if isinstance(value, list):
+        return b'\xdc' + struct.pack('>H', len(value)) + b''.join(
+            pack(x) for x in value
+        )
+    return b'\xde' + struct.pack('>H', len(value)) + b''.join(
+        pack(k) + pack(v) for k, v in sorted(value.items())
+    )
+
+
+records = {
+    'mirrors': [{'UUID': 'm1', 'Name': 'ubuntu', 'Components': ['main']}],
+    'repos': [{'UUID': 'r1', 'Name': 'local', 'Uploaders': None}],
+    'snapshots': [
+        {
+            'UUID': 's1', 'Name': 'ubuntu-20240101T0000Z',
+            'SourceKind': 'repo', 'SourceIDs': ['m1'],
+            # time.Time.MarshalBinary, not UTF-8
+            'CreatedAt': b'\x01\x00\x00\x00\x0e\xdd\xff\xfe',
+        },
+        {
+            'UUID': 's2', 'Name': 'merged', 'SourceKind': 'snapshot',
+            'SourceIDs': ['s1', 'gone'],
+        },
+    ],
+    'publishes': [
+        {
+            'UUID': 'p1', 'Prefix': 'ubuntu', 'Distribution': 'trusty',
+            'Storage': '', 'SourceKind': 'snapshot',
+            'Sources': {'main': 's2', 'contrib': 's1'},
+        },
+        {
+            'UUID': 'p2', 'Prefix': '.', 'Distribution': 'local',
+            'Storage': 's3:mirror', 'SourceKind': 'local',
+            'Sources': {'main': 'r1'},
+        },
+    ],
+}
+
+
+def test_unpack():
+    """Test if the msgpack formats aptly writes are decoded."""
+    for data, value in [
+            (b'\x05', 5),
+            (b'\xff', -1),
+            (b'\xcd\x01\x00', 256),
+            (b'\xd2\xff\xff\xff\xfe', -2),
+            (b'\xcb' + struct.pack('>d', 1.5), 1.5),
+            (b'\xc4\x02ab', b'ab'),
+            (b'\xd4\x05a', b'a'),
+            (b'\xc7\x02\x05ab', b'ab'),
+            (b'\x92\xc0\xc3', [None, True]),
+            (b'\x81\xa1a\xc2', {'a': False}),
+    ]:
+        assert aptlydb.unpack(data) == (value, len(data))
+    for data in (b'\xc1', b'\xa3ab', b''):
+        with pytest.raises(ValueError):
+            aptlydb.unpack(data)
+    assert aptlydb.decode(pack(records['snapshots'][0]))['Name'] == (
+        b'ubuntu-20240101T0000Z'
+    )
+    assert aptlydb.decode(pack(['a'])) is None
+
+
+def test_read_state():
+    """Test if the names and the snapshot sources are resolved."""
+    decoded = dict([
+        (collection, [aptlydb.decode(pack(x)) for x in values])
+        for collection, values in records.items()
+    ])
+    read = aptlydb.read_state(decoded)
+    assert read['mirrors'] == set(['ubuntu'])
+    assert read['repos'] == set(['local'])
+    assert read['snapshot_map'] == {
+        'ubuntu-20240101T0000Z': [],
+        'merged': ['ubuntu-20240101T0000Z'],
+    }
+    assert read['publish_map'] == {
+        'ubuntu trusty': ['ubuntu-20240101T0000Z', 'merged'],
+        's3:mirror:. local': [],
+    }
+
+
+def test_scan():
+    """Test if the records are read from a LevelDB, other keys sharing a
+    prefix are skipped."""
+    plyvel = pytest.importorskip('plyvel')
+    directory = tempfile.mkdtemp()
+    try:
+        db = plyvel.DB(directory, create_if_missing=True)
+        for collection, prefix in aptlydb.collection_prefixes:
+            for record in records[collection]:
+                db.put(prefix + record['UUID'].encode("UTF-8"), pack(record))
+        db.put(b'Sother', b'\xa5value')
+        db.put(b'Pamd64 a 1.0 1234', pack({'Package': 'a'}))
+        db.close()
+        read = aptlydb.read(directory)
+        assert read['snapshots'] == set(['ubuntu-20240101T0000Z', 'merged'])
+        assert read['publishes'] == set(['ubuntu trusty', 's3:mirror:. local'])
+    finally:
+        shutil.rmtree(directory)
+
+
+@requires_aptly
+def test_read_aptly():
+    """Test if a database written by aptly is read like aptly lists it."""
+    pytest.importorskip('plyvel')
+    directory = tempfile.mkdtemp()
+    try:
+        root = os.path.join(directory, 'aptly')
+        conf = os.path.join(directory, 'aptly.conf')
+        with open(conf, 'w') as f:
+            json.dump({'rootDir': root}, f)
+        aptly = ['aptly', '-config=%s' % conf]
+        for call in [
+                ['repo', 'create', 'local'],
+                ['snapshot', 'create', 'local-base', 'from', 'repo', 'local'],
+                ['snapshot', 'merge', 'merged', 'local-base'],
+                ['publish', 'snapshot', '-skip-signing',
+                 '-architectures=amd64', '-distribution=trusty', 'merged',
+                 'ubuntu'],
+        ]:
+            subprocess.check_call(aptly + call)
+        copy = dbcopy.prepare(
+            os.path.join(directory, 'dbcopy'), root, {'rootDir': root}
+        )
+        read = aptlydb.read(os.path.join(os.path.dirname(copy), 'db'))
+        assert read['repos'] == set(['local'])
+        assert read['snapshots'] == set(['local-base', 'merged'])
+        assert read['snapshot_map'] == {
+            'local-base': [], 'merged': ['local-base'],
+        }
+        assert read['publish_map'] == {'ubuntu trusty': ['merged']}
+    finally:
+        shutil.rmtree(directory)
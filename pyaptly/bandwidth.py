@@ -0,0 +1,225 @@
+"""Bandwidth budget shared by the mirror updates of a run.
+
+``aptly mirror update`` downloads at full speed unless it gets a
+``-download-limit``. With ``bandwidth`` configured, the budget valid at the
+time (the limit of the current time window, or the default limit) is split
+across the mirror updates that can run at once and every update is started
+with its share. Mirror updates open the aptly database, which only one aptly
+process can hold, so in a run of pyaptly they run one at a time even with
+``--jobs`` and every update gets the whole budget.
+
+aptly can't change the limit of a running download, so the split is
+rebalanced whenever a mirror update starts: it gets an equal part of the
+budget not taken by the running updates, the share of a finished update goes
+to the updates started after it. A share is never smaller than the budget
+divided by the number of concurrent updates, so no update is starved.
+"""
+import contextlib
+import datetime
+import threading
+
+from . import day_of_week_map, lg
+
+# Kind of the commands sharing the budget
+limited_kind = 'mirror update'
+
+
+def parse_time(value):
+    """Parse a time of day, ie. "08:30".
+
+    :param value: The time
+    :type  value: str
+    :rtype:       :py:class:`datetime.time`"""
+    try:
+        return datetime.datetime.strptime(str(value), '%H:%M').time()
+    except ValueError:
+        raise ValueError("Invalid time of day in bandwidth: %s" % value)
+
+
+class Window(object):
+    """A time window with its own limit. If from is after to, the window
+    spans midnight.
+
+    :param start: Start of the window
+    :type  start: :py:class:`datetime.time`
+    :param   end: End of the window
+    :type    end: :py:class:`datetime.time`
+    :param limit: Budget in KiB/s, 0 for no limit
+    :type  limit: int
+    :param  days: ISO weekdays of the window, None for every day
+    :type   days: set"""
+
+    def __init__(self, start, end, limit, days=None):
+        self.start = start
+        self.end   = end
+        self.limit = limit
+        self.days  = days
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a window from the config.
+
+        :param config: The window, "from", "to", "limit" and "days"
+        :type  config: dict
+        :rtype:        Window"""
+        unknown = set(config) - set(['from', 'to', 'limit', 'days'])
+        if unknown:
+            raise ValueError("Unknown bandwidth window keys: %s" % (
+                ", ".join(sorted(unknown))
+            ))
+        days = None
+        if 'days' in config:
+            days = set()
+            for day in config['days']:
+                if day not in day_of_week_map:
+                    raise ValueError("Unknown day in bandwidth: %s" % day)
+                days.add(day_of_week_map[day])
+        return cls(
+            parse_time(config['from']),
+            parse_time(config['to']),
+            int(config.get('limit', 0)),
+            days,
+        )
+
+    def contains(self, now):
+        """Return True if now is in the window.
+
+        :param now: The time
+        :type  now: :py:class:`datetime.datetime`
+        :rtype:     bool"""
+        if self.days is not None and now.isoweekday() not in self.days:
+            return False
+        time = now.time()
+        if self.start <= self.end:
+            return self.start <= time < self.end
+        return time >= self.start or time < self.end
+
+
+class Budget(object):
+    """The bandwidth budget of a run, see the module documentation.
+
+    :param   limit: Budget in KiB/s outside the windows, 0 for no limit
+    :type    limit: int
+    :param windows: Time windows with their own limits, the first matching
+                    window applies
+    :type  windows: list
+    :param    jobs: Number of mirror updates that can run at once
+    :type     jobs: int"""
+
+    def __init__(self, limit=0, windows=(), jobs=1):
+        self.limit   = limit
+        self.windows = list(windows)
+        self.jobs    = jobs
+        self.running = {}
+        self.waiting = 0
+        self._lock   = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, jobs=1):
+        """Create the budget from the "bandwidth" config.
+
+        :param config: The config, "limit" and "windows"
+        :type  config: dict
+        :param   jobs: Number of mirror updates that can run at once
+        :type    jobs: int
+        :rtype:        Budget"""
+        unknown = set(config) - set(['limit', 'windows'])
+        if unknown:
+            raise ValueError(
+                "Unknown bandwidth keys: %s" % ", ".join(sorted(unknown))
+            )
+        return cls(
+            int(config.get('limit', 0)),
+            [Window.from_config(x) for x in config.get('windows', [])],
+            jobs,
+        )
+
+    def limit_at(self, now=None):
+        """Return the budget at a time in KiB/s, 0 for no limit.
+
+        :param now: The time, defaults to now
+        :type  now: :py:class:`datetime.datetime`
+        :rtype:     int"""
+        if now is None:
+            now = datetime.datetime.now()
+        for window in self.windows:
+            if window.contains(now):
+                return window.limit
+        return self.limit
+
+    def expect(self, commands):
+        """Set the number of mirror updates of the run that haven't started.
+
+        :param commands: The commands of the run
+        :type  commands: list"""
+        with self._lock:
+            self.waiting = len([
+                cmd for cmd in commands if cmd.kind() == limited_kind
+            ])
+
+    def acquire(self, cmd, now=None):
+        """Return the share of a starting mirror update in KiB/s, 0 for no
+        limit. It is held until :meth:`release`.
+
+        :param cmd: The command
+        :type  cmd: :class:`pyaptly.Command`
+        :param now: The time, defaults to now
+        :type  now: :py:class:`datetime.datetime`
+        :rtype:     int"""
+        with self._lock:
+            self.waiting = max(self.waiting - 1, 0)
+            limit = self.limit_at(now)
+            share = 0
+            if limit:
+                running = len(self.running)
+                concurrent = max(
+                    min(self.jobs, running + 1 + self.waiting), running + 1
+                )
+                free = limit - sum(self.running.values())
+                share = max(
+                    free // (concurrent - running), limit // concurrent, 1
+                )
+            self.running[cmd] = share
+            return share
+
+    def release(self, cmd):
+        """Return the share of a finished mirror update to the budget.
+
+        :param cmd: The command
+        :type  cmd: :class:`pyaptly.Command`"""
+        with self._lock:
+            self.running.pop(cmd, None)
+
+    @contextlib.contextmanager
+    def allot(self, cmd):
+        """Context of running a command, yields the arguments to run it with.
+        Mirror updates get the option limiting them to their share.
+
+        :param cmd: The command
+        :type  cmd: :class:`pyaptly.Command`"""
+        if cmd.kind() != limited_kind:
+            yield cmd.cmd
+            return
+        share = self.acquire(cmd)
+        try:
+            if share:
+                lg.info(
+                    'Limiting %s to %d KiB/s', cmd.describe(), share
+                )
+            yield limited(cmd.cmd, share)
+        finally:
+            self.release(cmd)
+
+
+def limited(args, share):
+    """Return the arguments of a mirror update with a download limit.
+
+    :param  args: The aptly command
+    :type   args: list
+    :param share: Limit in KiB/s, 0 for no limit
+    :type  share: int
+    :rtype:       list"""
+    if not share:
+        return list(args)
+    index = args.index('update') + 1
+    return args[:index] + ['-download-limit=%d' % share] + args[index:]
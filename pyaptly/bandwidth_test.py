@@ -0,0 +1,88 @@
+"""Testing the bandwidth budget of mirror updates"""
+import datetime
+
+from . import Command, bandwidth
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+
+def update(name):
+    """Return the command updating a mirror."""
+    return Command(['aptly', 'mirror', 'update', '-max-tries=3', name])
+
+
+def test_limit_at():
+    """Test if the limit of the current window applies, windows may span
+    midnight and be limited to weekdays."""
+    budget = bandwidth.Budget.from_config({
+        'limit': 0,
+        'windows': [
+            {'from': '08:00', 'to': '18:00', 'limit': 2048,
+             'days': ['mon', 'tue', 'wed', 'thu', 'fri']},
+            {'from': '22:00', 'to': '02:00', 'limit': 8192},
+        ],
+    })
+    # 2024-01-01 is a monday
+    assert budget.limit_at(datetime.datetime(2024, 1, 1, 9)) == 2048
+    assert budget.limit_at(datetime.datetime(2024, 1, 6, 9)) == 0
+    assert budget.limit_at(datetime.datetime(2024, 1, 1, 18)) == 0
+    assert budget.limit_at(datetime.datetime(2024, 1, 1, 23)) == 8192
+    assert budget.limit_at(datetime.datetime(2024, 1, 2, 1, 59)) == 8192
+    for config in [{'limt': 1}, {'windows': [{'from': '8', 'to': '9'}]}]:
+        error = False
+        try:
+            bandwidth.Budget.from_config(config)
+        except ValueError:
+            error = True
+        assert error
+
+
+def test_split():
+    """Test if the budget is split across the updates running at once and
+    the share of a finished update goes to the next one."""
+    commands = [update(x) for x in ('a', 'b', 'c', 'd')]
+    budget = bandwidth.Budget(3000, jobs=3)
+    budget.expect(commands + [Command(['aptly', 'mirror', 'create'])])
+    assert budget.acquire(commands[0]) == 1000
+    assert budget.acquire(commands[1]) == 1000
+    budget.release(commands[0])
+    assert budget.acquire(commands[2]) == 1000
+    assert budget.acquire(commands[3]) == 1000
+    budget.release(commands[1])
+    budget.release(commands[2])
+    # Only one update left, it may use the free budget
+    budget.expect([commands[0]])
+    assert budget.acquire(commands[0]) == 2000
+    assert bandwidth.Budget(0).acquire(commands[1]) == 0
+
+
+def test_serial_updates():
+    """Test if updates that run one at a time get the whole budget, even if
+    more updates are waiting."""
+    commands = [update(x) for x in ('a', 'b', 'c')]
+    budget = bandwidth.Budget(3000)
+    budget.expect(commands)
+    for cmd in commands:
+        assert budget.acquire(cmd) == 3000
+        budget.release(cmd)
+
+
+def test_run_limited():
+    """Test if mirror updates are run with their share, other commands
+    unchanged."""
+    budget = bandwidth.Budget(1024)
+    with mock.patch.object(Command, 'bandwidth', budget), \
+            mock.patch('subprocess.check_call') as call:
+        update('ubuntu').run()
+        Command(['aptly', 'mirror', 'create', 'ubuntu']).run()
+    assert call.call_args_list[0][0][0] == [
+        'aptly', 'mirror', 'update', '-download-limit=1024', '-max-tries=3',
+        'ubuntu'
+    ]
+    assert call.call_args_list[1][0][0] == [
+        'aptly', 'mirror', 'create', 'ubuntu'
+    ]
+    assert budget.running == {}
@@ -0,0 +1,212 @@
+"""Changes of the config since the previous run.
+
+Every run of a task plans all mirrors, snapshots, publishes or repos of the
+config. With ``--changed-only`` a task plans only the entities affected by
+a change of the config since its last successful run: the entities whose
+config changed or that are new, and everything downstream of them.
+
+* a mirror affects the snapshots taken from it
+* a repo affects the snapshots taken from it and the publishes of it
+* a snapshot affects the snapshots filtering or merging it and the publishes
+  of it
+* a publish affects the publishes of it ("publish" source)
+
+The config of every entity is normalized (keys sorted, serialized as JSON)
+and hashed. The digests are stored per config file and task in
+``config-digests.json`` in the state directory, after the task succeeded, so
+a failed or pretended run is planned again. A plan file carries the
+digests, they are stored when the plan is applied successfully. Changes of
+aptly's state, ie. new packages upstream, aren't config changes, runs
+updating the state on a schedule still need the full task.
+"""
+import collections
+import hashlib
+import json
+import os
+
+from . import lg
+
+# Types of the entities in the config
+entity_types = ('mirror', 'repo', 'snapshot', 'publish')
+
+
+def digest(config):
+    """Return the digest of the normalized config of an entity.
+
+    :param config: The config
+    :type  config: dict or list
+    :rtype:        str"""
+    normalized = json.dumps(
+        config, sort_keys=True, separators=(',', ':'), default=str
+    )
+    return hashlib.sha256(normalized.encode("UTF-8")).hexdigest()
+
+
+def digests(cfg):
+    """Return the digests of the entities of a config.
+
+    :param cfg: pyaptly config
+    :type  cfg: dict
+    :rtype:     dict of name -> digest per type"""
+    return dict([
+        (type_, dict([
+            (name, digest(config))
+            for name, config in (cfg.get(type_) or {}).items()
+        ]))
+        for type_ in entity_types
+    ])
+
+
+def changed(previous, current):
+    """Return the entities that are new or whose digest changed.
+
+    :param previous: Digests of the previous run, None if there was none
+    :type  previous: dict
+    :param  current: Digests of the config
+    :type   current: dict
+    :rtype:          dict of sets of names per type"""
+    previous = previous or {}
+    return dict([
+        (type_, set([
+            name for name, value in current[type_].items()
+            if previous.get(type_, {}).get(name) != value
+        ]))
+        for type_ in entity_types
+    ])
+
+
+def spec_name(spec):
+    """Return the config name of a snapshot reference of a merge, filter or
+    publish, a name or a dict with a name and a timestamp.
+
+    :param spec: The reference
+    :type  spec: str or dict
+    :rtype:      str"""
+    if isinstance(spec, dict):
+        return spec['name']
+    return spec
+
+
+def snapshot_sources(snapshot_config):
+    """Return the entities a snapshot is taken from.
+
+    :param snapshot_config: Configuration of the snapshot
+    :type  snapshot_config: dict
+    :rtype:                 list of (type, name)"""
+    if 'mirror' in snapshot_config:
+        return [('mirror', snapshot_config['mirror'])]
+    if 'repo' in snapshot_config:
+        return [('repo', snapshot_config['repo'])]
+    if 'filter' in snapshot_config:
+        return [('snapshot', spec_name(snapshot_config['filter']['source']))]
+    return [
+        ('snapshot', spec_name(x)) for x in snapshot_config.get('merge', [])
+    ]
+
+
+def publish_sources(publish_config):
+    """Return the entities an entry of a publish is published from.
+
+    :param publish_config: Configuration of the publish entry
+    :type  publish_config: dict
+    :rtype:                list of (type, name)"""
+    if 'repo' in publish_config:
+        return [('repo', publish_config['repo'])]
+    if 'publish' in publish_config:
+        source = " ".join(publish_config['publish'].split("/"))
+        return [('publish', source.split(" ")[0])]
+    snapshots = publish_config.get('snapshots') or []
+    if not isinstance(snapshots, list):
+        snapshots = [snapshots]
+    return [('snapshot', spec_name(x)) for x in snapshots]
+
+
+def dependents(cfg):
+    """Return the entities downstream of every entity.
+
+    :param cfg: pyaptly config
+    :type  cfg: dict
+    :rtype:     dict of (type, name) -> set of (type, name)"""
+    graph = collections.defaultdict(set)
+    for name, config in (cfg.get('snapshot') or {}).items():
+        for source in snapshot_sources(config):
+            graph[source].add(('snapshot', name))
+    for name, entries in (cfg.get('publish') or {}).items():
+        for entry in entries:
+            for source in publish_sources(entry):
+                graph[source].add(('publish', name))
+    return graph
+
+
+def closure(cfg, changes):
+    """Return the changed entities and everything downstream of them.
+
+    :param     cfg: pyaptly config
+    :type      cfg: dict
+    :param changes: Changed names per type, see :func:`changed`
+    :type  changes: dict
+    :rtype:         dict of sets of names per type"""
+    graph = dependents(cfg)
+    todo = [(type_, name) for type_ in entity_types for name in changes[type_]]
+    affected = set(todo)
+    while todo:
+        for dependent in graph.get(todo.pop(), ()):
+            if dependent not in affected:
+                affected.add(dependent)
+                todo.append(dependent)
+    return dict([
+        (type_, set([name for x, name in affected if x == type_]))
+        for type_ in entity_types
+    ])
+
+
+class DigestStore(object):
+    """The digests of the configs of the previous runs, per config file and
+    task.
+
+    :param path: Path of the JSON file
+    :type  path: str"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """Return the content of the file, empty if it doesn't exist.
+
+        :rtype: dict"""
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            lg.warning('Ignoring corrupt config digests %s', self.path)
+            return {}
+
+    def load(self, config_path, task):
+        """Return the digests of the last successful run of a task, None if
+        there was none.
+
+        :param config_path: Absolute path of the config file
+        :type  config_path: str
+        :param        task: The task, ie. "publish update"
+        :type         task: str
+        :rtype:             dict"""
+        return self.read().get(config_path, {}).get(task)
+
+    def save(self, config_path, task, task_digests):
+        """Store the digests of a successful run of a task, the file is
+        replaced atomically.
+
+        :param  config_path: Absolute path of the config file
+        :type   config_path: str
+        :param         task: The task, ie. "publish update"
+        :type          task: str
+        :param task_digests: The digests, see :func:`digests`
+        :type  task_digests: dict"""
+        content = self.read()
+        content.setdefault(config_path, {})[task] = task_digests
+        temp = '%s.%d' % (self.path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(content, f, indent=2, sort_keys=True)
+        os.rename(temp, self.path)
@@ -0,0 +1,96 @@
+"""Testing the detection of config changes"""
+import argparse
+import os
+import shutil
+import tempfile
+
+from . import changes, selected_entities
+
+cfg = {
+    'mirror': {
+        'trusty-main': {'archive': 'http://mirror/ubuntu'},
+        'chrome': {'archive': 'http://dl.google.com/linux/chrome/deb/'},
+    },
+    'repo': {
+        'local': {'component': 'main'},
+    },
+    'snapshot': {
+        'trusty-main-%T': {
+            'mirror': 'trusty-main',
+            'timestamp': {'time': '00:00'},
+        },
+        'trusty-keyring-%T': {
+            'filter': {
+                'source': {'name': 'trusty-main-%T', 'timestamp': 'current'},
+                'query': 'ubuntu-keyring',
+            },
+            'timestamp': {'time': '00:00'},
+        },
+        'chrome-latest': {'mirror': 'chrome'},
+        'local-latest': {'repo': 'local'},
+    },
+    'publish': {
+        'ubuntu': [{
+            'distribution': 'trusty',
+            'snapshots': [
+                {'name': 'trusty-keyring-%T', 'timestamp': 'current'},
+            ],
+        }],
+        'ubuntu-copy': [
+            {'distribution': 'trusty', 'publish': 'ubuntu trusty'},
+        ],
+        'chrome': [{'distribution': 'stable', 'snapshots': 'chrome-latest'}],
+        'local': [{'distribution': 'stable', 'repo': 'local'}],
+    },
+}
+
+
+def test_closure():
+    """Test if a change selects the entities downstream of it."""
+    previous = changes.digests(cfg)
+    assert changes.changed(previous, previous) == dict(
+        (x, set()) for x in changes.entity_types
+    )
+    assert changes.changed(None, previous)['mirror'] == set(cfg['mirror'])
+    edited = dict(cfg, mirror=dict(
+        cfg['mirror'],
+        **{'trusty-main': {'archive': 'http://other/ubuntu'}}
+    ))
+    affected = changes.closure(
+        edited, changes.changed(previous, changes.digests(edited))
+    )
+    assert affected == {
+        'mirror':   set(['trusty-main']),
+        'repo':     set(),
+        'snapshot': set(['trusty-main-%T', 'trusty-keyring-%T']),
+        'publish':  set(['ubuntu', 'ubuntu-copy']),
+    }
+    args = argparse.Namespace(changed=affected)
+    assert selected_entities(cfg, args, 'publish') == [
+        (x, cfg['publish'][x]) for x in cfg['publish']
+        if x in ('ubuntu', 'ubuntu-copy')
+    ]
+    assert len(selected_entities(cfg, argparse.Namespace(), 'mirror')) == 2
+
+
+def test_publish_sources():
+    """Test if both notations of a publish source are understood."""
+    for source in ('ubuntu trusty', 'ubuntu/trusty'):
+        assert changes.publish_sources({'publish': source}) == [
+            ('publish', 'ubuntu')
+        ]
+
+
+def test_digest_store():
+    """Test if the digests are stored per config and task."""
+    directory = tempfile.mkdtemp()
+    try:
+        store = changes.DigestStore(os.path.join(directory, 'digests.json'))
+        assert store.load('/etc/pyaptly.yml', 'mirror update') is None
+        digests = changes.digests(cfg)
+        store.save('/etc/pyaptly.yml', 'mirror update', digests)
+        store.save('/etc/pyaptly.yml', 'publish update', {})
+        assert store.load('/etc/pyaptly.yml', 'mirror update') == digests
+        assert store.load('/etc/other.yml', 'mirror update') is None
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,359 @@
+"""Local control socket to trigger and observe pyaptly runs.
+
+The server accepts one JSON request per connection on a unix socket::
+
+    {"entry": "publish", "task": "update", "name": "ubuntu/stable"}
+
+*name* is optional and defaults to "all", like on the command-line. Requests
+are queued and executed one after another. Identical requests that are still
+waiting in the queue are coalesced into one run, every caller gets the events
+of that run.
+
+The server answers with one JSON object per line until the run is finished::
+
+    {"event": "queued", "job": 1, "coalesced": false}
+    {"event": "started", "job": 1}
+    {"event": "command", "job": 1, "state": "started", "command": "..."}
+    {"event": "command", "job": 1, "state": "finished", "command": "..."}
+    {"event": "finished", "job": 1, "status": "ok"}
+
+A failing run ends with status "failed" and an "error" message, an invalid
+request is answered with a single "error" event.
+
+Like the runs started on the command-line, every job holds the lock of the
+aptly root while it runs, see :mod:`pyaptly.runlock`. A job that is coalesced
+with a run waiting for the lock ends with status "coalesced".
+"""
+import argparse
+import collections
+import errno
+import json
+import os
+import socket
+import threading
+
+from six.moves import queue, socketserver
+
+from . import (Command, load_config, lg, mirror, plan_entries, plan_mirror,
+               plan_publish, plan_repo, plan_snapshot, publish, repo, runlock,
+               snapshot, state)
+
+# The functions executing the commands of the plan functions
+executors = {
+    plan_mirror:   mirror,
+    plan_snapshot: snapshot,
+    plan_publish:  publish,
+    plan_repo:     repo,
+}
+
+entries = dict([
+    (entry, (executors[plan_func], name_arg, tasks))
+    for entry, (plan_func, name_arg, tasks) in plan_entries.items()
+])
+
+
+class Job(object):
+    """A queued run of one entry point, all callers requesting the same run
+    subscribe to its events.
+
+    :param job_id: Serial number of the job
+    :type  job_id: int
+    :param    key: The request (entry, task, name)
+    :type     key: tuple"""
+
+    def __init__(self, job_id, key):
+        self.job_id      = job_id
+        self.key         = key
+        self.subscribers = []
+        self._lock       = threading.Lock()
+
+    def subscribe(self):
+        """Subscribe to the events of this job.
+
+        :rtype: :py:class:`queue.Queue`"""
+        events = queue.Queue()
+        with self._lock:
+            self.subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        """Stop sending events to a subscriber.
+
+        :param events: Queue returned by :meth:`subscribe`
+        :type  events: :py:class:`queue.Queue`"""
+        with self._lock:
+            if events in self.subscribers:
+                self.subscribers.remove(events)
+
+    def emit(self, event, **kwargs):
+        """Send an event to all subscribers.
+
+        :param event: Name of the event
+        :type  event: str"""
+        kwargs['event'] = event
+        kwargs['job']   = self.job_id
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for events in subscribers:
+            events.put(kwargs)
+
+
+class JobQueue(object):
+    """Queue of jobs, identical jobs are coalesced as long as they haven't
+    been started."""
+
+    def __init__(self):
+        self._pending = collections.OrderedDict()
+        self._serial  = 0
+        self._cond    = threading.Condition()
+
+    def submit(self, key):
+        """Queue a job for the request *key* or join the identical job already
+        waiting.
+
+        :param key: The request (entry, task, name)
+        :type  key: tuple
+        :rtype:     (Job, :py:class:`queue.Queue`, bool)"""
+        with self._cond:
+            job = self._pending.get(key)
+            coalesced = job is not None
+            if not coalesced:
+                self._serial += 1
+                job = Job(self._serial, key)
+                self._pending[key] = job
+            events = job.subscribe()
+            job.emit('queued', coalesced=coalesced)
+            self._cond.notify()
+        return job, events, coalesced
+
+    def take(self, timeout=None):
+        """Remove the oldest job from the queue, identical requests submitted
+        afterwards will start a new job.
+
+        :param timeout: Seconds to wait for a job, None waits forever
+        :type  timeout: float
+        :rtype:         Job or None"""
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+            if not self._pending:
+                return None
+            _, job = self._pending.popitem(last=False)
+            return job
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+
+def parse_request(line):
+    """Parse and validate a request line.
+
+    :param line: JSON encoded request
+    :type  line: bytes
+    :rtype:      tuple"""
+    try:
+        request = json.loads(line.decode("UTF-8"))
+    except ValueError:
+        raise ValueError("Request is not valid JSON")
+    if not hasattr(request, 'items'):
+        raise ValueError("Request must be a JSON object")
+    entry = request.get('entry')
+    task  = request.get('task')
+    name  = request.get('name', 'all')
+    if entry not in entries:
+        raise ValueError("Unknown entry: %s" % entry)
+    if task not in entries[entry][2]:
+        raise ValueError("Unknown task for %s: %s" % (entry, task))
+    return (entry, task, str(name))
+
+
+def remove_stale_socket(path):
+    """Remove the socket left behind by a server that is gone. Raises if a
+    server still listens on it.
+
+    :param path: Path of the unix socket
+    :type  path: str"""
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        lg.debug('Removing stale control socket %s', path)
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+    raise socket.error(
+        errno.EADDRINUSE, "Control socket %s is in use" % path
+    )
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Reads a request, queues it and streams the events back."""
+
+    def handle(self):
+        try:
+            key = parse_request(self.rfile.readline())
+        except ValueError as e:
+            self.send({'event': 'error', 'message': e.args[0]})
+            return
+        job, events, _ = self.server.jobs.submit(key)
+        try:
+            while True:
+                event = events.get()
+                self.send(event)
+                if event['event'] == 'finished':
+                    break
+        except socket.error:
+            lg.debug('Control client of job %s went away', job.job_id)
+        finally:
+            job.unsubscribe(events)
+
+    def send(self, event):
+        """Write an event as JSON line to the client.
+
+        :param event: The event
+        :type  event: dict"""
+        line = json.dumps(event, sort_keys=True) + "\n"
+        self.wfile.write(line.encode("UTF-8"))
+        self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+    """Control socket server, executing the queued jobs in a worker thread.
+
+    :param       path: Path of the unix socket
+    :type        path: str
+    :param cfg_path: Path of the config, reloaded when it changes
+    :type  cfg_path: str
+    :param        cfg: The configuration yml as dict
+    :type         cfg: dict
+    :param       args: The command-line arguments of the server
+    :type        args: namespace
+    :param read_state: Called before every job to refresh the system state
+    :type  read_state: callable"""
+
+    daemon_threads = True
+
+    def __init__(self, path, cfg_path, cfg, args, read_state=None):
+        remove_stale_socket(path)
+        socketserver.ThreadingUnixStreamServer.__init__(
+            self, path, ControlHandler
+        )
+        self.path       = path
+        self.cfg_path   = cfg_path
+        self.cfg        = cfg
+        self.cfg_mtime  = self._config_mtime()
+        self.args       = args
+        self.read_state = read_state or state.read
+        self.jobs       = JobQueue()
+        self._stop      = threading.Event()
+        self._worker    = threading.Thread(target=self._work)
+        self._worker.daemon = True
+        self._worker.start()
+        lg.info('Listening on control socket %s', path)
+
+    def _config_mtime(self):
+        try:
+            return os.stat(self.cfg_path).st_mtime
+        except OSError:
+            return None
+
+    def config(self):
+        """Return the config, reloading it if the file has changed.
+
+        :rtype: dict"""
+        mtime = self._config_mtime()
+        if mtime != self.cfg_mtime:
+            lg.info('Reloading changed config %s', self.cfg_path)
+            self.cfg       = load_config(self.cfg_path)
+            self.cfg_mtime = mtime
+        return self.cfg
+
+    def run_job(self, job):
+        """Execute a job and stream the progress of its commands.
+
+        :param job: The job to execute
+        :type  job: Job"""
+        entry, task, name = job.key
+        func, name_arg, _ = entries[entry]
+        args = argparse.Namespace(
+            task    = task,
+            debug   = self.args.debug,
+            pretend = self.args.pretend,
+        )
+        setattr(args, name_arg, name)
+
+        def observer(command, event, error):
+            """Forward command events to the subscribers of the job."""
+            job.emit('command', state=event, command=command.describe())
+
+        job.emit('started')
+        Command.observers.append(observer)
+        lock = None
+        try:
+            cfg = self.config()
+            if not self.args.pretend:
+                lock = runlock.RunLock(
+                    runlock.aptly_root(),
+                    getattr(self.args, 'lock_timeout', None),
+                )
+                if not lock.acquire({
+                        'config': os.path.abspath(self.cfg_path),
+                        'entry':  entry,
+                        'task':   task,
+                        'name':   name,
+                }):
+                    lock = None
+                    job.emit('finished', status='coalesced')
+                    return
+            self.read_state()
+            func(cfg, args)
+        except Exception as e:
+            lg.exception('Job %s %s failed', job.job_id, job.key)
+            job.emit('finished', status='failed', error=str(e))
+        else:
+            job.emit('finished', status='ok')
+        finally:
+            if lock is not None:
+                lock.release()
+            Command.observers.remove(observer)
+
+    def _work(self):
+        while not self._stop.is_set():
+            job = self.jobs.take(timeout=1)
+            if job is not None:
+                self.run_job(job)
+
+    def shutdown_worker(self):
+        """Stop the worker and remove the socket."""
+        self._stop.set()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def request(path, entry, task, name='all'):
+    """Send a request to a control socket and yield the events of the run.
+
+    :param  path: Path of the unix socket
+    :type   path: str
+    :param entry: One of mirror, snapshot, publish or repo
+    :type  entry: str
+    :param  task: The task, ie. update
+    :type   task: str
+    :param  name: Name of the entity or "all"
+    :type   name: str
+    :rtype:       generator"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        data = json.dumps({'entry': entry, 'task': task, 'name': name})
+        sock.sendall(data.encode("UTF-8") + b"\n")
+        reader = sock.makefile('rb')
+        for line in reader:
+            yield json.loads(line.decode("UTF-8"))
+    finally:
+        sock.close()
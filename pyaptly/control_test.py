@@ -0,0 +1,188 @@
+"""Testing the control socket"""
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import pytest
+
+from . import Command, FunctionCommand, control, runlock
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+
+def test_job_queue_coalesce():
+    """Test if identical waiting requests are coalesced."""
+    jobs = control.JobQueue()
+    key = ('publish', 'update', 'all')
+    results = [jobs.submit(key) for _ in range(3)]
+    assert [coalesced for _, _, coalesced in results] == [False, True, True]
+    assert len(set([job.job_id for job, _, _ in results])) == 1
+    other, _, coalesced = jobs.submit(('snapshot', 'create', 'all'))
+    assert not coalesced
+    assert len(jobs) == 2
+    assert jobs.take() is results[0][0]
+    again, _, coalesced = jobs.submit(key)
+    assert not coalesced
+    assert again is not results[0][0]
+
+
+def test_parse_request():
+    """Test if invalid requests are rejected."""
+    assert control.parse_request(
+        b'{"entry": "repo", "task": "create"}'
+    ) == ('repo', 'create', 'all')
+    assert control.parse_request(
+        b'{"entry": "publish", "task": "rollback", "name": "ubuntu"}'
+    ) == ('publish', 'rollback', 'ubuntu')
+    assert control.parse_request(
+        b'{"entry": "repo", "task": "add"}'
+    ) == ('repo', 'add', 'all')
+    for line in [b'nope', b'[]', b'{"entry": "repo", "task": "update"}']:
+        error = False
+        try:
+            control.parse_request(line)
+        except ValueError:
+            error = True
+        assert error
+
+
+def wait_for(condition, timeout=10):
+    """Wait until condition() is true."""
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_control_socket():
+    """Test if triggers are queued, coalesced and their progress is
+    streamed."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "control.sock")
+    started = threading.Event()
+    block = threading.Event()
+    runs = []
+
+    def fake_publish(cfg, args):
+        started.set()
+        block.wait(10)
+        runs.append(args.publish_name)
+        FunctionCommand(len, "abc").execute()
+
+    args = argparse.Namespace(debug=False, pretend=False)
+    server = control.ControlServer(
+        path, path, {}, args, read_state=lambda: None
+    )
+    serving = threading.Thread(target=server.serve_forever)
+    serving.daemon = True
+    serving.start()
+    Command.pretend_mode = False
+    results = []
+
+    def trigger(name):
+        results.append(list(control.request(path, 'publish', 'update', name)))
+
+    def subscribers():
+        pending = list(server.jobs._pending.values())
+        return pending and len(pending[0].subscribers) == 5
+
+    clients = [threading.Thread(target=trigger, args=('first', ))] + [
+        threading.Thread(target=trigger, args=('second', ))
+        for _ in range(5)
+    ]
+    try:
+        with mock.patch.dict(control.entries, {
+                'publish': (fake_publish, 'publish_name', ('update', ))
+        }), mock.patch.object(runlock, 'aptly_root', lambda: directory):
+            clients[0].start()
+            assert started.wait(10)
+            for client in clients[1:]:
+                client.start()
+            wait_for(subscribers)
+            block.set()
+            for client in clients:
+                client.join(10)
+    finally:
+        server.shutdown()
+        server.shutdown_worker()
+        shutil.rmtree(directory)
+
+    assert runs == ['first', 'second']
+    assert len(results) == 6
+    second = [events for events in results if events[0]['job'] != 1]
+    assert len(second) == 5
+    assert len(set([events[0]['job'] for events in second])) == 1
+    assert [events[0]['coalesced'] for events in second].count(False) == 1
+    for events in results:
+        assert events[-1]['status'] == 'ok'
+        assert [e['state'] for e in events if e['event'] == 'command'] == [
+            'started', 'finished'
+        ]
+
+
+def test_control_socket_lock():
+    """Test if a job waits for a run holding the lock of the aptly root."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "control.sock")
+    started = threading.Event()
+
+    def fake_publish(cfg, args):
+        started.set()
+
+    args = argparse.Namespace(debug=False, pretend=False, lock_timeout=None)
+    server = control.ControlServer(
+        path, path, {}, args, read_state=lambda: None
+    )
+    serving = threading.Thread(target=server.serve_forever)
+    serving.daemon = True
+    serving.start()
+    held = runlock.RunLock(directory)
+    assert held.acquire({'entry': 'mirror', 'task': 'update', 'name': 'all'})
+    results = []
+    client = threading.Thread(target=lambda: results.append(
+        list(control.request(path, 'publish', 'update'))
+    ))
+    try:
+        with mock.patch.dict(control.entries, {
+                'publish': (fake_publish, 'publish_name', ('update', ))
+        }), mock.patch.object(runlock, 'aptly_root', lambda: directory):
+            client.start()
+            assert not started.wait(1)
+            held.release()
+            assert started.wait(10)
+            client.join(10)
+    finally:
+        held.release()
+        server.shutdown()
+        server.shutdown_worker()
+        shutil.rmtree(directory)
+    assert results[0][-1]['status'] == 'ok'
+
+
+def test_stale_socket():
+    """Test if only the socket of a server that is gone is replaced."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "control.sock")
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    args = argparse.Namespace(debug=False, pretend=True)
+    try:
+        server = control.ControlServer(
+            path, path, {}, args, read_state=lambda: None
+        )
+        with pytest.raises(socket.error):
+            control.ControlServer(
+                path, path, {}, args, read_state=lambda: None
+            )
+        assert os.path.exists(path)
+        server.shutdown_worker()
+    finally:
+        shutil.rmtree(directory)
@@ -4,8 +4,14 @@ import datetime
 import os.path
 import sys
 
-from . import (date_round_daily, date_round_weekly, iso_to_gregorian,  # noqa
-               snapshot_spec_to_name, test, time_delta_helper, time_remove_tz)
+from . import (SystemStateReader, date_round_daily,  # noqa
+               date_round_weekly, iso_to_gregorian, snapshot_spec_to_name,
+               test, time_delta_helper, time_remove_tz)
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
 
 _test_base = os.path.dirname(
     os.path.abspath(__file__)
@@ -19,7 +25,6 @@ if not sys.version_info < (2, 7):  # pragma: no cover
 
 
 if sys.version_info < (2, 7):  # pragma: no cover
-    import mock
     given = mock.MagicMock()  # noqa
     datetimes = mock.MagicMock()  # noqa
     times = mock.MagicMock()  # noqa
@@ -202,8 +207,12 @@ def test_snapshot_spec_to_name():
 
         snaps = tyml['snapshot']['superfake-%T']['merge']
 
-        rounded1 = snapshot_spec_to_name(tyml, snaps[0])
-        rounded2 = snapshot_spec_to_name(tyml, snaps[1])
+        # "previous" resolves to an existing snapshot
+        state = SystemStateReader()
+        state.snapshots = set(['fakerepo01-20121009T0000Z'])
+        with mock.patch('pyaptly.state', state):
+            rounded1 = snapshot_spec_to_name(tyml, snaps[0])
+            rounded2 = snapshot_spec_to_name(tyml, snaps[1])
 
         assert rounded1 == 'fakerepo01-20121009T0000Z'
         assert rounded2 == 'fakerepo02-20121006T0000Z'
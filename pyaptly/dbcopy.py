@@ -0,0 +1,286 @@
+"""Read-only copies of the aptly database.
+
+aptly keeps its database in ``<rootDir>/db``, a LevelDB only one process can
+open at a time. While a long ``aptly mirror update`` runs, every other aptly
+command waits for or fails on its lock, even the list and show commands
+pyaptly reads the state with. With ``--state-copy`` pretend and plan runs
+read the state from a copy of the database instead, through an aptly config
+whose ``rootDir`` is the copy, passed with ``-config``. The native reader of
+:mod:`pyaptly.aptlydb` reads a copy too.
+
+The tables of a LevelDB are never changed once written, they are hardlinked
+into the copy. The manifest, the journals and CURRENT are appended to or
+replaced by the writer, they are reflinked where the filesystem supports it
+and copied otherwise. The files are copied in the order the writer creates
+them (CURRENT, manifests, tables, journals), the directory is listed again
+before each group. A compaction adds tables and appends to the manifest
+before it removes the old tables, so a file removed while it is copied, or a
+manifest or table set differing after the copy from before it, makes the copy
+start again, at most :data:`copy_attempts` times. Writes to the journal don't
+make the copy start again, the copy is the state when it was taken and may
+miss the last writes of a running writer.
+
+Copies are kept per fingerprint of the source (names, sizes and modification
+times of the files and the aptly config), a later run reuses the copy while
+the source is unchanged. The :data:`keep` most recently used copies are
+kept, so runs still reading an older copy aren't disturbed.
+"""
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+
+from . import lg, runlock
+
+# Attempts to copy a database changing while it is copied
+copy_attempts = 3
+
+# Copies kept in the copy directory
+keep = 2
+
+# Files of a LevelDB that are never changed once written
+table_extensions = ('.ldb', '.sst')
+
+# Files of the process having the database open, they aren't copied
+skipped_files = ('LOCK', 'LOG', 'LOG.old')
+
+# ioctl cloning a file on Linux, see ioctl_ficlone(2)
+ficlone = 0x40049409
+
+
+def source_config():
+    """Return the aptly config, read from ~/.aptly.conf or /etc/aptly.conf
+    like aptly does, empty if neither exists.
+
+    :rtype: dict"""
+    for path in (os.path.expanduser('~/.aptly.conf'), '/etc/aptly.conf'):
+        if os.path.exists(path):
+            with open(path) as conf:
+                return json.load(conf)
+    return {}
+
+
+def fingerprint(db, config):
+    """Return the fingerprint of a database and the aptly config.
+
+    :param     db: Directory of the database
+    :type      db: str
+    :param config: The aptly config
+    :type  config: dict
+    :rtype:        str"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(config, sort_keys=True).encode("UTF-8"))
+    for name in sorted(os.listdir(db)):
+        if name in skipped_files:
+            continue
+        try:
+            stat = os.stat(os.path.join(db, name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:  # pragma: no cover
+                raise
+            continue
+        digest.update((
+            "%s %d %d\n" % (name, stat.st_size, int(stat.st_mtime * 1e6))
+        ).encode("UTF-8"))
+    return digest.hexdigest()
+
+
+def source_fingerprint(root=None, config=None):
+    """Return the fingerprint of the database of aptly, None if there is no
+    database.
+
+    :param   root: Root directory of aptly, default
+                   :func:`pyaptly.runlock.aptly_root`
+    :type    root: str
+    :param config: The aptly config, default :func:`source_config`
+    :type  config: dict
+    :rtype:        str"""
+    if root is None:
+        root = runlock.aptly_root()
+    if config is None:
+        config = source_config()
+    db = os.path.join(root, 'db')
+    if not os.path.isdir(db):
+        return None
+    return fingerprint(db, config)
+
+
+def copy_group(name):
+    """Return the group of a file of a database, the groups are copied in
+    order.
+
+    :param name: Name of the file
+    :type  name: str
+    :rtype:      int"""
+    if name == 'CURRENT':
+        return 0
+    if name.startswith('MANIFEST-'):
+        return 1
+    if name.endswith(table_extensions):
+        return 2
+    return 3
+
+
+def reflink(source, target):
+    """Clone a file sharing its blocks, return False if the filesystem
+    doesn't support it.
+
+    :param source: Path of the file
+    :type  source: str
+    :param target: Path of the clone
+    :type  target: str
+    :rtype:        bool"""
+    with open(source, 'rb') as src:
+        with open(target, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+                return True
+            except (IOError, OSError):
+                return False
+
+
+def copy_file(source, target):
+    """Copy a file of a database, tables are hardlinked, other files
+    reflinked or copied.
+
+    :param source: Path of the file
+    :type  source: str
+    :param target: Path of the copy
+    :type  target: str"""
+    if source.endswith(table_extensions):
+        try:
+            os.link(source, target)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    if not reflink(source, target):
+        shutil.copyfile(source, target)
+
+
+def layout(db):
+    """Return the names and sizes of the files of a database a compaction
+    changes: CURRENT, the manifests and the tables.
+
+    :param db: Directory of the database
+    :type  db: str
+    :rtype:    list"""
+    files = []
+    for name in sorted(os.listdir(db)):
+        if name in skipped_files or copy_group(name) > 2:
+            continue
+        try:
+            files.append((name, os.path.getsize(os.path.join(db, name))))
+        except OSError as e:
+            if e.errno != errno.ENOENT:  # pragma: no cover
+                raise
+    return files
+
+
+def copy_db(db, target):
+    """Copy a database, return False if the copy is incomplete or the
+    database was compacted while it was copied.
+
+    :param     db: Directory of the database
+    :type      db: str
+    :param target: Directory of the copy, it is created
+    :type  target: str
+    :rtype:        bool"""
+    os.makedirs(target)
+    before = layout(db)
+    for group in range(4):
+        for name in sorted(os.listdir(db)):
+            if name in skipped_files or copy_group(name) != group:
+                continue
+            try:
+                copy_file(os.path.join(db, name), os.path.join(target, name))
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                lg.debug('%s vanished while copying %s', name, db)
+                return False
+    current = os.path.join(target, 'CURRENT')
+    if not os.path.exists(current):
+        return False
+    with open(current) as f:
+        manifest = f.read().strip()
+    if not os.path.exists(os.path.join(target, manifest)):
+        return False
+    if layout(db) != before:
+        lg.debug('%s was compacted while copying it', db)
+        return False
+    return True
+
+
+def cleanup(directory):
+    """Remove all but the :data:`keep` most recently used copies.
+
+    :param directory: The copy directory
+    :type  directory: str"""
+    copies = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        # Copies in progress have the pid appended
+        if '.' not in name and os.path.isdir(path):
+            copies.append((os.path.getmtime(path), path))
+    for _, path in sorted(copies, reverse=True)[keep:]:
+        lg.debug('Removing copy of the aptly database %s', path)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def prepare(directory, root=None, config=None):
+    """Return the path of the aptly config of an up to date copy of the
+    database, None if no complete copy could be taken.
+
+    :param directory: Directory the copies are kept in
+    :type  directory: str
+    :param      root: Root directory of aptly, default
+                      :func:`pyaptly.runlock.aptly_root`
+    :type       root: str
+    :param    config: The aptly config, default :func:`source_config`
+    :type     config: dict
+    :rtype:           str"""
+    if root is None:
+        root = runlock.aptly_root()
+    if config is None:
+        config = source_config()
+    db = os.path.join(root, 'db')
+    if not os.path.isdir(db):
+        lg.warning('No aptly database to copy in %s', root)
+        return None
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for _ in range(copy_attempts):
+        path = os.path.join(directory, fingerprint(db, config)[:16])
+        conf = os.path.join(path, 'aptly.conf')
+        if os.path.exists(conf):
+            lg.debug('Reusing copy of the aptly database %s', path)
+            os.utime(path, None)
+            return conf
+        temp = '%s.%d' % (path, os.getpid())
+        shutil.rmtree(temp, ignore_errors=True)
+        try:
+            complete = copy_db(db, os.path.join(temp, 'db'))
+            if complete:
+                copy_config = dict(config)
+                copy_config['rootDir'] = path
+                with open(os.path.join(temp, 'aptly.conf'), 'w') as f:
+                    json.dump(copy_config, f, indent=2)
+                try:
+                    os.rename(temp, path)
+                except OSError:
+                    # Another run took the same copy
+                    pass
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+        if complete:
+            lg.info('Copied aptly database %s to %s', db, path)
+            cleanup(directory)
+            return conf
+    lg.warning(
+        'Aptly database %s changed while copying it %d times',
+        db, copy_attempts
+    )
+    return None
@@ -0,0 +1,147 @@
+"""Testing the copies of the aptly database"""
+import errno
+import json
+import os
+import shutil
+import tempfile
+
+from . import SystemStateReader, aptlydb, dbcopy, runlock
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+db_files = {
+    'CURRENT':         'MANIFEST-000004\n',
+    'MANIFEST-000004': 'manifest',
+    '000005.ldb':      'table',
+    '000006.log':      'journal',
+    'LOCK':            '',
+    'LOG':             'log',
+}
+
+
+def make_root(directory):
+    """Create a fake aptly root with a database."""
+    root = os.path.join(directory, 'aptly')
+    os.makedirs(os.path.join(root, 'db'))
+    for name, content in db_files.items():
+        with open(os.path.join(root, 'db', name), 'w') as f:
+            f.write(content)
+    return root
+
+
+def test_prepare():
+    """Test if the database is copied, tables hardlinked, and the copy is
+    reused until the database changes."""
+    directory = tempfile.mkdtemp()
+    try:
+        root = make_root(directory)
+        cache = os.path.join(directory, 'dbcopy')
+        config = {'rootDir': root, 'architectures': ['amd64']}
+        conf = dbcopy.prepare(cache, root, config)
+        with open(conf) as f:
+            copy_config = json.load(f)
+        assert copy_config['architectures'] == ['amd64']
+        copy = os.path.join(copy_config['rootDir'], 'db')
+        assert sorted(os.listdir(copy)) == [
+            '000005.ldb', '000006.log', 'CURRENT', 'MANIFEST-000004'
+        ]
+        source = os.path.join(root, 'db')
+        for name, linked in [('000005.ldb', True), ('000006.log', False)]:
+            assert linked == (
+                os.stat(os.path.join(source, name)).st_ino ==
+                os.stat(os.path.join(copy, name)).st_ino
+            )
+        assert dbcopy.prepare(cache, root, config) == conf
+        for index in range(3):
+            with open(os.path.join(source, '000006.log'), 'a') as f:
+                f.write('write %d' % index)
+            assert dbcopy.prepare(cache, root, config) != conf
+        assert len(os.listdir(cache)) == dbcopy.keep
+
+        reader = SystemStateReader()
+        reader.aptly_cmd = ['aptly', '-config=%s' % conf]
+        assert reader.aptly_call(['aptly', 'mirror', 'list']) == [
+            'aptly', '-config=%s' % conf, 'mirror', 'list'
+        ]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_prepare_vanished():
+    """Test if no copy is used when files vanish during every attempt."""
+    directory = tempfile.mkdtemp()
+
+    def vanish(source, target):
+        raise OSError(errno.ENOENT, "No such file", source)
+    try:
+        root = make_root(directory)
+        cache = os.path.join(directory, 'dbcopy')
+        with mock.patch.object(dbcopy, 'copy_file', vanish):
+            assert dbcopy.prepare(cache, root, {}) is None
+        assert os.listdir(cache) == []
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_prepare_compacted():
+    """Test if the copy starts again when the database is compacted while
+    it is copied."""
+    directory = tempfile.mkdtemp()
+    copy_file = dbcopy.copy_file
+    compacted = []
+
+    def compact(source, target):
+        copy_file(source, target)
+        if source.endswith('.ldb') and not compacted:
+            db = os.path.dirname(source)
+            with open(os.path.join(db, '000007.ldb'), 'w') as f:
+                f.write('compacted')
+            with open(os.path.join(db, 'MANIFEST-000004'), 'a') as f:
+                f.write(' edit')
+            compacted.append(source)
+    try:
+        root = make_root(directory)
+        cache = os.path.join(directory, 'dbcopy')
+        with mock.patch.object(dbcopy, 'copy_file', compact):
+            conf = dbcopy.prepare(cache, root, {})
+        with open(conf) as f:
+            copy = os.path.join(json.load(f)['rootDir'], 'db')
+        assert compacted
+        assert '000007.ldb' in os.listdir(copy)
+        with open(os.path.join(copy, 'MANIFEST-000004')) as f:
+            assert f.read() == 'manifest edit'
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_read_database_reused():
+    """Test if the state is only copied and read again when the database
+    changed."""
+    directory = tempfile.mkdtemp()
+    read = {
+        'repos': set(), 'mirrors': set(), 'snapshots': set(['base']),
+        'snapshot_map': {'base': []}, 'publishes': set(), 'publish_map': {},
+    }
+    environ = {'PYAPTLY_STATE_DIR': directory}
+    try:
+        root = make_root(directory)
+        reader = SystemStateReader()
+        with mock.patch.dict(os.environ, environ), \
+                mock.patch.object(runlock, 'aptly_root', lambda: root), \
+                mock.patch.object(dbcopy, 'source_config', dict), \
+                mock.patch.object(dbcopy, 'prepare',
+                                  wraps=dbcopy.prepare) as prepare, \
+                mock.patch.object(aptlydb, 'read', return_value=read):
+            for _ in range(2):
+                assert reader.read_database()
+            assert prepare.call_count == 1
+            assert reader.snapshots == set(['base'])
+            with open(os.path.join(root, 'db', '000006.log'), 'a') as f:
+                f.write('write')
+            assert reader.read_database()
+            assert prepare.call_count == 2
+    finally:
+        shutil.rmtree(directory)
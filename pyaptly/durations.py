@@ -0,0 +1,186 @@
+"""Historical durations of commands, used to schedule the commands on the
+critical path first (see :meth:`pyaptly.Command.order_commands`).
+
+The durations are kept in a small SQLite database in the state directory of
+pyaptly. Commands are identified by their command-line with all timestamps
+replaced by %T, so timestamped snapshots share the history of their template.
+Durations of unknown commands are estimated by the average of their kind or a
+default per kind.
+
+The database is opened when the first command is ordered or executed, see
+:class:`LazyStore`, runs that don't order any command don't touch it.
+"""
+import os
+import re
+import threading
+
+re_timestamp = re.compile(r'\d{8}T\d{4}Z')
+
+# Estimated seconds for commands without history
+default_durations = {
+    'mirror update':    600.0,
+    'publish snapshot': 60.0,
+    'publish repo':     60.0,
+    'publish switch':   60.0,
+    'publish update':   60.0,
+    'function':         0.1,
+}
+default_duration = 5.0
+
+# Weight of the latest duration in the moving average
+smoothing = 0.3
+
+
+def command_identity(cmd):
+    """Return the identity of a command the durations are recorded for.
+
+    :param cmd: The command
+    :type  cmd: :class:`pyaptly.Command`
+    :rtype:     str"""
+    return re_timestamp.sub('%T', cmd.describe())
+
+
+def default_estimate(cmd):
+    """Estimate the duration of a command without any history.
+
+    :param cmd: The command
+    :type  cmd: :class:`pyaptly.Command`
+    :rtype:     float"""
+    return default_durations.get(cmd.kind(), default_duration)
+
+
+class DurationStore(object):
+    """Records durations of commands in a SQLite database.
+
+    :param path: Path of the database
+    :type  path: str"""
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS durations ("
+            "identity TEXT PRIMARY KEY, "
+            "kind TEXT NOT NULL, "
+            "runs INTEGER NOT NULL, "
+            "seconds REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._durations = {}
+        # kind -> [sum of seconds, number of identities]
+        self._kinds = {}
+        for identity, kind, runs, seconds in self._db.execute(
+                "SELECT identity, kind, runs, seconds FROM durations"
+        ):
+            self._set(identity, kind, runs, seconds)
+
+    def _set(self, identity, kind, runs, seconds):
+        old = self._durations.get(identity)
+        totals = self._kinds.setdefault(kind, [0.0, 0])
+        if old is None:
+            totals[1] += 1
+        else:
+            totals[0] -= old[2]
+        totals[0] += seconds
+        self._durations[identity] = (kind, runs, seconds)
+
+    def get(self, cmd):
+        """Return the recorded duration of a command or None.
+
+        :param cmd: The command
+        :type  cmd: :class:`pyaptly.Command`
+        :rtype:     float"""
+        entry = self._durations.get(command_identity(cmd))
+        if entry is None:
+            return None
+        return entry[2]
+
+    def estimate(self, cmd):
+        """Estimate the duration of a command: its recorded duration, the
+        average duration of its kind or the default duration of its kind.
+
+        :param cmd: The command
+        :type  cmd: :class:`pyaptly.Command`
+        :rtype:     float"""
+        seconds = self.get(cmd)
+        if seconds is not None:
+            return seconds
+        totals = self._kinds.get(cmd.kind())
+        if totals is not None:
+            return totals[0] / totals[1]
+        return default_estimate(cmd)
+
+    def record(self, cmd, seconds):
+        """Record the duration of an execution of a command.
+
+        :param     cmd: The command
+        :type      cmd: :class:`pyaptly.Command`
+        :param seconds: Duration of the execution
+        :type  seconds: float"""
+        identity = command_identity(cmd)
+        with self._lock:
+            entry = self._durations.get(identity)
+            if entry is None:
+                runs = 1
+            else:
+                runs = entry[1] + 1
+                seconds = (1 - smoothing) * entry[2] + smoothing * seconds
+            self._set(identity, cmd.kind(), runs, seconds)
+            self._db.execute(
+                "INSERT OR REPLACE INTO durations "
+                "(identity, kind, runs, seconds) VALUES (?, ?, ?, ?)",
+                (identity, cmd.kind(), runs, seconds)
+            )
+            self._db.commit()
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
+
+
+def open_store(directory):
+    """Open the duration store in the given directory.
+
+    :param directory: Directory of the database
+    :type  directory: str
+    :rtype:           DurationStore"""
+    return DurationStore(os.path.join(directory, "durations.sqlite"))
+
+
+class LazyStore(object):
+    """A duration store that is only opened when a duration is estimated or
+    recorded.
+
+    :param directory: Directory of the database
+    :type  directory: str"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._store = None
+        self._lock = threading.Lock()
+
+    def store(self):
+        """Return the store, opening it on first use.
+
+        :rtype: DurationStore"""
+        with self._lock:
+            if self._store is None:
+                self._store = open_store(self.directory)
+            return self._store
+
+    def estimate(self, cmd):
+        """See :meth:`DurationStore.estimate`."""
+        return self.store().estimate(cmd)
+
+    def record(self, cmd, seconds):
+        """See :meth:`DurationStore.record`."""
+        self.store().record(cmd, seconds)
+
+    def close(self):
+        """Close the database if it was opened."""
+        with self._lock:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
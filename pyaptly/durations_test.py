@@ -0,0 +1,65 @@
+"""Testing recorded command durations"""
+import os
+import shutil
+import tempfile
+
+from . import Command, FunctionCommand, durations
+
+
+def test_command_identity():
+    """Test if timestamps are not part of the identity of a command."""
+    cmd = Command([
+        'aptly', 'snapshot', 'create', 'fakerepo01-20121010T0000Z', 'from',
+        'mirror', 'fakerepo01'
+    ])
+    assert durations.command_identity(cmd) == (
+        'aptly snapshot create fakerepo01-%T from mirror fakerepo01'
+    )
+    assert cmd.kind() == 'snapshot create'
+    assert FunctionCommand(len, "a").kind() == 'function'
+    assert Command(['aptly', '-config=x', 'mirror', 'update', 'a']).kind() == (
+        'mirror update'
+    )
+
+
+def test_duration_store():
+    """Test if durations are recorded, averaged and persisted."""
+    directory = tempfile.mkdtemp()
+    try:
+        store = durations.open_store(directory)
+        update = Command(['aptly', 'mirror', 'update', 'ubuntu'])
+        other = Command(['aptly', 'mirror', 'update', 'debian'])
+        merge = Command(['aptly', 'snapshot', 'merge', 'a', 'b'])
+        assert store.get(update) is None
+        assert store.estimate(update) == durations.default_durations[
+            'mirror update'
+        ]
+        assert store.estimate(merge) == durations.default_duration
+        store.record(update, 100.0)
+        assert store.estimate(update) == 100.0
+        assert store.estimate(other) == 100.0
+        store.record(update, 200.0)
+        assert store.estimate(update) == 130.0
+        store.close()
+        store = durations.open_store(directory)
+        assert store.estimate(update) == 130.0
+        store.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_lazy_store():
+    """Test if the database is only opened when a duration is needed."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "durations.sqlite")
+    try:
+        store = durations.LazyStore(directory)
+        update = Command(['aptly', 'mirror', 'update', 'ubuntu'])
+        assert not os.path.exists(path)
+        store.record(update, 100.0)
+        assert os.path.exists(path)
+        assert store.estimate(update) == 100.0
+        store.close()
+        assert durations.LazyStore(directory).estimate(update) == 100.0
+    finally:
+        shutil.rmtree(directory)
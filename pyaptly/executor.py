@@ -0,0 +1,540 @@
+"""Executes ordered commands, enforces their timeouts and reports the run.
+
+A command may have a timeout (maximum run time) and a stall timeout
+(maximum time without any output), see :func:`pyaptly.limit_commands`. A
+command exceeding either is terminated with SIGTERM, and killed with SIGKILL
+if it is still running :data:`kill_grace` seconds later.
+
+When a command fails or times out, the commands depending on it are skipped,
+while unrelated commands continue. The outcome of every command is collected
+in a :class:`RunReport`.
+
+Transient failures (aptly database locked, network and keyserver errors) are
+retried with a jittered exponential backoff, if a :class:`RetryPolicy` is
+set in :attr:`pyaptly.Command.retries`. The failures are classified by
+:func:`classify` from the output and exit status of the command. All commands
+of a run share a retry budget.
+
+Deferred commands (see :attr:`pyaptly.Command.deferred`), like the
+regeneration of the contents indexes of a publish, run after all other
+commands with a lower priority. Until they are finished the report lists them
+as pending.
+"""
+import collections
+import os
+import random
+import re
+import select
+import subprocess
+import sys
+import time
+
+from . import Command, lg
+
+# Seconds a terminated process gets to exit before it is killed
+kill_grace = 10.0
+
+# Seconds between checks of the timeouts
+poll_interval = 1.0
+
+# Niceness of deferred commands
+deferred_niceness = 10
+
+# Bytes of output kept to classify failures
+output_tail = 8192
+
+# Transient failures by class, matched against the output of a command
+failure_patterns = [
+    ('lock', re.compile(
+        r"database is locked|resource temporarily unavailable|"
+        r"unable to (?:open|lock) database",
+        re.IGNORECASE,
+    )),
+    ('network', re.compile(
+        r"connection (?:refused|reset|timed out)|i/o timeout|"
+        r"no route to host|network is unreachable|"
+        r"temporary failure in name resolution|TLS handshake timeout|"
+        r"HTTP code 5\d\d|unexpected EOF",
+        re.IGNORECASE,
+    )),
+    ('gpg', re.compile(
+        r"keyserver (?:receive failed|communications error|timed out)|"
+        r"no keyserver available|can't connect to the agent",
+        re.IGNORECASE,
+    )),
+]
+
+# Transient failures by class, for commands whose output isn't captured
+failure_exit_codes = {
+    'gpg': ('gpg', (2, )),
+}
+
+
+class CommandTimeout(subprocess.CalledProcessError):
+    """Raised when a command exceeded its timeout or stall timeout.
+
+    :param returncode: Exit status of the terminated process
+    :type  returncode: int
+    :param        cmd: The command
+    :type         cmd: list
+    :param     reason: "timed out" or "stalled"
+    :type      reason: str
+    :param    seconds: The exceeded timeout
+    :type     seconds: float"""
+
+    def __init__(self, returncode, cmd, reason, seconds):
+        super(CommandTimeout, self).__init__(returncode, cmd)
+        self.reason  = reason
+        self.seconds = seconds
+
+    def __str__(self):
+        return "Command '%s' %s after %s seconds" % (
+            " ".join(self.cmd), self.reason, self.seconds
+        )
+
+
+def stop_process(process, grace=None):
+    """Terminate a process, kill it if it doesn't exit in time.
+
+    :param process: The process
+    :type  process: :py:class:`subprocess.Popen`
+    :param   grace: Seconds to wait before killing the process
+    :type    grace: float
+    :rtype:         int"""
+    if grace is None:
+        grace = kill_grace
+    if process.poll() is not None:
+        return process.returncode
+    process.terminate()
+    deadline = time.time() + grace
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if process.poll() is None:
+        lg.warning('Killing process %s, it ignored SIGTERM', process.pid)
+        process.kill()
+    return process.wait()
+
+
+def output_stream():
+    """Return the binary stream the output of commands is passed to."""
+    return getattr(sys.stdout, 'buffer', sys.stdout)
+
+
+def lower_priority(niceness):
+    """Return a function lowering the priority of a process before it
+    executes, for the preexec_fn of :py:class:`subprocess.Popen`.
+
+    :param niceness: Increment of the niceness, None keeps the priority
+    :type  niceness: int
+    :rtype:          function"""
+    if not niceness:
+        return None
+
+    def preexec():
+        os.nice(niceness)
+    return preexec
+
+
+def run_monitored(args, timeout=None, stall_timeout=None, preexec_fn=None,
+                  observer=None):
+    """Run a process, passing its output through, and stop it if it exceeds
+    timeout or doesn't produce output for stall_timeout seconds.
+
+    :param          args: Command to execute
+    :type           args: list
+    :param       timeout: Seconds the process may run, None for no limit
+    :type        timeout: float
+    :param stall_timeout: Seconds the process may be silent, None for no
+                          limit
+    :type  stall_timeout: float
+    :param    preexec_fn: Prepares the process before it executes, see
+                          :meth:`pyaptly.Command.preexec`
+    :type     preexec_fn: function
+    :param      observer: Called with every chunk of output
+    :type       observer: function
+    :rtype:               int"""
+    lg.debug(
+        'Running command: %s (timeout %s, stall timeout %s)',
+        " ".join(args), timeout, stall_timeout
+    )
+    process = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        preexec_fn=preexec_fn,
+    )
+    out = output_stream()
+    fd = process.stdout.fileno()
+    start = last_output = time.time()
+    tail = b""
+    try:
+        while True:
+            readable, _, _ = select.select([fd], [], [], poll_interval)
+            if readable:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                out.write(data)
+                out.flush()
+                tail = (tail + data)[-output_tail:]
+                if observer is not None:
+                    observer(data)
+                last_output = time.time()
+            now = time.time()
+            if timeout is not None and now - start > timeout:
+                returncode = stop_process(process)
+                raise with_output(
+                    CommandTimeout(returncode, args, "timed out", timeout),
+                    tail,
+                )
+            if (
+                    stall_timeout is not None and
+                    now - last_output > stall_timeout
+            ):
+                returncode = stop_process(process)
+                raise with_output(
+                    CommandTimeout(returncode, args, "stalled", stall_timeout),
+                    tail,
+                )
+    except BaseException:
+        stop_process(process)
+        raise
+    finally:
+        process.stdout.close()
+    returncode = process.wait()
+    if returncode != 0:
+        raise with_output(
+            subprocess.CalledProcessError(returncode, args), tail
+        )
+    return returncode
+
+
+def with_output(error, output):
+    """Attach the tail of the output of a failed command to its error, so the
+    failure can be classified.
+
+    :param  error: The error
+    :type   error: :py:class:`subprocess.CalledProcessError`
+    :param output: Output of the command
+    :type  output: bytes
+    :rtype:        :py:class:`subprocess.CalledProcessError`"""
+    error.output = output.decode("UTF-8", "replace")
+    return error
+
+
+def classify(error):
+    """Return the class of a transient failure ("lock", "network" or "gpg"),
+    or None if the failure is permanent.
+
+    A stalled command is considered a network failure, a command that timed
+    out is not retried.
+
+    :param error: The exception raised by the command
+    :type  error: Exception
+    :rtype:       str"""
+    if isinstance(error, CommandTimeout):
+        if error.reason == "stalled":
+            return 'network'
+        return None
+    if not isinstance(error, subprocess.CalledProcessError):
+        return None
+    output = getattr(error, 'output', None)
+    if output:
+        for class_, pattern in failure_patterns:
+            if pattern.search(output):
+                return class_
+        return None
+    cmd = error.cmd
+    if isinstance(cmd, (list, tuple)) and cmd:
+        program = os.path.basename(str(cmd[0]))
+        for class_, (name, codes) in failure_exit_codes.items():
+            if program == name and error.returncode in codes:
+                return class_
+    return None
+
+
+class RetryPolicy(object):
+    """How often and how long to wait before transient failures are retried.
+
+    The n-th retry waits a random time between the half and the full
+    delay * 2 ** (n - 1) seconds, at most max_delay seconds.
+
+    :param     tries: Attempts per command, including the first one
+    :type      tries: int
+    :param     delay: Seconds to wait before the first retry
+    :type      delay: float
+    :param max_delay: Maximum seconds to wait before a retry
+    :type  max_delay: float
+    :param    budget: Maximum number of retries of all commands of a run
+    :type     budget: int"""
+
+    def __init__(self, tries=3, delay=5.0, max_delay=300.0, budget=10):
+        self.tries     = tries
+        self.delay     = delay
+        self.max_delay = max_delay
+        self.budget    = budget
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a policy from the "retries" config.
+
+        :param config: The "retries" config
+        :type  config: dict
+        :rtype:        RetryPolicy"""
+        unknown = set(config) - set(['tries', 'delay', 'max-delay', 'budget'])
+        if unknown:
+            raise ValueError(
+                "Unknown retries config: %s" % ", ".join(sorted(unknown))
+            )
+        policy = cls(
+            tries=config.get('tries', 3),
+            delay=config.get('delay', 5.0),
+            max_delay=config.get('max-delay', 300.0),
+            budget=config.get('budget', 10),
+        )
+        if policy.tries < 1:
+            raise ValueError("retries: tries must be at least 1")
+        return policy
+
+    def backoff(self, attempt):
+        """Return the seconds to wait before the retry following attempt.
+
+        :param attempt: The failed attempt, starting at 1
+        :type  attempt: int
+        :rtype:         float"""
+        delay = min(self.max_delay, self.delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_delay(policy, report, cmd, error, attempt):
+    """Decide if a failed command is retried. Return the seconds to wait
+    before retrying and record the retry, or None if the command failed.
+
+    :param  policy: The retry policy, None never retries
+    :type   policy: RetryPolicy
+    :param  report: Report of the run, holds the retries so far
+    :type   report: RunReport
+    :param     cmd: The failed command
+    :type      cmd: :class:`pyaptly.Command`
+    :param   error: The exception raised by the command
+    :type    error: Exception
+    :param attempt: The failed attempt, starting at 1
+    :type  attempt: int
+    :rtype:         float"""
+    if policy is None or attempt >= policy.tries:
+        return None
+    class_ = classify(error)
+    if class_ is None:
+        return None
+    if report.retry_count() >= policy.budget:
+        lg.warning(
+            'Retry budget of %d exhausted, not retrying: %s',
+            policy.budget, cmd.describe()
+        )
+        return None
+    delay = policy.backoff(attempt)
+    report.record_retry(cmd, class_)
+    lg.warning(
+        'Command failed (%s error), retrying in %.1f seconds: %s',
+        class_, delay, cmd.describe()
+    )
+    return delay
+
+
+class RunReport(object):
+    """Outcome of the commands of a run."""
+
+    def __init__(self):
+        self.results = collections.OrderedDict()
+        self.retries = {}
+
+    def record(self, cmd, status, error=None):
+        """Record the outcome of a command.
+
+        :param    cmd: The command
+        :type     cmd: :class:`pyaptly.Command`
+        :param status: finished, pretended, failed, timeout or skipped
+        :type  status: str
+        :param  error: The exception that made the command fail
+        :type   error: Exception"""
+        self.results[cmd] = (status, error)
+
+    def record_retry(self, cmd, class_):
+        """Record a retry of a command.
+
+        :param    cmd: The command
+        :type     cmd: :class:`pyaptly.Command`
+        :param class_: Class of the transient failure, see :func:`classify`
+        :type  class_: str"""
+        self.retries[cmd] = self.retries.get(cmd, 0) + 1
+
+    def retry_count(self):
+        """Return the number of retries of the run.
+
+        :rtype: int"""
+        return sum(self.retries.values())
+
+    def status(self, cmd):
+        """Return the status of a command or None if it hasn't completed.
+
+        :param cmd: The command
+        :type  cmd: :class:`pyaptly.Command`
+        :rtype:     str"""
+        return self.results.get(cmd, (None, None))[0]
+
+    def counts(self):
+        """Return the number of commands per status.
+
+        :rtype: dict"""
+        counts = {}
+        for status, _ in self.results.values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def pending(self):
+        """Return the deferred commands that didn't finish.
+
+        :rtype: list"""
+        return [
+            cmd for cmd, (status, _) in self.results.items()
+            if cmd.deferred and status not in ('finished', 'pretended')
+        ]
+
+    def errors(self):
+        """Return the exceptions of the failed commands in order.
+
+        :rtype: list"""
+        return [
+            error for status, error in self.results.values()
+            if error is not None
+        ]
+
+    def summary(self):
+        """Return a one line summary of the run.
+
+        :rtype: str"""
+        counts = self.counts()
+        parts = [
+            "%d %s" % (counts[status], status) for status in sorted(counts)
+        ]
+        pending = {}
+        for cmd in self.pending():
+            pending[cmd.deferred] = pending.get(cmd.deferred, 0) + 1
+        for label in sorted(pending):
+            parts.append("%d %s pending" % (pending[label], label))
+        retries = self.retry_count()
+        if retries:
+            parts.append("%d %s" % (
+                retries, "retry" if retries == 1 else "retries"
+            ))
+        return ", ".join(parts) or "nothing to do"
+
+    def log(self):
+        """Log the failed and skipped commands and the summary."""
+        for cmd, (status, error) in self.results.items():
+            if status in ('failed', 'timeout'):
+                lg.error('Command %s: %s', status, error)
+                if cmd in self.retries:
+                    lg.error(
+                        'Command was retried %d times: %s',
+                        self.retries[cmd], cmd.describe()
+                    )
+            elif status == 'skipped':
+                lg.warning(
+                    'Command skipped, a dependency failed: %s', cmd.describe()
+                )
+        for cmd in self.pending():
+            lg.warning('%s pending: %s', cmd.deferred, cmd.describe())
+        lg.info('Run finished: %s', self.summary())
+        if Command.progress is not None:
+            Command.progress.log()
+
+    def raise_errors(self):
+        """Raise the error of the first failed command, if any."""
+        errors = self.errors()
+        if errors:
+            raise errors[0]
+
+
+def outcome(error):
+    """Return the status of a command that raised error.
+
+    :param error: The exception
+    :type  error: Exception
+    :rtype:       str"""
+    if isinstance(error, CommandTimeout):
+        return 'timeout'
+    return 'failed'
+
+
+def execute_retrying(cmd, policy, report):
+    """Execute a command, retrying transient failures. Return the exception
+    of the last attempt if the command failed, else None.
+
+    :param    cmd: The command
+    :type     cmd: :class:`pyaptly.Command`
+    :param policy: Retry policy, None doesn't retry
+    :type  policy: RetryPolicy
+    :param report: Report of the run, the retries are recorded in it
+    :type  report: RunReport
+    :rtype:        Exception"""
+    attempt = 1
+    while True:
+        try:
+            cmd.execute()
+        except Exception as e:
+            delay = retry_delay(policy, report, cmd, e, attempt)
+            if delay is None:
+                return e
+            time.sleep(delay)
+            attempt += 1
+        else:
+            return None
+
+
+def split_deferred(commands):
+    """Move the deferred commands behind the other commands, keeping their
+    order otherwise.
+
+    :param commands: Ordered commands
+    :type  commands: list
+    :rtype:          list"""
+    return (
+        [cmd for cmd in commands if not cmd.deferred] +
+        [cmd for cmd in commands if cmd.deferred]
+    )
+
+
+def execute_commands(commands, has_dependency_cb=lambda x: False):
+    """Execute ordered commands one after another. Transient failures are
+    retried according to :attr:`pyaptly.Command.retries`. The dependents of a
+    failed command are skipped, the other commands are executed. Deferred
+    commands are executed last.
+
+    :param          commands: Commands as returned by
+                              :meth:`pyaptly.Command.order_commands`
+    :type           commands: list
+    :param has_dependency_cb: Callback to resolve external dependencies
+    :type  has_dependency_cb: function
+    :rtype:                   RunReport"""
+    commands, _, successors = Command.dependency_graph(
+        commands, has_dependency_cb
+    )
+    if Command.bandwidth is not None:
+        Command.bandwidth.expect(commands)
+    report  = RunReport()
+    blocked = set()
+    for cmd in split_deferred(commands):
+        if cmd in blocked:
+            report.record(cmd, 'skipped')
+            blocked.update(successors[cmd])
+            continue
+        error = execute_retrying(cmd, Command.retries, report)
+        if error is not None:
+            report.record(cmd, outcome(error), error)
+            blocked.update(successors[cmd])
+        elif Command.pretend_mode:
+            report.record(cmd, 'pretended')
+        else:
+            report.record(cmd, 'finished')
+    return report
@@ -0,0 +1,256 @@
+"""Testing command execution, timeouts and the run report"""
+import subprocess
+import time
+
+from . import (Command, FunctionCommand, SystemStateReader, executor,
+               limit_commands, publish_cmd_create, publish_cmd_update)
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+
+def test_run_monitored():
+    """Test if output is passed through and errors are raised."""
+    assert executor.run_monitored(['echo', 'hello'], 5, 5) == 0
+    error = False
+    try:
+        executor.run_monitored(['bash', '-c', 'exit 42'], 5)
+    except subprocess.CalledProcessError as e:
+        assert not isinstance(e, executor.CommandTimeout)
+        assert e.returncode == 42
+        error = True
+    assert error
+
+
+def test_run_monitored_timeouts():
+    """Test if timed out and stalled commands are terminated."""
+    cases = [
+        (['bash', '-c', 'while true; do echo x; sleep 0.1; done'], 1, None,
+         "timed out"),
+        (['bash', '-c', 'echo start; sleep 10'], None, 0.5, "stalled"),
+    ]
+    with mock.patch.object(executor, 'poll_interval', 0.1):
+        for args, timeout, stall_timeout, reason in cases:
+            start = time.time()
+            error = False
+            try:
+                executor.run_monitored(args, timeout, stall_timeout)
+            except executor.CommandTimeout as e:
+                assert e.reason == reason
+                error = True
+            assert error
+            assert time.time() - start < 5
+
+
+def test_stop_process_kill():
+    """Test if a process ignoring SIGTERM is killed."""
+    process = subprocess.Popen(
+        ['bash', '-c', 'trap "" TERM; echo ready; sleep 10'],
+        stdout=subprocess.PIPE,
+    )
+    process.stdout.readline()
+    start = time.time()
+    returncode = executor.stop_process(process, grace=0.3)
+    process.stdout.close()
+    assert returncode == -9
+    assert time.time() - start < 5
+
+
+def test_execute_commands_skip():
+    """Test if the dependents of a failed command are skipped while unrelated
+    commands are executed."""
+    calls = []
+
+    def fail():
+        raise subprocess.CalledProcessError(1, ['fail'])
+
+    failing = FunctionCommand(fail)
+    failing.provide('virtual', 'a')
+    dependent = FunctionCommand(calls.append, 'dependent')
+    dependent.require('virtual', 'a')
+    dependent.provide('virtual', 'b')
+    indirect = FunctionCommand(calls.append, 'indirect')
+    indirect.require('virtual', 'b')
+    unrelated = FunctionCommand(calls.append, 'unrelated')
+    commands = Command.order_commands(
+        [indirect, dependent, failing, unrelated]
+    )
+    with mock.patch.object(Command, 'durations', None):
+        report = executor.execute_commands(commands)
+    assert calls == ['unrelated']
+    assert report.status(failing) == 'failed'
+    assert report.status(dependent) == 'skipped'
+    assert report.status(indirect) == 'skipped'
+    assert report.status(unrelated) == 'finished'
+    assert report.summary() == "1 failed, 1 finished, 2 skipped"
+    error = False
+    try:
+        report.raise_errors()
+    except subprocess.CalledProcessError:
+        error = True
+    assert error
+
+
+def test_classify():
+    """Test if transient failures are classified from output and exit code."""
+    def error(output, cmd=('aptly', 'mirror', 'update', 'a'), returncode=1):
+        e = subprocess.CalledProcessError(returncode, list(cmd))
+        e.output = output
+        return e
+
+    assert executor.classify(error(
+        "ERROR: can't open database: resource temporarily unavailable"
+    )) == 'lock'
+    assert executor.classify(error(
+        "ERROR: unable to update: HTTP code 503 while fetching"
+    )) == 'network'
+    assert executor.classify(error(
+        "gpg: keyserver receive failed: No data", cmd=['gpg']
+    )) == 'gpg'
+    assert executor.classify(error(
+        "ERROR: mirror with name a not found"
+    )) is None
+    assert executor.classify(error(None, ['gpg', '--recv-keys'], 2)) == 'gpg'
+    assert executor.classify(error(None)) is None
+    assert executor.classify(
+        executor.CommandTimeout(-15, ['aptly'], "stalled", 1)
+    ) == 'network'
+    assert executor.classify(
+        executor.CommandTimeout(-15, ['aptly'], "timed out", 1)
+    ) is None
+    assert executor.classify(ValueError("broken")) is None
+    class_ = None
+    try:
+        executor.run_monitored(
+            ['bash', '-c', 'echo "database is locked"; exit 1']
+        )
+    except subprocess.CalledProcessError as e:
+        assert "database is locked" in e.output
+        class_ = executor.classify(e)
+    assert class_ == 'lock'
+
+
+def test_retry_policy():
+    """Test the retries config and the backoff."""
+    policy = executor.RetryPolicy.from_config({
+        'tries': 4, 'delay': 2, 'max-delay': 10
+    })
+    assert policy.budget == 10
+    for attempt, delay in [(1, 2), (2, 4), (3, 8), (4, 10), (10, 10)]:
+        for _ in range(20):
+            assert delay / 2.0 <= policy.backoff(attempt) <= delay
+    for config in [{'tries': 0}, {'retry': 3}]:
+        error = False
+        try:
+            executor.RetryPolicy.from_config(config)
+        except ValueError:
+            error = True
+        assert error
+
+
+def test_execute_commands_retry():
+    """Test if transient failures are retried within the budget and
+    permanent failures aren't."""
+    attempts = []
+
+    def flaky(name, failures, output):
+        attempts.append(name)
+        if attempts.count(name) <= failures:
+            e = subprocess.CalledProcessError(1, ['aptly', name])
+            e.output = output
+            raise e
+
+    locked = FunctionCommand(flaky, 'locked', 2, "database is locked")
+    broken = FunctionCommand(flaky, 'broken', 5, "mirror not found")
+    offline = FunctionCommand(flaky, 'offline', 5, "connection refused")
+    policy = executor.RetryPolicy(tries=3, delay=0, budget=3)
+    with mock.patch.object(Command, 'durations', None), \
+            mock.patch.object(Command, 'retries', policy):
+        report = executor.execute_commands([locked, broken, offline])
+    assert attempts == [
+        'locked', 'locked', 'locked', 'broken', 'offline', 'offline'
+    ]
+    assert report.status(locked) == 'finished'
+    assert report.status(broken) == 'failed'
+    assert report.status(offline) == 'failed'
+    assert report.retries == {locked: 2, offline: 1}
+    assert report.summary() == "2 failed, 1 finished, 3 retries"
+
+
+def test_limit_commands():
+    """Test if limits are taken from the entity, the kind or the defaults."""
+    update = Command(['aptly', 'mirror', 'update', 'ubuntu'])
+    switch = Command(['aptly', 'publish', 'switch', 'stable', 'ubuntu'])
+    configured = Command(['aptly', 'mirror', 'update', 'debian'])
+    configured.timeout = 60
+    limit_commands({}, [update, switch])
+    assert update.timeout is None
+    assert update.stall_timeout == 3600
+    assert switch.stall_timeout is None
+    limit_commands({'timeouts': {
+        'mirror update': {'timeout': 7200},
+        'publish switch': {'stall-timeout': 600},
+    }}, [configured, switch])
+    assert configured.timeout == 60
+    assert configured.stall_timeout is None
+    assert switch.stall_timeout == 600
+
+
+def test_publish_deferred_contents():
+    """Test if a publish skips the contents and regenerates them deferred."""
+    config = {
+        'distribution': 'stable',
+        'components': 'main',
+        'snapshots': ['base'],
+        'skip-contents': 'deferred',
+    }
+    with mock.patch('pyaptly.state', SystemStateReader()):
+        cmd, contents = publish_cmd_create({}, 'ubuntu', config)
+        assert '-skip-contents=true' in cmd.cmd
+        assert contents.cmd == [
+            'aptly', 'publish', 'switch', '-component=main',
+            '-skip-contents=false', 'stable', 'ubuntu', 'base'
+        ]
+        assert contents.deferred == 'contents'
+        assert contents._requires == set([
+            ('virtual', 'published ubuntu stable')
+        ])
+        assert contents._requires < cmd._provides
+        del config['snapshots']
+        config['repo'] = 'local'
+        cmd, contents = publish_cmd_update({}, 'ubuntu', config)
+    assert cmd.cmd == [
+        'aptly', 'publish', 'update', '-skip-contents=true', 'stable', 'ubuntu'
+    ]
+    assert contents.cmd == [
+        'aptly', 'publish', 'update', '-skip-contents=false', 'stable',
+        'ubuntu'
+    ]
+
+
+def test_execute_deferred():
+    """Test if deferred commands run last and are pending until they are
+    finished."""
+    order = []
+
+    def fail(name):
+        order.append(name)
+        raise subprocess.CalledProcessError(1, ['aptly', name])
+
+    contents = FunctionCommand(fail, 'contents')
+    contents.deferred = 'contents'
+    contents.require('virtual', 'published')
+    switch = FunctionCommand(order.append, 'switch')
+    switch.provide('virtual', 'published')
+    other = FunctionCommand(order.append, 'other')
+    with mock.patch.object(Command, 'durations', None):
+        report = executor.execute_commands([switch, contents, other])
+    assert order == ['switch', 'other', 'contents']
+    assert report.pending() == [contents]
+    assert report.summary() == "1 failed, 2 finished, 1 contents pending"
+    with mock.patch.object(Command, 'durations', None), \
+            mock.patch.object(Command, 'pretend_mode', True):
+        report = executor.execute_commands([switch, contents, other])
+    assert report.pending() == []
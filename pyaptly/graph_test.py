@@ -2,7 +2,16 @@
 import random
 import sys
 
-from . import Command, FunctionCommand, test
+import pytest
+
+from . import (Command, FunctionCommand, SystemStateReader,
+               check_publish_sources, publish_cmd_create, publish_cmd_update,
+               publish_from_publish, test)
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
 
 if not sys.version_info < (2, 7):  # pragma: no cover
     from hypothesis import strategies as st
@@ -10,7 +19,6 @@ if not sys.version_info < (2, 7):  # pragma: no cover
 
 
 if sys.version_info < (2, 7):  # pragma: no cover
-    import mock
     given = mock.MagicMock()  # noqa
     example = mock.MagicMock()  # noqa
     st = mock.MagicMock()  # noqa
@@ -133,3 +141,122 @@ def run_graph(tree):  # pragma: no cover
     for command in ordered:
         assert command._requires.issubset(provided)
         provided.update(command._provides)
+
+
+def test_graph_critical_path():
+    """Test if the command on the longest path is scheduled first."""
+    merges = []
+    for i in range(20):
+        cmd = Command(['aptly', 'snapshot', 'merge', 'merge-%d' % i])
+        cmd.provide('snapshot', 'merge-%d' % i)
+        merges.append(cmd)
+    update = Command(['aptly', 'mirror', 'update', 'ubuntu'])
+    update.provide('mirror', 'ubuntu')
+    create = Command(['aptly', 'snapshot', 'create', 'ubuntu'])
+    create.require('mirror', 'ubuntu')
+    create.provide('snapshot', 'ubuntu')
+    with mock.patch.object(Command, 'durations', None):
+        ordered = Command.order_commands(merges + [create, update])
+        assert ordered[0] is update
+        assert ordered.index(create) > ordered.index(update)
+        assert Command.predict_makespan(ordered) == 600.0 + 21 * 5.0
+        assert Command.predict_makespan(ordered, workers=2) == 605.0
+
+
+def test_command_structural_equality():
+    """Test if commands are equal by structure and can't be changed after
+    they are sealed."""
+    def make():
+        cmd = Command(['aptly', 'mirror', 'update', 'ubuntu'])
+        cmd.provide('mirror', 'ubuntu')
+        return cmd
+    a, b = make(), make()
+    assert a == b
+    assert not a != b
+    assert hash(a) == hash(b)
+    b.require('virtual', 'other')
+    assert a != b
+    assert a != FunctionCommand(len, ['aptly', 'mirror', 'update', 'ubuntu'])
+    config = {'gpg-keys': ['650FE755'], 'archive': 'http://example.com'}
+    assert FunctionCommand(len, config) == FunctionCommand(len, dict(config))
+    assert FunctionCommand(len, config) != FunctionCommand(repr, config)
+    assert len(Command.order_commands([a, make(), make()])) == 1
+    assert a.sealed
+    for change in [
+            lambda: a.append('-force'),
+            lambda: a.require('virtual', 'late'),
+            lambda: a.provide('virtual', 'late'),
+    ]:
+        error = False
+        try:
+            change()
+        except AssertionError:
+            error = True
+        assert error
+
+
+def test_publish_of_publish():
+    """Test if a publish of a publish created in the same run depends on it
+    and resolves its snapshots when executed."""
+    upstream = {
+        'distribution': 'main',
+        'components': 'main',
+        'snapshots': ['base'],
+    }
+    downstream = {
+        'distribution': 'main',
+        'components': 'main',
+        'publish': 'upstream main',
+    }
+    state = SystemStateReader()
+    with mock.patch('pyaptly.state', state):
+        first, = publish_cmd_create({}, 'upstream', upstream)
+        second, = publish_cmd_create({}, 'downstream', downstream)
+        assert second.cmd is publish_from_publish
+        ordered = Command.order_commands([second, first], state.has_dependency)
+        assert ordered == [first, second]
+        show = "Sources:\n  main: base [snapshot]\n".split("\n")
+        with mock.patch('pyaptly.call_output_lines', return_value=show), \
+                mock.patch('subprocess.check_call') as call:
+            second.run()
+    args, = call.call_args[0]
+    assert sorted(args[2:4]) == ['-component=main', '-distribution=main']
+    assert args[:2] + args[4:] == [
+        'aptly', 'publish', 'snapshot', 'base', 'downstream'
+    ]
+
+
+def test_publish_of_staged_publish():
+    """Test if the source of a publish of a staged publish is resolved to
+    its staging prefix, and a missing source is an error."""
+    cfg = {'publish': {
+        'upstream': [{
+            'distribution': 'main',
+            'components': 'main',
+            'snapshots': ['base'],
+            'staged': True,
+        }],
+        'downstream': [{
+            'distribution': 'main',
+            'components': 'main',
+            'publish': 'upstream/main',
+        }],
+    }}
+    downstream, = cfg['publish']['downstream']
+    state = SystemStateReader()
+    with mock.patch('pyaptly.state', state):
+        upstream = publish_cmd_create(
+            cfg, 'upstream', cfg['publish']['upstream'][0]
+        )
+        second, = publish_cmd_create(cfg, 'downstream', downstream)
+        assert second.args[2] == '.staged/upstream main'
+        assert ('publish', '.staged/upstream main') in second._requires
+        check_publish_sources(upstream + [second])
+        with pytest.raises(ValueError):
+            check_publish_sources([second])
+        state.publish_map = {'downstream main': ['old']}
+        with pytest.raises(ValueError):
+            publish_cmd_update(cfg, 'downstream', downstream)
+        state.publish_map['.staged/upstream main'] = ['base']
+        switch, = publish_cmd_update(cfg, 'downstream', downstream)
+    assert switch.cmd[-3:] == ['main', 'downstream', 'base']
@@ -1,7 +1,15 @@
 """Testing testing helper functions"""
+import os
 import subprocess
+import sys
 
-from pyaptly import Command, SystemStateReader, call_output
+from pyaptly import (Command, SystemStateReader, call_output,
+                     call_output_lines, cmd_mirror_create, cmd_mirror_update)
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
 
 
 def test_call_output_error():
@@ -20,6 +28,83 @@ def test_call_output_error():
     assert error
 
 
+def test_call_output_lines():
+    """Test if call_output_lines streams lines and raises errors after the
+    last line"""
+    lines = call_output_lines(['bash', '-c', 'printf "a\\nb\\n"; exit 3'])
+    assert next(lines) == 'a'
+    assert next(lines) == 'b'
+    error = False
+    try:
+        next(lines)
+    except subprocess.CalledProcessError as e:
+        assert e.returncode == 3
+        error = True
+    assert error
+    lines = call_output_lines(['bash', '-c', 'seq 100000'])
+    assert next(lines) == '1'
+    lines.close()
+
+
+def test_extract_sources():
+    """Test if sources are extracted from lines and strings"""
+    data = [
+        "Name: test-snap",
+        "Sources:",
+        "  test-snap-base [snapshot]",
+        "Description: test",
+    ]
+    state = SystemStateReader()
+    assert state._extract_sources(iter(data)) == [
+        "  test-snap-base [snapshot]"
+    ]
+    assert state._extract_sources("\n".join(data)) == [
+        "  test-snap-base [snapshot]"
+    ]
+
+
+def test_mirror_filter():
+    """Test if the filter of a mirror is passed to aptly and a changed filter
+    is applied to the existing mirror before the update."""
+    config = {
+        'archive': 'http://archive.ubuntu.com/ubuntu',
+        'distribution': 'trusty',
+        'components': 'universe',
+        'filter': 'nginx | haproxy',
+        'filter-with-deps': True,
+        'dependency-follow-recommends': True,
+    }
+    show = [
+        "Name: universe",
+        "Filter: nginx",
+        "Filter With Deps: yes",
+        "Last update: never",
+    ]
+    state = SystemStateReader()
+    with mock.patch('pyaptly.state', state):
+        create = cmd_mirror_create({}, 'universe', config)[1]
+        assert create.cmd[4:8] == [
+            '-filter=nginx | haproxy',
+            '-filter-with-deps=true',
+            '-dep-follow-recommends',
+            'universe',
+        ]
+        state.mirrors = set(['universe'])
+        with mock.patch('pyaptly.call_output_lines', return_value=show):
+            edit, _, update = cmd_mirror_update({}, 'universe', config)
+            assert cmd_mirror_create({}, 'universe', config) == [edit]
+            show[1] = "Filter: nginx | haproxy"
+            assert cmd_mirror_create({}, 'universe', config) == []
+    assert edit.cmd == [
+        'aptly', 'mirror', 'edit', '-filter=nginx | haproxy',
+        '-filter-with-deps=true', 'universe',
+    ]
+    assert update.cmd == [
+        'aptly', 'mirror', 'update', '-dep-follow-recommends', 'universe'
+    ]
+    assert edit.get_provides() <= update._requires
+
+
 def test_command_dependency_fail():
     """Test if bad dependencies fail correctly."""
     a = Command(['ls'])
@@ -40,3 +125,31 @@ def test_dependency_callback_file():
         assert "Unknown dependency" in e.args[0]
         error = True
     assert error
+
+
+def test_import_is_cheap():
+    """Test if importing pyaptly stays within its budget of modules and time,
+    and doesn't import heavy modules or run test hooks."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = (
+        "import sys, time; sys.path.insert(0, %r); "
+        "before = len(sys.modules); start = time.time(); import pyaptly; "
+        "seconds = time.time() - start; "
+        "print('%%d %%f' %% (len(sys.modules) - before, seconds)); "
+        "print(' '.join(sys.modules))"
+    ) % root
+    output, _ = call_output([sys.executable, '-c', code])
+    budget, output = output.split("\n", 1)
+    count, seconds = budget.split()
+    # Budget of the import: the modules it loads and the time it takes, about
+    # 3 times what it takes now, see the README
+    assert int(count) <= 60
+    assert float(seconds) < 0.2
+    modules = set([name.split('.')[0] for name in output.split()])
+    for name in [
+            'argparse', 'freeze', 'hypothesis', 'json', 'six', 'sqlite3',
+            'subprocess', 'yaml'
+    ]:
+        assert name not in modules, name
+    loaded = [name for name in output.split() if name.startswith('pyaptly.')]
+    assert loaded == []
@@ -0,0 +1,154 @@
+"""Ingestion of the packages in incoming directories into local repos.
+
+A repo may list ``incoming`` directories, uploads from CI for example. Instead
+of one ``aptly repo add`` per file, each opening the database, ``pyaptly repo
+add`` scans the directories of a repo and skips the files whose checksum the
+repo already contains or which were found twice. aptly lists no checksum for
+source packages, they are identified by their name and version instead. The
+remaining files are added with one ``aptly repo add`` per
+:data:`files_per_add` files, to stay below the size limit of the
+command-line.
+"""
+import hashlib
+import os
+import subprocess
+
+from . import call_output_lines, lg, state
+
+# Files added to repos, aptly picks up the files a .dsc references itself
+package_extensions = ('.deb', '.udeb', '.dsc')
+
+# Bytes read at once while hashing
+chunk_size = 1024 * 1024
+
+# Files added by one aptly repo add
+files_per_add = 256
+
+# Printed by aptly for fields a package doesn't have
+no_value = '<no value>'
+
+
+def file_checksum(path):
+    """Return the SHA256 checksum of a file.
+
+    :param path: The file
+    :type  path: str
+    :rtype:      str"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_key(name, version):
+    """Return the key identifying a source package, see :func:`package_key`.
+
+    :param    name: Name of the source package
+    :type     name: str
+    :param version: Version of the source package
+    :type  version: str
+    :rtype:         str"""
+    return 'source %s %s' % (name, version)
+
+
+def package_key(path):
+    """Return the key identifying a package file: the SHA256 checksum of
+    binary packages and the source name and version of a .dsc.
+
+    :param path: The file
+    :type  path: str
+    :rtype:      str"""
+    if not path.endswith('.dsc'):
+        return file_checksum(path)
+    fields = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.decode('UTF-8', 'replace')
+            for field in ('Source', 'Version'):
+                if line.startswith('%s:' % field) and field not in fields:
+                    fields[field] = line.split(':', 1)[1].strip()
+    if len(fields) < 2:
+        # Not a valid .dsc, aptly will complain about it
+        return file_checksum(path)
+    return source_key(fields['Source'], fields['Version'])
+
+
+def scan(directories):
+    """Return the sorted paths of the packages in the directories. Missing
+    directories are skipped.
+
+    :param directories: The incoming directories
+    :type  directories: list
+    :rtype:             list"""
+    files = []
+    for directory in directories:
+        if not os.path.isdir(directory):
+            lg.warning('Incoming directory %s does not exist', directory)
+            continue
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.endswith(package_extensions):
+                    files.append(os.path.join(dirpath, filename))
+    return sorted(files)
+
+
+def repo_checksums(repo_name):
+    """Return the keys of the packages in a repo, see :func:`package_key`.
+
+    :param repo_name: Name of the repo
+    :type  repo_name: str
+    :rtype:           set"""
+    checksums = set()
+    try:
+        for line in call_output_lines(state.aptly_call([
+                'aptly', 'repo', 'search',
+                '-format={{.Package}} {{.Version}} {{.SHA256}}', repo_name
+        ])):
+            fields = line.split(None, 2)
+            if len(fields) != 3:
+                continue
+            name, version, checksum = [x.strip() for x in fields]
+            if checksum != no_value:
+                checksums.add(checksum)
+            else:
+                # Source packages have no SHA256 field
+                checksums.add(source_key(name, version))
+    except subprocess.CalledProcessError:
+        # aptly fails searching an empty repo
+        lg.debug('Repo %s has no packages', repo_name)
+    return checksums
+
+
+def new_files(directories, known):
+    """Return the packages in the directories whose key isn't known, every
+    key once.
+
+    :param directories: The incoming directories
+    :type  directories: list
+    :param       known: Keys of the packages already in the repo, see
+                        :func:`repo_checksums`
+    :type        known: set
+    :rtype:             list"""
+    seen = set(known)
+    files = []
+    for path in scan(directories):
+        key = package_key(path)
+        if key in seen:
+            lg.debug('Skipping %s, already added', path)
+            continue
+        seen.add(key)
+        files.append(path)
+    return files
+
+
+def batches(files):
+    """Split the files into the batches added by one command each.
+
+    :param files: The files to add
+    :type  files: list
+    :rtype:       list of lists"""
+    return [
+        files[i:i + files_per_add]
+        for i in range(0, len(files), files_per_add)
+    ]
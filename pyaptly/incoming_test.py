@@ -0,0 +1,171 @@
+"""Testing the ingestion of incoming directories"""
+import argparse
+import os
+import shutil
+import tempfile
+
+from . import SystemStateReader, incoming, plan_repo
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+
+def write(path, content):
+    """Write a file, creating its directory."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_new_files():
+    """Test if only packages with unknown checksums are returned, every
+    checksum once."""
+    directory = tempfile.mkdtemp()
+    first = os.path.join(directory, 'ci')
+    second = os.path.join(directory, 'manual')
+    try:
+        write(os.path.join(first, 'a_1_amd64.deb'), "a")
+        write(os.path.join(first, 'b_1_amd64.deb'), "b")
+        write(os.path.join(first, 'b_1_amd64.changes'), "changes")
+        write(os.path.join(second, 'sub', 'b_1_amd64.deb'), "b")
+        write(os.path.join(second, 'c_1.dsc'), "c")
+        known = set([incoming.file_checksum(
+            os.path.join(first, 'a_1_amd64.deb')
+        )])
+        missing = os.path.join(directory, 'missing')
+        assert incoming.new_files([first, second, missing], known) == [
+            os.path.join(first, 'b_1_amd64.deb'),
+            os.path.join(second, 'c_1.dsc'),
+        ]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_source_packages():
+    """Test if source packages, which aptly lists without a checksum, are
+    known by their name and version."""
+    directory = tempfile.mkdtemp()
+    dsc = (
+        "-----BEGIN PGP SIGNED MESSAGE-----\n"
+        "Hash: SHA256\n\n"
+        "Format: 3.0 (quilt)\n"
+        "Source: hello\n"
+        "Binary: hello\n"
+        "Version: 1:2.10-2\n"
+    )
+    output = [
+        "hello 1:2.10-2 0a1b2c\n",
+        "hello 1:2.10-2 <no value>\n",
+        "world 1.0 <no value>\n",
+        "\n",
+    ]
+    try:
+        write(os.path.join(directory, 'hello_2.10-2.dsc'), dsc)
+        write(os.path.join(directory, 'world_1.1.dsc'), dsc.replace(
+            'hello', 'world'
+        ).replace('1:2.10-2', '1.1'))
+        with mock.patch.object(incoming, 'call_output_lines') as call:
+            call.return_value = output
+            known = incoming.repo_checksums('sources')
+        assert known == set([
+            '0a1b2c', 'source hello 1:2.10-2', 'source world 1.0'
+        ])
+        assert incoming.new_files([directory], known) == [
+            os.path.join(directory, 'world_1.1.dsc'),
+        ]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_plan_repo_add():
+    """Test if new packages are added with one command per batch of files,
+    followed by the snapshots of the repo and the publishes of the repo and
+    its snapshots."""
+    directory = tempfile.mkdtemp()
+    cfg = {
+        'repo': {
+            'centrify': {'incoming': os.path.join(directory, 'centrify')},
+            'tools': {'incoming': os.path.join(directory, 'tools')},
+        },
+        'snapshot': {
+            'centrify-%T': {
+                'repo': 'centrify',
+                'timestamp': {'time': '00:00'},
+            },
+        },
+        'publish': {
+            'centrify': [{
+                'distribution': 'latest',
+                'repo': 'centrify',
+                'automatic-update': True,
+            }],
+            'centrify-snapshot': [{
+                'distribution': 'latest',
+                'components': 'main',
+                'snapshots': [{'name': 'centrify-%T', 'timestamp': 'current'}],
+                'automatic-update': True,
+            }],
+        },
+    }
+    state = SystemStateReader()
+    state.repos = set(['centrify', 'tools'])
+    state.publishes = set(['centrify latest', 'centrify-snapshot latest'])
+    state.publish_map = {
+        'centrify-snapshot latest': ['centrify-20000101T0000Z'],
+    }
+
+    def repo_checksums(repo_name):
+        """The repos already contain b_1_amd64.deb."""
+        return set([incoming.file_checksum(
+            os.path.join(directory, repo_name, 'b_1_amd64.deb')
+        )])
+
+    try:
+        write(os.path.join(directory, 'centrify', 'a_1_amd64.deb'), "a")
+        write(os.path.join(directory, 'centrify', 'b_1_amd64.deb'), "b")
+        write(os.path.join(directory, 'tools', 'b_1_amd64.deb'), "b")
+        args = argparse.Namespace(
+            task='add', repo_name='all', directories=[], debug=False
+        )
+        with mock.patch('pyaptly.state', state), \
+                mock.patch.object(incoming, 'repo_checksums', repo_checksums):
+            commands = plan_repo(cfg, args)
+            assert commands[0].cmd[:4] == ['aptly', 'repo', 'add', 'centrify']
+            assert sorted([x.cmd[:3] for x in commands[1:]]) == [
+                ['aptly', 'publish', 'switch'],
+                ['aptly', 'publish', 'update'],
+                ['aptly', 'snapshot', 'create'],
+            ]
+            assert commands[0].cmd[4:] == [
+                os.path.join(directory, 'centrify', 'a_1_amd64.deb')
+            ]
+            added = ('virtual', 'repo added centrify')
+            for cmd in commands[1:]:
+                assert added in cmd._requires
+            create, = [x for x in commands if 'create' in x.cmd]
+            switch, = [x for x in commands if 'switch' in x.cmd]
+            assert create.get_provides() <= switch._requires
+            assert commands.index(create) < commands.index(switch)
+            write(os.path.join(directory, 'centrify', 'c_1_amd64.deb'), "c")
+            with mock.patch.object(incoming, 'files_per_add', 1):
+                commands = plan_repo(cfg, args)
+            assert [x.cmd[4:] for x in commands[:2]] == [
+                [os.path.join(directory, 'centrify', 'a_1_amd64.deb')],
+                [os.path.join(directory, 'centrify', 'c_1_amd64.deb')],
+            ]
+            for cmd in commands[2:]:
+                assert added in cmd._requires
+            os.remove(os.path.join(directory, 'centrify', 'c_1_amd64.deb'))
+            args.repo_name = 'tools'
+            args.directories = [os.path.join(directory, 'centrify')]
+            commands = plan_repo(cfg, args)
+            assert [x.cmd for x in commands] == [[
+                'aptly', 'repo', 'add', 'tools',
+                os.path.join(directory, 'centrify', 'a_1_amd64.deb'),
+            ]]
+    finally:
+        shutil.rmtree(directory)
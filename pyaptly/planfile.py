@@ -0,0 +1,155 @@
+"""Serialized execution plans, written by "pyaptly plan" and executed by
+"pyaptly apply".
+
+A plan is a JSON file containing the ordered commands of a task with their
+requires and provides, the request it was made for and the fingerprint of the
+state it was computed from (see :meth:`pyaptly.SystemStateReader.fingerprint`).
+The requirements that were already fulfilled by that state are stored too, so
+applying the plan doesn't have to read the state again.
+
+Function commands are stored by name, only functions of the :mod:`pyaptly`
+module and methods of the global state reader can be planned.
+"""
+import codecs
+import json
+
+import pyaptly
+
+plan_version = 2
+
+
+def function_reference(func):
+    """Return the name a function is stored with in a plan.
+
+    :param func: Function of a :class:`pyaptly.FunctionCommand`
+    :type  func: callable
+    :rtype:      str"""
+    if getattr(func, '__self__', None) is pyaptly.state:
+        return 'state.%s' % func.__name__
+    if getattr(pyaptly, func.__name__, None) is func:
+        return func.__name__
+    raise ValueError("Function %s can't be stored in a plan" % func)
+
+
+def resolve_function(reference):
+    """Return the function stored with the given name in a plan.
+
+    :param reference: Name as returned by :func:`function_reference`
+    :type  reference: str
+    :rtype:           callable"""
+    if reference.startswith('state.'):
+        owner, name = pyaptly.state, reference[len('state.'):]
+    else:
+        owner, name = pyaptly, reference
+    func = getattr(owner, name, None)
+    if not hasattr(func, '__call__'):
+        raise ValueError("Unknown function in plan: %s" % reference)
+    return func
+
+
+def command_to_dict(cmd):
+    """Convert a command into its plan representation.
+
+    :param cmd: The command
+    :type  cmd: :class:`pyaptly.Command`
+    :rtype:     dict"""
+    if isinstance(cmd, pyaptly.FunctionCommand):
+        data = {
+            'function': function_reference(cmd.cmd),
+            'args':     list(cmd.args),
+            'kwargs':   cmd.kwargs,
+        }
+    else:
+        data = {'cmd': list(cmd.cmd)}
+    data['requires'] = sorted([list(x) for x in cmd._requires])
+    data['provides'] = sorted([list(x) for x in cmd._provides])
+    if cmd.timeout is not None:
+        data['timeout'] = cmd.timeout
+    if cmd.stall_timeout is not None:
+        data['stall-timeout'] = cmd.stall_timeout
+    if cmd.deferred is not None:
+        data['deferred'] = cmd.deferred
+    return data
+
+
+def command_from_dict(data):
+    """Create a command from its plan representation.
+
+    :param data: Representation as returned by :func:`command_to_dict`
+    :type  data: dict
+    :rtype:      :class:`pyaptly.Command`"""
+    if 'function' in data:
+        cmd = pyaptly.FunctionCommand(
+            resolve_function(data['function']),
+            *data['args'],
+            **data['kwargs']
+        )
+    else:
+        cmd = pyaptly.Command(list(data['cmd']))
+    for type_, identifier in data['requires']:
+        cmd.require(type_, identifier)
+    for type_, identifier in data['provides']:
+        cmd.provide(type_, identifier)
+    cmd.timeout       = data.get('timeout')
+    cmd.stall_timeout = data.get('stall-timeout')
+    cmd.deferred      = data.get('deferred')
+    return cmd
+
+
+def fulfilled_requirements(commands, has_dependency_cb):
+    """Return the requirements of the commands that are already fulfilled.
+
+    :param          commands: The commands
+    :type           commands: list
+    :param has_dependency_cb: Callback to resolve external dependencies
+    :type  has_dependency_cb: function
+    :rtype:                   set"""
+    fulfilled = set()
+    for cmd in commands:
+        for req in cmd._requires:
+            if req not in fulfilled and has_dependency_cb(req):
+                fulfilled.add(req)
+    return fulfilled
+
+
+def write_plan(path, commands, fingerprint, request, fulfilled=()):
+    """Write ordered commands to a plan file.
+
+    :param        path: Path of the plan file
+    :type         path: str
+    :param    commands: Ordered commands
+    :type     commands: list
+    :param fingerprint: Fingerprint of the state the plan was made from
+    :type  fingerprint: str
+    :param     request: Description of the planned task
+    :type      request: dict
+    :param   fulfilled: Requirements fulfilled by the state, see
+                        :func:`fulfilled_requirements`
+    :type    fulfilled: set"""
+    data = {
+        'version':     plan_version,
+        'fingerprint': fingerprint,
+        'request':     request,
+        'fulfilled':   sorted([list(x) for x in fulfilled]),
+        'commands':    [command_to_dict(cmd) for cmd in commands],
+    }
+    with codecs.open(path, 'w', encoding="UTF-8") as fh:
+        json.dump(data, fh, indent=2, sort_keys=True)
+
+
+def read_plan(path):
+    """Read a plan file.
+
+    :param path: Path of the plan file
+    :type  path: str
+    :rtype:      (list, str, dict, set) the commands, the fingerprint, the
+                 request and the fulfilled requirements"""
+    with codecs.open(path, 'r', encoding="UTF-8") as fh:
+        data = json.load(fh)
+    if data.get('version') != plan_version:
+        raise ValueError(
+            "Unsupported plan version %s in %s" % (data.get('version'), path)
+        )
+    commands = [command_from_dict(x) for x in data['commands']]
+    fulfilled = set([tuple(x) for x in data['fulfilled']])
+    return (commands, data['fingerprint'], data['request'], fulfilled)
@@ -0,0 +1,190 @@
+"""Testing plan files"""
+import datetime
+import os
+import shutil
+import tempfile
+
+import freezegun
+
+from . import (Command, FunctionCommand, add_gpg_keys, changes, main,
+               planfile, publish_cmd_update, state)
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+
+def example_commands():
+    """Commands as created by a snapshot update."""
+    rename = Command(['aptly', 'snapshot', 'rename', 'a', 'a-rotated'])
+    rename.provide('virtual', 'a-rotated')
+    refresh = FunctionCommand(state.read)
+    refresh.require('virtual', 'a-rotated')
+    refresh.provide('virtual', 'all-snapshots-rotated')
+    keys = FunctionCommand(add_gpg_keys, {'gpg-keys': ['650FE755']})
+    return [rename, refresh, keys]
+
+
+def test_plan_roundtrip():
+    """Test if commands survive writing and reading a plan."""
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "plan.json")
+        commands = example_commands()
+        commands[0].stall_timeout = 600
+        planfile.write_plan(
+            path, commands, "abc", {'entry': 'snapshot'},
+            set([('snapshot', 'a')])
+        )
+        loaded, fingerprint, request, fulfilled = planfile.read_plan(path)
+    finally:
+        shutil.rmtree(directory)
+    assert fingerprint == "abc"
+    assert request == {'entry': 'snapshot'}
+    assert fulfilled == set([('snapshot', 'a')])
+    assert [x.cmd for x in loaded[:1]] == [commands[0].cmd]
+    assert loaded[1].cmd == state.read
+    assert loaded[2].cmd is add_gpg_keys
+    assert loaded[2].args == ({'gpg-keys': ['650FE755']}, )
+    for old, new in zip(commands, loaded):
+        assert old._requires == new._requires
+        assert old._provides == new._provides
+        assert old.timeout == new.timeout
+        assert old.stall_timeout == new.stall_timeout
+
+
+def test_plan_unknown_function():
+    """Test if only functions of pyaptly can be planned."""
+    error = False
+    try:
+        planfile.command_to_dict(FunctionCommand(lambda: None))
+    except ValueError:
+        error = True
+    assert error
+
+
+def test_apply_fingerprint():
+    """Test if a plan is only applied if the state is unchanged."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "plan.json")
+    planfile.write_plan(path, example_commands()[:1], "abc", {})
+    try:
+        environ = {'PYAPTLY_STATE_DIR': directory}
+        with mock.patch("subprocess.check_call") as call, \
+                mock.patch.dict(os.environ, environ), \
+                mock.patch.object(Command, 'durations', None), \
+                mock.patch.object(state, 'read'):
+            with mock.patch.object(state, 'fingerprint') as fingerprint:
+                fingerprint.return_value = "changed"
+                error = False
+                try:
+                    main(['apply', path])
+                except ValueError as e:
+                    assert "plan again" in e.args[0]
+                    error = True
+                assert error
+                assert not call.called
+                fingerprint.return_value = "abc"
+                main(['apply', path])
+                call.assert_called_once_with(
+                    ['aptly', 'snapshot', 'rename', 'a', 'a-rotated']
+                )
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_apply_reads_gpg_only():
+    """Test if applying reads only the gpg keys, so the keys already present
+    aren't fetched again, and resolves dependencies with the plan."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "plan.json")
+    create = Command(['aptly', 'snapshot', 'create', 'a'])
+    create.provide('snapshot', 'a')
+    publish = Command(['aptly', 'publish', 'snapshot', 'a'])
+    publish.require('snapshot', 'a')
+    commands = [publish, create] + example_commands()[2:]
+    planfile.write_plan(path, commands, "abc", {}, set([('snapshot', 'a')]))
+
+    def read_gpg():
+        state.gpg_keys = set(['650FE755'])
+    try:
+        environ = {'PYAPTLY_STATE_DIR': directory}
+        with mock.patch("subprocess.check_call") as call, \
+                mock.patch.dict(os.environ, environ), \
+                mock.patch.object(Command, 'durations', None), \
+                mock.patch.object(state, 'gpg_keys', set()), \
+                mock.patch.object(state, 'read') as read, \
+                mock.patch.object(state, 'read_gpg', read_gpg), \
+                mock.patch.object(state, 'fingerprint') as fingerprint:
+            fingerprint.return_value = "abc"
+            main(['apply', path])
+            assert not read.called
+            # The publish doesn't wait for the snapshot it already had
+            assert [x[0][0] for x in call.call_args_list] == [
+                publish.cmd, create.cmd
+            ]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_apply_records_digests():
+    """Test if the config digests of a plan are stored once it is applied."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "plan.json")
+    digests = {'mirror': {'ubuntu': 'abc'}}
+    planfile.write_plan(path, example_commands()[:1], "abc", {
+        'config': '/etc/pyaptly.yml',
+        'entry':  'mirror',
+        'task':   'update',
+        'name':   'all',
+        'digests': digests,
+    })
+    try:
+        environ = {'PYAPTLY_STATE_DIR': directory}
+        with mock.patch("subprocess.check_call"), \
+                mock.patch.dict(os.environ, environ), \
+                mock.patch.object(Command, 'durations', None), \
+                mock.patch.object(state, 'read'), \
+                mock.patch.object(state, 'fingerprint') as fingerprint:
+            fingerprint.return_value = "abc"
+            main(['apply', path])
+        store = changes.DigestStore(
+            os.path.join(directory, 'config-digests.json')
+        )
+        assert store.load('/etc/pyaptly.yml', 'mirror update') == digests
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_publish_update_plan_archive():
+    """Test if the archive snapshot is planned instead of created while
+    planning."""
+    cfg = {
+        'snapshot': {
+            'fakerepo01-%T': {'timestamp': {'time': '00:00'}},
+        }
+    }
+    publish_config = {
+        'distribution': 'main',
+        'components': 'main',
+        'snapshots': [{
+            'name': 'fakerepo01-%T',
+            'timestamp': 'current',
+            'archive-on-update': 'archived-fakerepo01-%T',
+        }],
+    }
+    with freezegun.freeze_time(datetime.datetime(2012, 10, 11, 10, 10)):
+        with mock.patch.object(state, 'publish_map', {
+                'fakerepo01 main': set(['fakerepo01-20121010T0000Z'])
+        }), mock.patch("subprocess.check_call") as call:
+            cmds = publish_cmd_update(cfg, 'fakerepo01', publish_config)
+    assert not call.called
+    archive, switch = cmds
+    assert archive.cmd == [
+        'aptly', 'snapshot', 'merge',
+        'archived-fakerepo01-20121011T1010Z',
+        'fakerepo01-20121010T0000Z',
+    ]
+    assert archive._provides.issubset(switch._requires)
+    assert switch.cmd[-1] == 'fakerepo01-20121011T0000Z'
@@ -0,0 +1,284 @@
+"""Download progress of mirror updates.
+
+The output of ``aptly mirror update`` is passed through and parsed into
+counters per mirror: the packages and bytes in the download queue, the
+packages downloaded, the rate and the estimated time left. aptly reports the
+size of the whole queue but not of every file, so the downloaded bytes are
+estimated from the average size of the queued packages. A package counts as
+downloaded once aptly starts the download of the next one.
+
+While mirrors are updated the counters are written to a status file every
+:data:`status_interval` seconds, replaced atomically so readers never see a
+partial file. At the end of the run they are logged with the run report.
+"""
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+from . import lg
+
+# Seconds between rewrites of the status file
+status_interval = 5.0
+
+# Kind of the commands whose progress is tracked
+tracked_kind = 'mirror update'
+
+queue_pattern = re.compile(
+    r"Download queue: (\d+) items? \(([\d.]+) ?([KMGTP]?i?B)\)"
+)
+download_pattern = re.compile(r"Downloading:? (\S+?)(?:\.\.\.)?$")
+done_pattern = re.compile(r"Mirror `.*` has been (?:successfully )?updated")
+
+size_units = {
+    'B': 1, 'KiB': 1 << 10, 'MiB': 1 << 20, 'GiB': 1 << 30, 'TiB': 1 << 40,
+    'PiB': 1 << 50, 'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3,
+    'TB': 1000 ** 4, 'PB': 1000 ** 5,
+}
+
+
+def parse_size(number, unit):
+    """Return the bytes of a size as printed by aptly, ie. "12.50 MiB".
+
+    :param number: The number
+    :type  number: str
+    :param   unit: The unit
+    :type    unit: str
+    :rtype:        int"""
+    return int(float(number) * size_units.get(unit, 1))
+
+
+def format_size(size):
+    """Return a human readable size.
+
+    :param size: Bytes
+    :type  size: int
+    :rtype:      str"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TiB' % size
+
+
+class MirrorProgress(object):
+    """Progress of the update of a mirror.
+
+    :param name: Name of the mirror
+    :type  name: str"""
+
+    def __init__(self, name):
+        self.name         = name
+        self.state        = 'running'
+        self.start        = time.time()
+        self.end          = None
+        self.queue_start  = None
+        self.queued       = 0
+        self.queued_bytes = 0
+        self.started      = 0
+        self._buffer      = b""
+
+    def feed(self, data):
+        """Parse output of aptly, incomplete lines are kept for the next
+        call.
+
+        :param data: Output of the command
+        :type  data: bytes"""
+        lines = (self._buffer + data).split(b"\n")
+        self._buffer = lines.pop()[-4096:]
+        for line in lines:
+            self.parse(line.decode("UTF-8", "replace").strip())
+
+    def parse(self, line):
+        """Update the counters from a line of output.
+
+        :param line: The line
+        :type  line: str"""
+        match = queue_pattern.search(line)
+        if match:
+            self.queued       = int(match.group(1))
+            self.queued_bytes = parse_size(match.group(2), match.group(3))
+            self.queue_start  = time.time()
+            return
+        match = download_pattern.search(line)
+        if match:
+            if self.queue_start is not None and '/pool/' in match.group(1):
+                self.started += 1
+            return
+        if done_pattern.search(line):
+            self.started = self.queued + 1
+
+    @property
+    def downloaded(self):
+        """Number of packages downloaded.
+
+        :rtype: int"""
+        if self.state == 'finished':
+            return self.queued
+        return min(max(self.started - 1, 0), self.queued)
+
+    @property
+    def downloaded_bytes(self):
+        """Estimated bytes downloaded.
+
+        :rtype: int"""
+        if not self.queued:
+            return 0
+        return self.queued_bytes * self.downloaded // self.queued
+
+    def rate(self, now=None):
+        """Return the download rate in bytes per second.
+
+        :param now: The time, defaults to now
+        :type  now: float
+        :rtype:     float"""
+        if self.queue_start is None:
+            return 0.0
+        if now is None:
+            now = self.end or time.time()
+        elapsed = now - self.queue_start
+        if elapsed <= 0:
+            return 0.0
+        return self.downloaded_bytes / elapsed
+
+    def eta(self, now=None):
+        """Return the estimated seconds until the downloads are finished,
+        None if unknown.
+
+        :param now: The time, defaults to now
+        :type  now: float
+        :rtype:     float"""
+        if self.state != 'running':
+            return 0.0
+        rate = self.rate(now)
+        if not rate:
+            return None
+        return (self.queued_bytes - self.downloaded_bytes) / rate
+
+    def finish(self, state):
+        """Mark the update as ended.
+
+        :param state: finished or failed
+        :type  state: str"""
+        self.state = state
+        self.end   = time.time()
+
+    def as_dict(self, now=None):
+        """Return the counters.
+
+        :param now: The time, defaults to now
+        :type  now: float
+        :rtype:     dict"""
+        if now is None:
+            now = self.end or time.time()
+        return collections.OrderedDict([
+            ('state',            self.state),
+            ('elapsed',          round(now - self.start, 1)),
+            ('queued',           self.queued),
+            ('queued_bytes',     self.queued_bytes),
+            ('downloaded',       self.downloaded),
+            ('downloaded_bytes', self.downloaded_bytes),
+            ('rate',             round(self.rate(now), 1)),
+            ('eta',              self.eta(now)),
+        ])
+
+    def describe(self):
+        """Return a one line description of the progress.
+
+        :rtype: str"""
+        return '%s %s: %d/%d packages, %s of %s, %s/s' % (
+            self.name, self.state, self.downloaded, self.queued,
+            format_size(self.downloaded_bytes),
+            format_size(self.queued_bytes),
+            format_size(self.rate()),
+        )
+
+
+class Tracker(object):
+    """Tracks the progress of the mirror updates of a run and writes it to
+    the status file. Registered in :attr:`pyaptly.Command.observers` to see
+    the updates end.
+
+    :param path: Path of the status file, None doesn't write one
+    :type  path: str"""
+
+    def __init__(self, path=None):
+        self.path    = path
+        self.mirrors = collections.OrderedDict()
+        self.running = {}
+        self.written = 0.0
+        self._lock   = threading.Lock()
+
+    def observer(self, cmd):
+        """Return the callable the output of a command is fed to, None if
+        its progress isn't tracked.
+
+        :param cmd: The command
+        :type  cmd: :class:`pyaptly.Command`
+        :rtype:     function"""
+        if cmd.kind() != tracked_kind:
+            return None
+        progress = MirrorProgress(str(cmd.cmd[-1]))
+        with self._lock:
+            self.mirrors[progress.name] = progress
+            self.running[cmd] = progress
+
+        def feed(data):
+            progress.feed(data)
+            self.update()
+        return feed
+
+    def __call__(self, cmd, event, error=None):
+        """Observe the end of the mirror updates, see
+        :meth:`pyaptly.Command.notify`."""
+        if event not in ('finished', 'failed'):
+            return
+        with self._lock:
+            progress = self.running.pop(cmd, None)
+        if progress is not None:
+            progress.finish(event)
+            self.update(force=True)
+
+    def update(self, force=False):
+        """Rewrite the status file if :data:`status_interval` passed.
+
+        :param force: Write it anyway
+        :type  force: bool"""
+        now = time.time()
+        if not self.path:
+            return
+        if not force and now - self.written < status_interval:
+            return
+        self.written = now
+        self.write()
+
+    def status(self):
+        """Return the content of the status file.
+
+        :rtype: dict"""
+        with self._lock:
+            mirrors = list(self.mirrors.values())
+        return collections.OrderedDict([
+            ('updated', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('pid',     os.getpid()),
+            ('mirrors', collections.OrderedDict([
+                (x.name, x.as_dict()) for x in mirrors
+            ])),
+        ])
+
+    def write(self):
+        """Replace the status file atomically."""
+        temp = '%s.%d' % (self.path, os.getpid())
+        try:
+            with open(temp, 'w') as f:
+                json.dump(self.status(), f, indent=2)
+            os.rename(temp, self.path)
+        except (IOError, OSError) as e:  # pragma: no cover
+            lg.warning('Could not write status file %s: %s', self.path, e)
+
+    def log(self):
+        """Log the progress of the mirror updates of the run."""
+        for progress in list(self.mirrors.values()):
+            lg.info('Mirror update %s', progress.describe())
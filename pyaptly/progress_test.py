@@ -0,0 +1,94 @@
+"""Testing the progress of mirror updates"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from . import Command, executor, progress, track_progress
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+output = b"""Downloading http://mirror/ubuntu/dists/trusty/Release...
+Applying filter...
+Building download queue...
+Download queue: 4 items (2.00 MiB)
+Downloading http://mirror/ubuntu/pool/main/a/a_1_amd64.deb...
+Downloading http://mirror/ubuntu/pool/main/b/b_1_amd64.deb...
+Downloading http://mirror/ubuntu/pool/main/c/c_1_amd64.deb...
+"""
+
+
+def test_mirror_progress():
+    """Test if the counters are parsed from the output, split at any
+    point."""
+    mirror = progress.MirrorProgress('ubuntu')
+    for index in range(0, len(output), 7):
+        mirror.feed(output[index:index + 7])
+    assert mirror.queued == 4
+    assert mirror.queued_bytes == 2 * 1024 * 1024
+    assert mirror.downloaded == 2
+    assert mirror.downloaded_bytes == 1024 * 1024
+    now = mirror.queue_start + 2
+    assert mirror.rate(now) == 512 * 1024
+    assert mirror.eta(now) == 2
+    mirror.feed(b"\nMirror `ubuntu` has been successfully updated.\n")
+    assert mirror.downloaded == 4
+    mirror.finish('finished')
+    assert mirror.as_dict()['eta'] == 0
+
+
+def test_status_file():
+    """Test if the progress of a mirror update is written to the status
+    file while it runs and when it ends."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'status.json')
+    tracker = progress.Tracker(path)
+    cmd = Command([
+        sys.executable, '-c',
+        'import sys; sys.stdout.write(sys.argv[1])', output.decode("UTF-8"),
+        'mirror', 'update', 'ubuntu',
+    ])
+    # Track the fake aptly command
+    cmd.kind = lambda: 'mirror update'
+    try:
+        executor.run_monitored(
+            cmd.cmd, observer=tracker.observer(cmd)
+        )
+        tracker.update(force=True)
+        with open(path) as f:
+            status = json.load(f)
+        assert status['mirrors']['ubuntu']['state'] == 'running'
+        assert status['mirrors']['ubuntu']['downloaded'] == 2
+        tracker(cmd, 'failed')
+        with open(path) as f:
+            status = json.load(f)
+        assert status['mirrors']['ubuntu']['state'] == 'failed'
+        assert tracker.running == {}
+        assert tracker.observer(Command(['aptly', 'mirror', 'list'])) is None
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_track_progress():
+    """Test if progress is only tracked for runs with mirror updates."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'status.json')
+    update = Command(['aptly', 'mirror', 'update', 'ubuntu'])
+    try:
+        with mock.patch.object(Command, 'status_file', path), \
+                mock.patch.object(Command, 'observers', []):
+            track_progress([Command(['aptly', 'snapshot', 'drop', 'a'])])
+            assert Command.progress is None
+            track_progress([update])
+            assert isinstance(Command.progress, progress.Tracker)
+            assert Command.observers == [Command.progress]
+            Command.progress = None
+        track_progress([update])
+        assert Command.progress is None
+    finally:
+        Command.progress = None
+        shutil.rmtree(directory)
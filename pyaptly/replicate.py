@@ -0,0 +1,139 @@
+"""Replication of published trees to further local destinations.
+
+A publish may list ``destinations``, document roots or NFS mounts serving the
+same repository. After aptly published it, the tree is replicated to every
+destination by its own command, so with ``--jobs`` the destinations are
+updated in parallel and the run report shows the outcome per destination.
+
+Files are hard-linked where possible. If the destination is on another
+filesystem they are copied, skipping files with the same size and
+modification time. The pool is replicated first and the release files of the
+indexes last, so clients never see indexes referencing missing packages.
+Files that vanished from the published tree are removed at the end.
+"""
+import errno
+import os
+import shutil
+
+from . import lg
+
+# Index files replaced after all other files
+release_files = ('Release', 'Release.gpg', 'InRelease')
+
+
+def replication_order(relpath):
+    """Return the sort key of a file: pool, other files, release files.
+
+    :param relpath: Path of the file in the tree
+    :type  relpath: str
+    :rtype:         tuple"""
+    if relpath.split(os.sep)[0] == 'pool':
+        return (0, relpath)
+    if os.path.basename(relpath) in release_files:
+        return (2, relpath)
+    return (1, relpath)
+
+
+def tree_files(root):
+    """Return the paths of the files in a tree relative to root.
+
+    :param root: The tree
+    :type  root: str
+    :rtype:      set"""
+    files = set()
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            files.add(
+                os.path.relpath(os.path.join(dirpath, filename), root)
+            )
+    return files
+
+
+def unchanged(source, destination):
+    """Return True if destination is the same file or a copy with the same
+    size and modification time as source.
+
+    :param      source: The source file
+    :type       source: str
+    :param destination: The destination file
+    :type  destination: str
+    :rtype:             bool"""
+    try:
+        if os.path.samefile(source, destination):
+            return True
+        src = os.stat(source)
+        dst = os.stat(destination)
+    except OSError:
+        return False
+    return (
+        src.st_size == dst.st_size and
+        int(src.st_mtime) == int(dst.st_mtime)
+    )
+
+
+def replace_file(source, destination, link=True):
+    """Replace destination by a hard link to source or, if that isn't
+    possible, by a copy. The file is replaced with an atomic rename.
+    Return True if it was linked.
+
+    :param      source: The source file
+    :type       source: str
+    :param destination: The destination file
+    :type  destination: str
+    :param        link: Try to hard-link the file
+    :type         link: bool
+    :rtype:             bool"""
+    directory = os.path.dirname(destination)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp = '%s.pyaptly-%d' % (destination, os.getpid())
+    if os.path.lexists(temp):  # pragma: no cover
+        os.unlink(temp)
+    linked = False
+    if link:
+        try:
+            os.link(source, temp)
+            linked = True
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    if not linked:
+        shutil.copy2(source, temp)
+    os.rename(temp, destination)
+    return linked
+
+
+def replicate(source, destination):
+    """Replicate the tree source to destination. Return the number of
+    linked, copied, unchanged and removed files.
+
+    :param      source: The published tree
+    :type       source: str
+    :param destination: The destination directory
+    :type  destination: str
+    :rtype:             dict"""
+    source = os.path.realpath(source)
+    if not os.path.isdir(source):
+        raise ValueError("Published tree %s doesn't exist" % source)
+    counts = {'linked': 0, 'copied': 0, 'unchanged': 0, 'removed': 0}
+    files = tree_files(source)
+    link = True
+    for relpath in sorted(files, key=replication_order):
+        src = os.path.join(source, relpath)
+        dst = os.path.join(destination, relpath)
+        if unchanged(src, dst):
+            counts['unchanged'] += 1
+            continue
+        linked = replace_file(src, dst, link)
+        # Once a link failed, the destination is on another filesystem
+        link = linked
+        counts['linked' if linked else 'copied'] += 1
+    for relpath in tree_files(destination) - files:
+        os.unlink(os.path.join(destination, relpath))
+        counts['removed'] += 1
+    lg.info(
+        'Replicated %s to %s: %s', source, destination, ", ".join([
+            '%d %s' % (counts[x], x) for x in sorted(counts)
+        ])
+    )
+    return counts
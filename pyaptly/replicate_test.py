@@ -0,0 +1,143 @@
+"""Testing the replication of published trees"""
+import argparse
+import errno
+import os
+import shutil
+import tempfile
+
+from . import (Command, FunctionCommand, SystemStateReader, fan_out,
+               merge_publish_commands, plan_snapshot, replicate,
+               replicate_publish)
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+
+def write(path, content):
+    """Write a file, creating its directory."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_replication_order():
+    """Test if the pool is replicated first and release files last."""
+    files = [
+        'dists/trusty/Release',
+        'dists/trusty/main/binary-amd64/Packages',
+        'pool/main/a/a.deb',
+    ]
+    assert sorted(files, key=replicate.replication_order) == [
+        'pool/main/a/a.deb',
+        'dists/trusty/main/binary-amd64/Packages',
+        'dists/trusty/Release',
+    ]
+
+
+def test_replicate():
+    """Test if files are linked, unchanged files skipped and vanished files
+    removed."""
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'public', 'ubuntu')
+    destination = os.path.join(directory, 'www')
+    try:
+        write(os.path.join(source, 'dists', 'trusty', 'Release'), "1")
+        write(os.path.join(source, 'pool', 'a.deb'), "a")
+        write(os.path.join(destination, 'pool', 'old.deb'), "old")
+        assert replicate.replicate(source, destination) == {
+            'linked': 2, 'copied': 0, 'unchanged': 0, 'removed': 1
+        }
+        assert os.path.samefile(
+            os.path.join(source, 'pool', 'a.deb'),
+            os.path.join(destination, 'pool', 'a.deb'),
+        )
+        assert not os.path.exists(os.path.join(destination, 'pool', 'old.deb'))
+        assert replicate.replicate(source, destination)['unchanged'] == 2
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_replicate_copy():
+    """Test if files are copied to another filesystem and unchanged copies
+    are skipped."""
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'public', 'ubuntu')
+    destination = os.path.join(directory, 'nfs')
+
+    def link(source, destination):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    try:
+        write(os.path.join(source, 'dists', 'trusty', 'Release'), "1")
+        write(os.path.join(source, 'pool', 'a.deb'), "a")
+        with mock.patch('os.link', link):
+            assert replicate.replicate(source, destination)['copied'] == 2
+            assert replicate.replicate(source, destination)['unchanged'] == 2
+            write(os.path.join(source, 'dists', 'trusty', 'Release'), "22")
+            counts = replicate.replicate(source, destination)
+        assert counts['copied'] == 1
+        assert counts['unchanged'] == 1
+        release = os.path.join(destination, 'dists', 'trusty', 'Release')
+        with open(release) as f:
+            assert f.read() == "22"
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_fan_out():
+    """Test if every destination is replicated once after the publish."""
+    config = {
+        'distribution': 'trusty',
+        'destinations': ['/srv/www/ubuntu', '/mnt/nfs/ubuntu'],
+    }
+    trusty = fan_out(
+        [Command(['aptly', 'publish', 'switch', 'trusty', 'ubuntu'])],
+        'ubuntu', config
+    )
+    xenial = fan_out(
+        [Command(['aptly', 'publish', 'switch', 'xenial', 'ubuntu'])],
+        'ubuntu', dict(config, distribution='xenial')
+    )
+    assert len(trusty) == 3
+    commands = merge_publish_commands(trusty + xenial)
+    assert len(commands) == 4
+    replications = [x for x in commands if isinstance(x, FunctionCommand)]
+    assert [x.args[1] for x in replications] == config['destinations']
+    for cmd in replications:
+        assert cmd.cmd is replicate_publish
+        assert cmd._requires == trusty[0]._provides | xenial[0]._provides
+        assert cmd.deferred is None
+    assert fan_out([], 'ubuntu', config) == []
+
+
+def test_snapshot_update_fan_out():
+    """Test if a snapshot update replicates the publishes it switches."""
+    cfg = {
+        'mirror': {'ubuntu': {}},
+        'snapshot': {'base': {'mirror': 'ubuntu'}},
+        'publish': {'ubuntu': [{
+            'distribution': 'trusty',
+            'components': 'main',
+            'snapshots': ['base'],
+            'automatic-update': True,
+            'destinations': ['/srv/www/ubuntu'],
+        }]},
+    }
+    reader = SystemStateReader()
+    reader.mirrors = set(['ubuntu'])
+    reader.snapshots = set(['base'])
+    reader.snapshot_map = {'base': []}
+    reader.publishes = set(['ubuntu trusty'])
+    reader.publish_map = {'ubuntu trusty': ['base']}
+    args = argparse.Namespace(
+        task='update', snapshot_name='base', debug=False
+    )
+    with mock.patch('pyaptly.state', reader):
+        commands = plan_snapshot(cfg, args)
+    assert commands[-1].cmd is replicate_publish
+    assert commands[-1].args == ('ubuntu', '/srv/www/ubuntu')
+    assert commands[-2].cmd[:3] == ['aptly', 'publish', 'switch']
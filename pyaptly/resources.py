@@ -0,0 +1,196 @@
+"""Resource classes of the processes started by pyaptly.
+
+On a shared host a ``publish switch`` signing and compressing big indexes can
+starve other services. The ``resources`` config assigns a resource class per
+kind of command, like the timeouts (ie. "publish switch", "mirror update"):
+
+* ``nice``: increment of the niceness
+* ``ionice``: IO scheduling class, realtime, best-effort or idle, with an
+  optional ``ionice-level`` from 0 (highest) to 7
+* ``cpus``: the CPUs the process may run on
+* ``memory``: maximum address space in MiB (``RLIMIT_AS``), a process
+  exceeding it fails
+
+The class is applied in the child process between fork and exec, through
+the ``preexec_fn`` of :py:class:`subprocess.Popen`. Everything it needs is
+prepared in pyaptly before, the child only makes system calls.
+"""
+import os
+import platform
+
+# IO scheduling classes of ioprio_set
+ionice_classes = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# Number of the ioprio_set system call per machine
+ioprio_syscalls = {
+    'x86_64':  251,
+    'i386':    289,
+    'i686':    289,
+    'aarch64': 30,
+    'armv7l':  314,
+    'ppc64le': 273,
+}
+ioprio_class_shift = 13
+ioprio_who_process = 1
+
+config_keys = set(['nice', 'ionice', 'ionice-level', 'cpus', 'memory'])
+
+
+def io_priority_setter():
+    """Return the function setting the IO priority of the calling process,
+    it takes the ioprio value.
+
+    :rtype: function"""
+    import ctypes
+    import ctypes.util
+    machine = platform.machine()
+    if machine not in ioprio_syscalls:
+        raise ValueError("ionice isn't supported on %s" % machine)
+    number = ioprio_syscalls[machine]
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    syscall = libc.syscall
+
+    def set_io_priority(value):
+        syscall(number, ioprio_who_process, 0, value)
+    return set_io_priority
+
+
+class ResourceClass(object):
+    """Scheduling and limits of the processes of a kind of command.
+
+    :param         nice: Increment of the niceness
+    :type          nice: int
+    :param       ionice: IO scheduling class, see :data:`ionice_classes`
+    :type        ionice: str
+    :param ionice_level: Level in the IO scheduling class, 0 to 7
+    :type  ionice_level: int
+    :param         cpus: CPUs the process may run on
+    :type          cpus: list
+    :param       memory: Maximum address space in MiB
+    :type        memory: int"""
+
+    def __init__(
+            self, nice=None, ionice=None, ionice_level=None, cpus=None,
+            memory=None
+    ):
+        self.nice         = nice
+        self.ionice       = ionice
+        self.ionice_level = ionice_level
+        self.cpus         = cpus
+        self.memory       = memory
+        self._set_io_priority = None
+        if ionice is not None:
+            self._set_io_priority = io_priority_setter()
+
+    @classmethod
+    def from_config(cls, kind, config):
+        """Create a resource class from the config.
+
+        :param   kind: The kind of command, for errors
+        :type    kind: str
+        :param config: The class, see the module documentation
+        :type  config: dict
+        :rtype:        ResourceClass"""
+        unknown = set(config) - config_keys
+        if unknown:
+            raise ValueError("Unknown resources of %s: %s" % (
+                kind, ", ".join(sorted(unknown))
+            ))
+        ionice = config.get('ionice')
+        if ionice is not None and ionice not in ionice_classes:
+            raise ValueError("Unknown ionice class of %s: %s" % (kind, ionice))
+        level = config.get('ionice-level')
+        if level is not None and not 0 <= int(level) <= 7:
+            raise ValueError("ionice-level of %s must be 0 to 7" % kind)
+        cpus = config.get('cpus')
+        if cpus is not None:
+            if not hasattr(os, 'sched_setaffinity'):
+                raise ValueError("cpus of %s aren't supported here" % kind)
+            if not isinstance(cpus, list):
+                cpus = [cpus]
+            cpus = [int(x) for x in cpus]
+        return cls(
+            nice=config.get('nice'),
+            ionice=ionice,
+            ionice_level=level,
+            cpus=cpus,
+            memory=config.get('memory'),
+        )
+
+    def io_priority(self):
+        """Return the ioprio value of the class.
+
+        :rtype: int"""
+        level = self.ionice_level
+        if level is None:
+            level = 0 if self.ionice == 'idle' else 4
+        return (
+            ionice_classes[self.ionice] << ioprio_class_shift | int(level)
+        )
+
+    def preexec(self, niceness=None):
+        """Return the function applying the class in the child process, None
+        if there is nothing to apply.
+
+        :param niceness: Additional increment of the niceness, ie. of
+                         deferred commands
+        :type  niceness: int
+        :rtype:          function"""
+        import resource
+        nice = (self.nice or 0) + (niceness or 0)
+        io_priority = None
+        if self.ionice is not None:
+            io_priority = self.io_priority()
+        set_io_priority = self._set_io_priority
+        cpus = self.cpus
+        memory = None
+        if self.memory:
+            memory = int(self.memory) * 1024 * 1024
+        if not (nice or io_priority is not None or cpus or memory):
+            return None
+        setrlimit = resource.setrlimit
+        rlimit_as = resource.RLIMIT_AS
+
+        def preexec():
+            if nice:
+                os.nice(nice)
+            if io_priority is not None:
+                set_io_priority(io_priority)
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+            if memory:
+                setrlimit(rlimit_as, (memory, memory))
+        return preexec
+
+
+class Resources(object):
+    """The resource classes per kind of command.
+
+    :param classes: Kind -> :class:`ResourceClass`
+    :type  classes: dict"""
+
+    def __init__(self, classes):
+        self.classes = classes
+
+    @classmethod
+    def from_config(cls, config):
+        """Create the resource classes from the "resources" config.
+
+        :param config: Kind -> class
+        :type  config: dict
+        :rtype:        Resources"""
+        return cls(dict([
+            (kind, ResourceClass.from_config(kind, class_config))
+            for kind, class_config in config.items()
+        ]))
+
+    def preexec(self, kind, niceness=None):
+        """Return the function applying the class of a kind of command in
+        the child process, None if there is nothing to apply.
+
+        :param     kind: The kind of the command
+        :type      kind: str
+        :param niceness: Additional increment of the niceness
+        :type  niceness: int
+        :rtype:          function"""
+        return self.classes.get(kind, ResourceClass()).preexec(niceness)
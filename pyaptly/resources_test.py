@@ -0,0 +1,71 @@
+"""Testing the resource classes of processes"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from . import Command, resources
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+report = """
+import ctypes, json, os, resource
+libc = ctypes.CDLL(None)
+print(json.dumps({
+    'nice': os.nice(0),
+    'cpus': sorted(os.sched_getaffinity(0)),
+    'memory': resource.getrlimit(resource.RLIMIT_AS)[0],
+    'ioprio': libc.syscall(252, 1, 0),
+}))
+"""
+
+
+def test_from_config():
+    """Test if invalid resource classes are rejected."""
+    for config in [
+            {'niceness': 10},
+            {'ionice': 'lazy'},
+            {'ionice': 'best-effort', 'ionice-level': 9},
+    ]:
+        error = False
+        try:
+            resources.Resources.from_config({'publish switch': config})
+        except ValueError:
+            error = True
+        assert error
+    assert resources.Resources({}).preexec('publish switch') is None
+
+
+@pytest.mark.skipif(
+    not hasattr(os, 'sched_getaffinity') or
+    resources.platform.machine() != 'x86_64',
+    reason="requires linux on x86_64"
+)
+def test_preexec():
+    """Test if the class of the kind of a command is applied to its process,
+    on top of the lower priority of deferred commands."""
+    classes = resources.Resources.from_config({
+        'publish switch': {
+            'nice': 5,
+            'ionice': 'idle',
+            'cpus': [sorted(os.sched_getaffinity(0))[0]],
+            'memory': 4096,
+        },
+    })
+    cmd = Command(['aptly', 'publish', 'switch', 'trusty', 'ubuntu'])
+    cmd.deferred = 'contents'
+    with mock.patch.object(Command, 'resources', classes):
+        preexec = cmd.preexec()
+    output = subprocess.check_output(
+        [sys.executable, '-c', report], preexec_fn=preexec
+    )
+    applied = json.loads(output.decode("UTF-8"))
+    assert applied['nice'] == min(os.nice(0) + 15, 19)
+    assert applied['cpus'] == classes.classes['publish switch'].cpus
+    assert applied['memory'] == 4096 * 1024 * 1024
+    assert applied['ioprio'] == 3 << 13
@@ -0,0 +1,188 @@
+"""Advisory lock serialising the pyaptly runs on one aptly root.
+
+A run changing aptly takes an exclusive flock on ``pyaptly.lock`` in the
+aptly root directory before it reads the state. A second run waits for the
+lock, at most ``--lock-timeout`` seconds. While waiting, its request is listed
+in ``pyaptly.queue`` next to the lock::
+
+    [{"config": "/etc/pyaptly.yml", "entry": "mirror", "task": "update",
+      "name": "all", "pid": 4242}]
+
+A run whose request is covered by a request already waiting doesn't wait, it
+is coalesced: the waiting run will do the same work after the current run.
+A request covers another one if the config, entry and task are the same and
+its name is the same or "all". Requests of processes that died are ignored.
+"""
+import errno
+import fcntl
+import json
+import os
+import time
+
+from . import lg
+
+# Exit status of a run that was coalesced with a waiting run
+coalesced_status = 3
+
+# Seconds between attempts to take the lock
+poll_interval = 0.5
+
+
+class LockTimeout(Exception):
+    """Raised when the lock wasn't acquired within the timeout."""
+
+
+def aptly_root():
+    """Return the root directory of aptly, read from ~/.aptly.conf or
+    /etc/aptly.conf like aptly does, ~/.aptly if neither exists.
+
+    :rtype: str"""
+    for path in (os.path.expanduser('~/.aptly.conf'), '/etc/aptly.conf'):
+        if os.path.exists(path):
+            with open(path) as conf:
+                root = json.load(conf).get('rootDir')
+            if root:
+                return os.path.expanduser(root)
+    return os.path.expanduser('~/.aptly')
+
+
+def covers(queued, request):
+    """Return True if the work of request is part of the queued request.
+
+    :param  queued: A request waiting for the lock
+    :type   queued: dict
+    :param request: The new request
+    :type  request: dict
+    :rtype:         bool"""
+    for key in ('config', 'entry', 'task', 'directories'):
+        if queued.get(key) != request.get(key):
+            return False
+    return queued.get('name') in ('all', request.get('name'))
+
+
+def alive(pid):
+    """Return True if a process with pid exists.
+
+    :param pid: The process id
+    :type  pid: int
+    :rtype:     bool"""
+    if not isinstance(pid, int):
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class RunLock(object):
+    """Exclusive lock of an aptly root with a queue of waiting requests.
+
+    :param    root: The aptly root directory
+    :type     root: str
+    :param timeout: Seconds to wait for the lock, None waits forever
+    :type  timeout: float"""
+
+    def __init__(self, root, timeout=None):
+        self.root       = root
+        self.timeout    = timeout
+        self.path       = os.path.join(root, 'pyaptly.lock')
+        self.queue_path = os.path.join(root, 'pyaptly.queue')
+        self._fd        = None
+
+    def _try_lock(self):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def _update_queue(self, update):
+        """Read the queue, call update with the requests of living processes
+        and write the list it returns, while holding a lock on the queue.
+
+        :param update: Function changing the queue
+        :type  update: function"""
+        fd = os.open(self.queue_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = b""
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                queue = json.loads(data.decode("UTF-8") or "[]")
+            except ValueError:
+                lg.warning('Ignoring corrupt run queue %s', self.queue_path)
+                queue = []
+            queue = [x for x in queue if alive(x.get('pid'))]
+            queue = update(queue)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, json.dumps(queue, sort_keys=True).encode("UTF-8"))
+        finally:
+            os.close(fd)
+
+    def acquire(self, request):
+        """Take the lock, waiting for the current run if needed. Return False
+        if the request was coalesced with a waiting request instead.
+
+        :param request: The request of this run (config, entry, task, name)
+        :type  request: dict
+        :rtype:         bool"""
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if self._try_lock():
+            return True
+        request = dict(request, pid=os.getpid())
+        waiting = []
+
+        def enqueue(queue):
+            for queued in queue:
+                if covers(queued, request):
+                    lg.info('Coalescing with waiting run %s', queued)
+                    return queue
+            waiting.append(request)
+            return queue + [request]
+
+        def dequeue(queue):
+            return [x for x in queue if x.get('pid') != request['pid']]
+
+        self._update_queue(enqueue)
+        if not waiting:
+            self._close()
+            return False
+        lg.info('Waiting for the run holding %s', self.path)
+        start = time.time()
+        try:
+            while not self._try_lock():
+                if (
+                        self.timeout is not None and
+                        time.time() - start > self.timeout
+                ):
+                    self._close()
+                    raise LockTimeout(
+                        "Another run held %s for more than %s seconds" % (
+                            self.path, self.timeout
+                        )
+                    )
+                time.sleep(poll_interval)
+        finally:
+            self._update_queue(dequeue)
+        return True
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def release(self):
+        """Release the lock."""
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._close()
@@ -0,0 +1,128 @@
+"""Testing the run lock of the aptly root"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from . import mirror, plan, run_request, runlock
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+
+def request(name='all', task='update'):
+    """Return a request of a mirror run."""
+    return {
+        'config': '/etc/pyaptly.yml',
+        'entry':  'mirror',
+        'task':   task,
+        'name':   name,
+    }
+
+
+def test_covers():
+    """Test if a request covers the same or fewer entities."""
+    assert runlock.covers(request(), request())
+    assert runlock.covers(request(), request('ubuntu'))
+    assert runlock.covers(request('ubuntu'), request('ubuntu'))
+    assert not runlock.covers(request('ubuntu'), request())
+    assert not runlock.covers(request('ubuntu'), request('debian'))
+    assert not runlock.covers(request(), request(task='create'))
+    assert not runlock.covers(
+        request(), dict(request('ubuntu'), directories=['/srv/incoming'])
+    )
+
+
+def test_aptly_root():
+    """Test if the root directory is read from the aptly config."""
+    home = tempfile.mkdtemp()
+    exists = os.path.exists
+    try:
+        with mock.patch.dict(os.environ, {'HOME': home}):
+            with mock.patch(
+                    'os.path.exists',
+                    lambda x: x.startswith(home) and exists(x)
+            ):
+                assert runlock.aptly_root() == os.path.join(home, '.aptly')
+                with open(os.path.join(home, '.aptly.conf'), 'w') as conf:
+                    json.dump({'rootDir': '/srv/aptly'}, conf)
+                assert runlock.aptly_root() == '/srv/aptly'
+    finally:
+        shutil.rmtree(home)
+
+
+def test_lock_wait():
+    """Test if a second run waits for the lock or times out."""
+    root = tempfile.mkdtemp()
+    first = runlock.RunLock(root)
+    try:
+        assert first.acquire(request())
+        error = False
+        try:
+            runlock.RunLock(root, timeout=0.2).acquire(request('ubuntu'))
+        except runlock.LockTimeout:
+            error = True
+        assert error
+        with open(os.path.join(root, 'pyaptly.queue')) as queue:
+            assert json.load(queue) == []
+        timer = threading.Timer(0.3, first.release)
+        timer.start()
+        start = time.time()
+        second = runlock.RunLock(root, timeout=10)
+        with mock.patch.object(runlock, 'poll_interval', 0.05):
+            assert second.acquire(request('ubuntu'))
+        assert time.time() - start >= 0.25
+        second.release()
+        timer.join()
+    finally:
+        first.release()
+        shutil.rmtree(root)
+
+
+def test_lock_coalesce():
+    """Test if a request covered by a waiting request is coalesced, and
+    requests of dead processes are ignored."""
+    root = tempfile.mkdtemp()
+    first = runlock.RunLock(root)
+    process = subprocess.Popen(['true'])
+    process.wait()
+    try:
+        assert first.acquire(request())
+        with open(os.path.join(root, 'pyaptly.queue'), 'w') as queue:
+            json.dump([
+                dict(request(), pid=os.getppid()),
+                dict(request(task='create'), pid=process.pid),
+            ], queue)
+        assert not runlock.RunLock(root).acquire(request('ubuntu'))
+        error = False
+        try:
+            runlock.RunLock(root, timeout=0).acquire(request(task='create'))
+        except runlock.LockTimeout:
+            error = True
+        assert error
+        with open(os.path.join(root, 'pyaptly.queue')) as queue:
+            assert json.load(queue) == [dict(request(), pid=os.getppid())]
+    finally:
+        first.release()
+        shutil.rmtree(root)
+
+
+def test_run_request():
+    """Test if runs changing aptly are locked with their request."""
+    args = argparse.Namespace(
+        func=mirror, config='mirror.yml', task='update', mirror_name='all'
+    )
+    assert run_request(args) == {
+        'config': os.path.abspath('mirror.yml'),
+        'entry':  'mirror',
+        'task':   'update',
+        'name':   'all',
+    }
+    args.func = plan
+    assert run_request(args) is None
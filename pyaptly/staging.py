@@ -0,0 +1,204 @@
+r"""Staged publishes, switched by flipping a symlink.
+
+aptly rewrites a published directory in place, clients may see partially
+regenerated indexes while a big publish is switched. A publish with
+``staged: true`` is therefore published by aptly to the hidden prefix
+``.staged/<name>`` instead. Once aptly has finished and signed it, the staged
+tree is released:
+
+* ``dists`` is copied and ``pool`` is hard-linked to
+  ``.releases/<name>/<timestamp>`` in the public directory
+* the symlink ``<name>`` is flipped to the new release with an atomic rename
+
+Clients see either the old or the new tree, the flip itself is a single
+rename. Preparing the release isn't free: every file of the pool is
+hard-linked, so it takes time proportional to the number of files, but no
+package is copied. The previous release is kept for :func:`rollback`, older
+releases are removed.
+
+``.staged`` and ``.releases`` are in the public directory, so the release
+symlinks can be relative. The web server must not serve them, or clients may
+fetch the unfinished staged tree. It has to follow the symlinks though, for
+example with nginx::
+
+    location ~ /\.(staged|releases)/ { deny all; }
+"""
+import os
+import shutil
+import time
+
+from . import lg
+
+staging_prefix = '.staged'
+releases_dir   = '.releases'
+
+# Number of releases kept, the current one and the ones to roll back to
+keep_releases = 2
+
+
+def public_dir():
+    """Return the directory aptly publishes to.
+
+    :rtype: str"""
+    from . import runlock
+    return os.path.join(runlock.aptly_root(), 'public')
+
+
+def staged_name(publish_name):
+    """Return the prefix a staged publish is published to by aptly.
+
+    :param publish_name: Name (prefix) of the publish
+    :type  publish_name: str
+    :rtype:              str"""
+    return '%s/%s' % (staging_prefix, publish_name)
+
+
+def copy_release(source, destination):
+    """Copy a staged tree, hard-linking the files in the pool. It walks the
+    whole tree, one link per file of the pool.
+
+    :param      source: The staged tree
+    :type       source: str
+    :param destination: The new release
+    :type  destination: str"""
+    pool = os.path.join(source, 'pool')
+    for dirpath, dirnames, filenames in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(dirpath, source))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        in_pool = dirpath == pool or dirpath.startswith(pool + os.sep)
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if in_pool:
+                try:
+                    os.link(path, os.path.join(target, filename))
+                    continue
+                except OSError:  # pragma: no cover
+                    pass
+            shutil.copy2(path, os.path.join(target, filename))
+
+
+def flip(link, target):
+    """Point the symlink link to target with an atomic rename.
+
+    :param   link: Path of the symlink
+    :type    link: str
+    :param target: The new target, relative to the directory of link
+    :type  target: str"""
+    temp = '%s.flip-%d' % (link, os.getpid())
+    if os.path.lexists(temp):  # pragma: no cover
+        os.unlink(temp)
+    os.symlink(target, temp)
+    if os.path.isdir(link) and not os.path.islink(link):
+        # First release of a publish aptly created in place, keep the old
+        # tree next to the releases
+        aside = '%s.unstaged-%d' % (link, int(time.time()))
+        lg.warning('Moving unstaged publish %s to %s', link, aside)
+        os.rename(link, aside)
+    os.rename(temp, link)
+
+
+def releases(publish_name, public):
+    """Return the paths of the releases of a publish, oldest first.
+
+    :param publish_name: Name (prefix) of the publish
+    :type  publish_name: str
+    :param       public: The public directory
+    :type        public: str
+    :rtype:              list"""
+    directory = os.path.join(public, releases_dir, publish_name)
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, x) for x in sorted(os.listdir(directory))]
+
+
+def current_release(publish_name, public):
+    """Return the path of the release the publish points to, None if it isn't
+    staged yet.
+
+    :param publish_name: Name (prefix) of the publish
+    :type  publish_name: str
+    :param       public: The public directory
+    :type        public: str
+    :rtype:              str"""
+    link = os.path.join(public, publish_name)
+    if not os.path.islink(link):
+        return None
+    return os.path.normpath(
+        os.path.join(os.path.dirname(link), os.readlink(link))
+    )
+
+
+def point_to(publish_name, public, release_path):
+    """Flip the publish to a release.
+
+    :param publish_name: Name (prefix) of the publish
+    :type  publish_name: str
+    :param       public: The public directory
+    :type        public: str
+    :param release_path: Path of the release
+    :type  release_path: str"""
+    link = os.path.join(public, publish_name)
+    parent = os.path.dirname(link)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    flip(link, os.path.relpath(release_path, parent))
+    lg.info('Publish %s points to %s', publish_name, release_path)
+
+
+def release(publish_name, public=None):
+    """Release the staged tree of a publish, see the module documentation.
+
+    :param publish_name: Name (prefix) of the publish
+    :type  publish_name: str
+    :param       public: The public directory, defaults to the one of aptly
+    :type        public: str
+    :rtype:              str"""
+    if public is None:
+        public = public_dir()
+    staged = os.path.join(public, staged_name(publish_name))
+    if not os.path.isdir(staged):
+        raise ValueError("Staged publish %s doesn't exist" % staged)
+    name = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    existing = releases(publish_name, public)
+    serial = 0
+    path = os.path.join(public, releases_dir, publish_name, name)
+    while path in existing or os.path.exists(path):
+        serial += 1
+        path = os.path.join(
+            public, releases_dir, publish_name, '%s.%d' % (name, serial)
+        )
+    temp = path + '.tmp'
+    if os.path.exists(temp):  # pragma: no cover
+        shutil.rmtree(temp)
+    copy_release(staged, temp)
+    os.rename(temp, path)
+    point_to(publish_name, public, path)
+    for old in releases(publish_name, public)[:-keep_releases]:
+        if not old.endswith('.tmp'):
+            lg.debug('Removing old release %s', old)
+            shutil.rmtree(old)
+    return path
+
+
+def rollback(publish_name, public=None):
+    """Flip a publish back to the release before the current one.
+
+    :param publish_name: Name (prefix) of the publish
+    :type  publish_name: str
+    :param       public: The public directory, defaults to the one of aptly
+    :type        public: str
+    :rtype:              str"""
+    if public is None:
+        public = public_dir()
+    current = current_release(publish_name, public)
+    existing = [
+        x for x in releases(publish_name, public) if not x.endswith('.tmp')
+    ]
+    if current not in existing or existing.index(current) == 0:
+        raise ValueError(
+            "No previous release of %s to roll back to" % publish_name
+        )
+    previous = existing[existing.index(current) - 1]
+    point_to(publish_name, public, previous)
+    return previous
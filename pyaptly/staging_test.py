@@ -0,0 +1,147 @@
+"""Testing staged publishes"""
+import argparse
+import os
+import shutil
+import tempfile
+
+from . import (FunctionCommand, SystemStateReader, merge_publish_commands,
+               plan_snapshot, publish_cmd_create, release_staged, staging)
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+
+def write(path, content):
+    """Write a file, creating its directory."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def read(path):
+    """Read a file."""
+    with open(path) as f:
+        return f.read()
+
+
+def test_release_rollback():
+    """Test if the staged tree is released by flipping a symlink and the
+    previous release can be restored."""
+    public = tempfile.mkdtemp()
+    staged = os.path.join(public, '.staged', 'ubuntu', 'stable')
+    live = os.path.join(public, 'ubuntu', 'stable')
+    deb = os.path.join('pool', 'main', 'a', 'a_1.deb')
+    try:
+        # A publish aptly created in place
+        write(os.path.join(live, 'dists', 'trusty', 'Release'), "unstaged")
+        write(os.path.join(staged, 'dists', 'trusty', 'Release'), "first")
+        write(os.path.join(staged, deb), "deb")
+        with mock.patch.object(staging, 'keep_releases', 2):
+            first = staging.release('ubuntu/stable', public)
+            assert os.path.islink(live)
+            assert read(os.path.join(live, 'dists', 'trusty', 'Release')) == (
+                "first"
+            )
+            assert os.path.samefile(
+                os.path.join(live, deb), os.path.join(staged, deb)
+            )
+            write(os.path.join(staged, 'dists', 'trusty', 'Release'), "second")
+            second = staging.release('ubuntu/stable', public)
+            assert second != first
+            assert read(os.path.join(live, 'dists', 'trusty', 'Release')) == (
+                "second"
+            )
+            assert staging.rollback('ubuntu/stable', public) == first
+            assert read(os.path.join(live, 'dists', 'trusty', 'Release')) == (
+                "first"
+            )
+            error = False
+            try:
+                staging.rollback('ubuntu/stable', public)
+            except ValueError:
+                error = True
+            assert error
+            staging.release('ubuntu/stable', public)
+            assert staging.releases('ubuntu/stable', public)[0] == second
+            assert not os.path.exists(first)
+        unstaged = [
+            x for x in os.listdir(os.path.join(public, 'ubuntu'))
+            if x.startswith('stable.unstaged-')
+        ]
+        assert len(unstaged) == 1
+    finally:
+        shutil.rmtree(public)
+
+
+def test_staged_publish_commands():
+    """Test if a staged publish is published to the staging prefix and
+    released once per publish."""
+    config = {
+        'distribution': 'trusty',
+        'components': 'main',
+        'snapshots': ['base'],
+        'staged': True,
+    }
+    with mock.patch('pyaptly.state', SystemStateReader()):
+        trusty = publish_cmd_create({}, 'ubuntu', config)
+        xenial = publish_cmd_create(
+            {}, 'ubuntu', dict(config, distribution='xenial')
+        )
+    assert trusty[0].cmd[-1] == '.staged/ubuntu'
+    commands = merge_publish_commands(trusty + xenial)
+    assert len(commands) == 3
+    release = commands[1]
+    assert isinstance(release, FunctionCommand)
+    assert release.cmd is release_staged
+    assert release._requires == set([
+        ('virtual', 'staged ubuntu trusty'),
+        ('virtual', 'staged ubuntu xenial'),
+    ])
+    assert ('publish', '.staged/ubuntu trusty') in trusty[0]._provides
+
+
+def test_staged_snapshot_update():
+    """Test if a snapshot update republishes the staged publishes of the
+    snapshot and releases them once."""
+    entry = {
+        'distribution': 'trusty',
+        'components': 'main',
+        'snapshots': ['base'],
+        'staged': True,
+        'automatic-update': True,
+    }
+    cfg = {
+        'mirror': {'ubuntu': {}},
+        'snapshot': {'base': {'mirror': 'ubuntu'}},
+        'publish': {'ubuntu': [entry, dict(entry, distribution='xenial')]},
+    }
+    reader = SystemStateReader()
+    reader.mirrors = set(['ubuntu'])
+    reader.snapshots = set(['base'])
+    reader.snapshot_map = {'base': []}
+    reader.publishes = set(['.staged/ubuntu trusty', '.staged/ubuntu xenial'])
+    reader.publish_map = {
+        '.staged/ubuntu trusty': ['base'],
+        '.staged/ubuntu xenial': ['base'],
+    }
+    args = argparse.Namespace(
+        task='update', snapshot_name='base', debug=False
+    )
+    with mock.patch('pyaptly.state', reader):
+        commands = plan_snapshot(cfg, args)
+    republished = [
+        cmd.cmd[-2] for cmd in commands
+        if not isinstance(cmd, FunctionCommand) and
+        cmd.cmd[:3] == ['aptly', 'publish', 'switch']
+    ]
+    assert republished == ['.staged/ubuntu', '.staged/ubuntu']
+    releases = [
+        cmd for cmd in commands
+        if isinstance(cmd, FunctionCommand) and cmd.cmd is release_staged
+    ]
+    assert len(releases) == 1
+    assert commands.index(releases[0]) == len(commands) - 1
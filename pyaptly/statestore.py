@@ -0,0 +1,275 @@
+"""Compact storage of the state read by :class:`pyaptly.SystemStateReader`.
+
+Every name is stored once in a :class:`NameTable` and referenced by an integer
+id. Sets of names are sorted arrays of ids, the merge-tree and the publish map
+are stored as compressed sparse rows: the sources of the n-th key are
+``targets[offsets[n]:offsets[n + 1]]``. With 50000 timestamped snapshots this
+is a few MB instead of a set and a dict entry per name and source. Every read
+of the state interns into a new table, sets of different reads are compared
+by name.
+
+:class:`NameSet` and :class:`NameMap` are immutable, so copying a state only
+copies references. They compare equal to the plain sets and dicts they
+replace.
+
+The :class:`TimestampIndex` keeps the existing generations of every
+timestamped snapshot template sorted, to resolve back-references like
+"previous" to snapshots that actually exist.
+"""
+import array
+import bisect
+import re
+
+try:
+    from collections.abc import Mapping, Set
+except ImportError:  # pragma: no cover
+    from collections import Mapping, Set
+
+# Type of the id arrays, 4 bytes per id
+id_typecode = 'i'
+
+re_timestamp = re.compile(r'\d{8}T\d{4}Z')
+
+
+class NameTable(object):
+    """Interns names and maps them to consecutive integer ids."""
+
+    __slots__ = ('_names', '_ids')
+
+    def __init__(self):
+        self._names = []
+        self._ids   = {}
+
+    def intern(self, name):
+        """Return the id of a name, adding it to the table if needed.
+
+        :param name: The name
+        :type  name: str
+        :rtype:      int"""
+        id_ = self._ids.get(name)
+        if id_ is None:
+            id_ = len(self._names)
+            self._names.append(name)
+            self._ids[name] = id_
+        return id_
+
+    def lookup(self, name):
+        """Return the id of a name or None if it was never interned.
+
+        :param name: The name
+        :type  name: str
+        :rtype:      int"""
+        return self._ids.get(name)
+
+    def name(self, id_):
+        """Return the name of an id.
+
+        :param id_: The id
+        :type  id_: int
+        :rtype:     str"""
+        return self._names[id_]
+
+    def __len__(self):
+        return len(self._names)
+
+
+def _find(ids, id_):
+    """Return the index of id_ in the sorted array ids or None."""
+    if id_ is None:
+        return None
+    index = bisect.bisect_left(ids, id_)
+    if index < len(ids) and ids[index] == id_:
+        return index
+    return None
+
+
+class NameSet(Set):
+    """Immutable set of names stored as sorted array of ids.
+
+    :param table: Table the names are interned in
+    :type  table: NameTable
+    :param names: The names
+    :type  names: iterable"""
+
+    __slots__ = ('table', 'ids')
+
+    def __init__(self, table, names=()):
+        self.table = table
+        self.ids   = array.array(
+            id_typecode, sorted(set([table.intern(name) for name in names]))
+        )
+
+    @classmethod
+    def from_ids(cls, table, ids):
+        """Create a set from a sorted array of unique ids.
+
+        :param table: Table the ids belong to
+        :type  table: NameTable
+        :param   ids: Sorted unique ids
+        :type    ids: :py:class:`array.array`
+        :rtype:       NameSet"""
+        self = cls.__new__(cls)
+        self.table = table
+        self.ids   = ids
+        return self
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        # Results of set operations are plain sets
+        return set(iterable)
+
+    def __contains__(self, name):
+        return _find(self.ids, self.table.lookup(name)) is not None
+
+    def __iter__(self):
+        name = self.table.name
+        for id_ in self.ids:
+            yield name(id_)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return "NameSet(%r)" % sorted(self)
+
+
+class NameMap(Mapping):
+    """Immutable mapping of names to sets of names, stored as compressed
+    sparse rows.
+
+    :param   table: Table the names are interned in
+    :type    table: NameTable
+    :param mapping: Mapping of names to iterables of names
+    :type  mapping: dict"""
+
+    __slots__ = ('table', 'key_ids', 'offsets', 'targets')
+
+    def __init__(self, table, mapping=None):
+        rows = sorted([
+            (
+                table.intern(key),
+                sorted(set([table.intern(name) for name in names]))
+            )
+            for key, names in (mapping or {}).items()
+        ])
+        self.table   = table
+        self.key_ids = array.array(id_typecode)
+        self.offsets = array.array(id_typecode, [0])
+        self.targets = array.array(id_typecode)
+        for key_id, ids in rows:
+            self.key_ids.append(key_id)
+            self.targets.extend(ids)
+            self.offsets.append(len(self.targets))
+
+    def __getitem__(self, name):
+        index = _find(self.key_ids, self.table.lookup(name))
+        if index is None:
+            raise KeyError(name)
+        return NameSet.from_ids(
+            self.table,
+            self.targets[self.offsets[index]:self.offsets[index + 1]]
+        )
+
+    def __contains__(self, name):
+        return _find(self.key_ids, self.table.lookup(name)) is not None
+
+    def __iter__(self):
+        name = self.table.name
+        for id_ in self.key_ids:
+            yield name(id_)
+
+    def __len__(self):
+        return len(self.key_ids)
+
+    def __repr__(self):
+        return "NameMap(%r)" % dict([
+            (key, sorted(names)) for key, names in self.items()
+        ])
+
+
+def diff(old, new):
+    """Compare two sets of names.
+
+    Sets of the same table are compared by id, without looking at the names.
+
+    :param old: The earlier set
+    :type  old: NameSet or set
+    :param new: The later set
+    :type  new: NameSet or set
+    :rtype:     (set, set) of added and removed names"""
+    if (
+            isinstance(old, NameSet) and
+            isinstance(new, NameSet) and
+            old.table is new.table
+    ):
+        old_ids = set(old.ids)
+        new_ids = set(new.ids)
+        table   = new.table
+        return (
+            set([table.name(id_) for id_ in new_ids - old_ids]),
+            set([table.name(id_) for id_ in old_ids - new_ids]),
+        )
+    return set(new) - set(old), set(old) - set(new)
+
+
+class TimestampIndex(object):
+    """Sorted timestamps of the existing snapshots per %T template.
+
+    Every snapshot name containing exactly one timestamp is indexed under its
+    template, the name with the timestamp replaced by %T. The timestamps are
+    formatted by :func:`pyaptly.format_timestamp`, so sorting them as strings
+    sorts them chronologically.
+
+    :param names: Names of the existing snapshots
+    :type  names: iterable"""
+
+    __slots__ = ('_generations', )
+
+    def __init__(self, names):
+        generations = {}
+        for name in names:
+            timestamps = re_timestamp.findall(name)
+            if len(timestamps) != 1:
+                continue
+            template = name.replace(timestamps[0], '%T')
+            generations.setdefault(template, []).append(timestamps[0])
+        for timestamps in generations.values():
+            timestamps.sort()
+        self._generations = generations
+
+    def generations(self, template):
+        """Return the sorted timestamps of the existing generations of a
+        template.
+
+        :param template: Snapshot name containing %T
+        :type  template: str
+        :rtype:          list"""
+        return self._generations.get(template, [])
+
+    def before(self, template, timestamp, back=1):
+        """Return the timestamp of the back-th existing generation older than
+        timestamp or None if there are fewer generations.
+
+        :param  template: Snapshot name containing %T
+        :type   template: str
+        :param timestamp: Formatted timestamp
+        :type  timestamp: str
+        :param      back: 1 for the newest generation before timestamp
+        :type       back: int
+        :rtype:           str"""
+        timestamps = self.generations(template)
+        index = bisect.bisect_left(timestamps, timestamp) - back
+        if back < 1 or index < 0:
+            return None
+        return timestamps[index]
+
+    def latest(self, template):
+        """Return the timestamp of the newest existing generation or None.
+
+        :param template: Snapshot name containing %T
+        :type  template: str
+        :rtype:          str"""
+        timestamps = self.generations(template)
+        if not timestamps:
+            return None
+        return timestamps[-1]
@@ -0,0 +1,160 @@
+"""Testing the compact state store"""
+import freezegun
+import pytest
+
+from . import (FunctionCommand, SystemStateReader, fail_unplanned,
+               publish_cmd_create, snapshot_spec_to_name, statestore)
+
+try:
+    import unittest.mock as mock
+except ImportError:  # pragma: no cover
+    import mock
+
+
+def test_name_set():
+    """Test if a name set behaves like the set it replaces."""
+    table = statestore.NameTable()
+    names = statestore.NameSet(table, ['b', 'a', 'b', 'c'])
+    assert len(table) == 3
+    assert names == set(['a', 'b', 'c'])
+    assert set(['a', 'b', 'c']) == names
+    assert names != set(['a'])
+    assert 'a' in names
+    assert 'd' not in names
+    assert len(names) == 3
+    assert set(['a', 'c']).issubset(names)
+    assert names - set(['a']) == set(['b', 'c'])
+    assert statestore.NameSet(table) == set()
+
+
+def test_name_map():
+    """Test if a name map behaves like the dict of sets it replaces."""
+    table = statestore.NameTable()
+    expect = {
+        'merged': set(['a', 'b']),
+        'a': set(['base']),
+        'empty': set(),
+    }
+    names = statestore.NameMap(table, expect)
+    assert names == expect
+    assert expect == names
+    assert names['merged'] == set(['a', 'b'])
+    assert names.get('missing', []) == []
+    assert 'base' not in names
+    assert sorted(names) == ['a', 'empty', 'merged']
+    error = False
+    try:
+        names['base']
+    except KeyError:
+        error = True
+    assert error
+    assert statestore.NameMap(table) == {}
+
+
+def test_state_diff():
+    """Test if states are copied and compared."""
+    old = SystemStateReader()
+    old.snapshots = old._name_set(['a', 'b'])
+    old.mirrors   = old._name_set(['m'])
+    new = old.copy()
+    assert new.names is old.names
+    new.snapshots = new._name_set(['b', 'c'])
+    changes = new.diff(old)
+    assert changes['snapshots'] == (set(['c']), set(['a']))
+    assert changes['mirrors'] == (set(), set())
+    assert changes['publishes'] == (set(), set())
+    assert statestore.diff(set(['a']), new.snapshots) == (
+        set(['b', 'c']), set(['a'])
+    )
+
+
+def test_read_new_table():
+    """Test if every read interns into a new table, so it doesn't grow with
+    every state read, and states of different reads are still compared."""
+    reader = SystemStateReader()
+    outputs = {
+        'repo': [['a', 'b'], ['b', 'c']],
+    }
+
+    def call(args):
+        if args[:2] == ['aptly', 'repo']:
+            return outputs['repo'].pop(0)
+        return []
+    with mock.patch('pyaptly.call_output_lines', call):
+        reader.read()
+        old = reader.copy()
+        reader.read()
+    assert reader.names is not old.names
+    assert len(reader.names) == 2
+    assert reader.diff(old)['repos'] == (set(['c']), set(['a']))
+
+
+def test_timestamp_index():
+    """Test if existing generations are indexed per template."""
+    index = statestore.TimestampIndex([
+        'foo-20121010T0000Z',
+        'foo-20121001T0000Z',
+        'foo-20121007T0000Z',
+        'bar-20121010T0000Z',
+        'foo-20121010T0000Z-rotated-20121011T1010Z',
+        'plain',
+    ])
+    assert index.generations('foo-%T') == [
+        '20121001T0000Z', '20121007T0000Z', '20121010T0000Z'
+    ]
+    assert index.latest('foo-%T') == '20121010T0000Z'
+    assert index.latest('baz-%T') is None
+    assert index.before('foo-%T', '20121010T0000Z') == '20121007T0000Z'
+    assert index.before('foo-%T', '20121009T0000Z', 2) == '20121001T0000Z'
+    assert index.before('foo-%T', '20121010T0000Z', 3) is None
+
+
+def test_snapshot_spec_existing():
+    """Test if back-references resolve to existing snapshots."""
+    cfg = {'snapshot': {'foo-%T': {'timestamp': {'time': '00:00'}}}}
+    reader = SystemStateReader()
+    reader.snapshots = reader._name_set([
+        'foo-20121003T0000Z', 'foo-20121007T0000Z'
+    ])
+
+    def spec(ts):
+        return snapshot_spec_to_name(cfg, {'name': 'foo-%T', 'timestamp': ts})
+
+    with mock.patch('pyaptly.state', reader), \
+            freezegun.freeze_time("2012-10-10 10:10:10"):
+        assert spec('current') == 'foo-20121010T0000Z'
+        assert spec('previous') == 'foo-20121007T0000Z'
+        assert spec(2) == 'foo-20121003T0000Z'
+        # Fewer existing generations
+        with pytest.raises(ValueError):
+            spec(3)
+        assert spec('latest') == 'foo-20121007T0000Z'
+        reader.snapshots = reader._name_set([])
+        with pytest.raises(ValueError):
+            spec('previous')
+        assert spec('latest') == 'foo-20121010T0000Z'
+
+
+def test_missing_generation_unplanned():
+    """Test if only the publish referring to a missing generation fails,
+    instead of the whole planning."""
+    cfg = {'snapshot': {'foo-%T': {'timestamp': {'time': '00:00'}}}}
+    reader = SystemStateReader()
+    reader.snapshots = reader._name_set(['foo-20121010T0000Z'])
+    reader.publishes = reader._name_set([])
+
+    def create(ts):
+        return publish_cmd_create(cfg, 'foo', {
+            'distribution': 'main',
+            'components': 'main',
+            'snapshots': [{'name': 'foo-%T', 'timestamp': ts}],
+        })
+
+    with mock.patch('pyaptly.state', reader), \
+            freezegun.freeze_time("2012-10-10 10:10:10"):
+        assert 'foo-20121010T0000Z' in create('current')[0].cmd
+        failing, = create('previous')
+    assert isinstance(failing, FunctionCommand)
+    assert failing.cmd is fail_unplanned
+    with pytest.raises(ValueError):
+        failing.run()
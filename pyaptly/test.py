@@ -26,6 +26,21 @@ else:
     environb = os.environb  # pragma: no cover
 
 
+def init_hypothesis():
+    """Initialize hypothesis profile if hypothesis is available"""
+    try:  # pragma: no cover
+        if b'HYPOTHESIS_PROFILE' in environb:
+            from hypothesis import Settings
+            Settings.register_profile("ci", Settings(
+                max_examples=10000
+            ))
+            Settings.load_profile(os.getenv(u'HYPOTHESIS_PROFILE', 'default'))
+    except (ImportError, AttributeError):  # pragma: no cover
+        pass
+
+init_hypothesis()
+
+
 def read_yml(file_):
     """Read and merge a yml file.
 
@@ -52,9 +52,11 @@ setup(
     },
     install_requires = [
         "pyyaml",
-        "freeze",
         "six"
     ],
+    extras_require = {
+        "leveldb": ["plyvel"],
+    },
     author = "Adfinis-SyGroup",
     author_email = "https://adfinis-sygroup.ch/",
     description = "Aptly mirror/snapshot managment automation.",